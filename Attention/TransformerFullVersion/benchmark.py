@@ -0,0 +1,683 @@
+"""
+TransformerFullVersion 的性能测试，使用随机初始化的模型和随机生成的句子，不需要数据集\n
+在仓库根目录下运行，例如：
+python Attention/TransformerFullVersion/benchmark.py decode
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import torch as t
+from torch.profiler import profile, ProfilerActivity
+from datasets import Vocab, RESERVED_TOKENS
+from export import export_translator
+from loading import make_vocab, make_model, load_trained
+from model import (EncoderBlock, DotProductAttention, MultiHeadAttention, masked_softmax, transpose_qkv,
+                   transpose_output, capture_attention, set_attention_backend, set_activation_checkpointing,
+                   quantize_dynamic_int8)
+from server import MicroBatcher, serve, percentile
+from utils import (predict_seq2seq, predict_seq2seq_batch, beam_search, build_src_batch, MaskedSoftmaxCELoss,
+                   corpus_bleu)
+
+
+def random_sentences(vocab: Vocab, num_sentences: int, max_len: int) -> list[str]:
+    """
+    从词表中随机采样句子
+    """
+    tokens = vocab.idx_to_token[len(RESERVED_TOKENS)+1:]
+    return [" ".join(random.choices(tokens, k=random.randint(1, max_len)))
+            for _ in range(num_sentences)]
+
+
+def timeit(fn, repeat: int) -> float:
+    """
+    先预热一次，然后返回fn平均每次调用的秒数
+    """
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter()-start)/repeat
+
+
+def _measure_in_child(queue, fn, args, setup):
+    if setup is not None:
+        setup()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = fn(*args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((after-before)/1024, result))
+
+
+def peak_memory_mb(fn, *args, setup=None):
+    """
+    在一个新的子进程中运行fn(*args)，返回运行期间常驻内存峰值的增量(MB)和fn的返回值\n
+    setup会在开始测量之前调用，比如导入比较大的模块\n
+    CPU上没有类似torch.cuda.max_memory_allocated的接口，所以用子进程的ru_maxrss来近似
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure_in_child,
+                          args=(queue, fn, args, setup))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def reference_masked_softmax(X: t.Tensor, valid_lens: t.Tensor) -> t.Tensor:
+    """
+    原来基于repeat_interleave和布尔下标赋值的masked_softmax，用来对比结果和速度，它会修改输入的X
+    """
+    shape = X.shape
+    if valid_lens.dim() == 1:
+        valid_lens = t.repeat_interleave(valid_lens, shape[1])
+    else:
+        valid_lens = valid_lens.reshape(-1)
+    X = X.reshape(-1, shape[-1])
+    mask = t.arange(shape[-1], dtype=t.float32, device=X.device)[
+        None, :] < valid_lens[:, None]
+    X[~mask] = -1e6
+    return t.softmax(X.reshape(shape), dim=-1)
+
+
+def bench_attention(args):
+    """
+    masked_softmax和DotProductAttention的微基准，分数的形状为(batch_size*num_heads, num_steps, num_steps)
+    """
+    attention = DotProductAttention(0).eval()
+
+    def reference_attention(queries, keys, values, valid_lens):
+        scores = t.bmm(queries, keys.transpose(1, 2))/math.sqrt(queries.shape[-1])
+        return t.bmm(reference_masked_softmax(scores, valid_lens), values)
+
+    for num_steps in args.seq_lens:
+        X = t.randn(args.batch_size*args.num_heads,
+                    num_steps, num_steps, device=args.device)
+        valid_lens = t.randint(
+            0, num_steps+1, (args.batch_size*args.num_heads,), device=args.device)
+        expected = masked_softmax(X, valid_lens)
+        assert t.equal(expected, reference_masked_softmax(X, valid_lens))
+        old = timeit(lambda: reference_masked_softmax(
+            X, valid_lens), args.repeat)
+        new = timeit(lambda: masked_softmax(X, valid_lens), args.repeat)
+        print(f"num_steps {num_steps:<5}: masked_softmax      reference {old*1e3:8.3f}ms, "
+              f"new {new*1e3:8.3f}ms ({old/new:.2f}x)")
+        Q, K, V = [t.randn(args.batch_size*args.num_heads, num_steps, args.num_hiddens//args.num_heads,
+                           device=args.device) for _ in range(3)]
+        with t.no_grad():
+            assert t.equal(attention(Q, K, V, valid_lens),
+                           reference_attention(Q, K, V, valid_lens))
+            old = timeit(lambda: reference_attention(
+                Q, K, V, valid_lens), args.repeat)
+            new = timeit(lambda: attention(Q, K, V, valid_lens), args.repeat)
+        print(f"num_steps {num_steps:<5}: DotProductAttention reference {old*1e3:8.3f}ms, "
+              f"new {new*1e3:8.3f}ms ({old/new:.2f}x)")
+
+
+def _mha_forward(backend, batch_size, num_steps, num_hiddens, num_heads, repeat):
+    # 返回平均耗时和部分输出，输出转换成列表，避免通过共享内存在进程之间传递张量
+    t.manual_seed(0)
+    attention = MultiHeadAttention(num_hiddens, num_hiddens, num_hiddens,
+                                   num_hiddens, num_heads, 0, backend=backend).eval()
+    X = t.randn(batch_size, num_steps, num_hiddens)
+    valid_lens = t.randint(1, num_steps+1, (batch_size,))
+    with t.no_grad():
+        elapsed = timeit(lambda: attention(X, X, X, valid_lens), repeat)
+        return elapsed, attention(X, X, X, valid_lens)[0, :4].tolist()
+
+
+def bench_sdpa(args):
+    """
+    MultiHeadAttention在math和sdpa两种后端下的耗时和内存峰值，每个配置在单独的子进程中运行
+    """
+    for num_steps in args.seq_lens:
+        (math_mem, (math_time, math_out)), (sdpa_mem, (sdpa_time, sdpa_out)) = [
+            peak_memory_mb(_mha_forward, backend, args.batch_size, num_steps,
+                           args.num_hiddens, args.num_heads, args.repeat)
+            for backend in ("math", "sdpa")]
+        max_diff = (t.tensor(math_out)-t.tensor(sdpa_out)).abs().max()
+        print(f"num_steps {num_steps:<5}: math {math_time*1e3:8.2f}ms {math_mem:8.1f}MB, "
+              f"sdpa {sdpa_time*1e3:8.2f}ms {sdpa_mem:8.1f}MB, max diff {max_diff:.2e}")
+
+
+def _import_pltutils():
+    # pltutils在仓库根目录下，和notebook里一样把它加到搜索路径中
+    sys.path.append(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "..", ".."))
+    import pltutils
+    return pltutils
+
+
+def _additive_forward_backward(chunk_size, batch_size, num_queries, num_kvs, num_hiddens, repeat):
+    pltutils = _import_pltutils()
+    t.manual_seed(0)
+    attention = pltutils.AdditiveAttention(
+        num_hiddens, num_hiddens, num_hiddens, 0, chunk_size)
+    queries = t.randn(batch_size, num_queries, num_hiddens, requires_grad=True)
+    keys = t.randn(batch_size, num_kvs, num_hiddens, requires_grad=True)
+    valid_lens = t.randint(1, num_kvs+1, (batch_size,))
+
+    def step():
+        attention(queries, keys, keys, valid_lens).sum().backward()
+    return timeit(step, repeat)
+
+
+def check_additive_chunks(chunk_size, batch_size, num_queries, num_kvs, num_hiddens):
+    """
+    分块和不分块的加性注意力使用同一份权重，前向的输出和键的梯度必须完全一致，
+    返回在键上求和得到的梯度(查询、W_q、w_v)的最大相对误差
+    """
+    pltutils = _import_pltutils()
+    t.manual_seed(0)
+    attentions = [pltutils.AdditiveAttention(num_hiddens, num_hiddens, num_hiddens, 0, size)
+                  for size in (None, chunk_size)]
+    attentions[1].load_state_dict(attentions[0].state_dict())
+    queries = t.randn(batch_size, num_queries, num_hiddens)
+    keys = t.randn(batch_size, num_kvs, num_hiddens)
+    valid_lens = t.randint(1, num_kvs+1, (batch_size,))
+    outputs, grads = [], []
+    for attention in attentions:
+        q, k = queries.clone().requires_grad_(), keys.clone().requires_grad_()
+        output = attention(q, k, k, valid_lens)
+        output.sum().backward()
+        outputs.append(output)
+        grads.append({"queries": q.grad, "keys": k.grad,
+                      **{name: p.grad for name, p in attention.named_parameters()}})
+    assert t.equal(*outputs)
+    assert t.equal(grads[0]["keys"], grads[1]["keys"]) and t.equal(grads[0]["W_k.weight"], grads[1]["W_k.weight"])
+    return max(((grads[0][name]-grads[1][name]).abs().max()/grads[0][name].abs().max()).item()
+               for name in ("queries", "W_q.weight", "w_v.weight"))
+
+
+def bench_additive(args):
+    """
+    加性注意力在训练(前向+反向)时的耗时和内存峰值，对比不分块和按chunk_size分块，
+    num_queries=num_kvs=num_steps，和Bahdanau解码器在训练时一次算完所有时间步的情况一样
+    """
+    for num_steps in args.seq_lens:
+        error = check_additive_chunks(args.chunk_size, 4, num_steps, num_steps, args.num_hiddens)
+        print(f"num_steps {num_steps:<5}: outputs and key gradients identical, "
+              f"max relative error of gradients summed over keys {error:.1e}")
+        line = f"num_steps {num_steps:<5}:"
+        for chunk_size in (None, args.chunk_size):
+            mem, elapsed = peak_memory_mb(_additive_forward_backward, chunk_size, args.batch_size,
+                                          num_steps, num_steps, args.num_hiddens, args.repeat,
+                                          setup=_import_pltutils)
+            line += f" chunk {str(chunk_size):<5} {elapsed*1e3:9.2f}ms {mem:8.1f}MB,"
+        print(line.rstrip(","))
+
+
+def bench_fused_qkv(args):
+    """
+    EncoderBlock推理和训练(前向+反向)的吞吐量(tokens/s)，对比打包的QKV投影和分开的三个投影，
+    两个编码器块共享同一份权重，输出和梯度必须完全一致\n
+    两种实现交替运行repeat轮，取每次调用耗时的中位数，减小机器负载波动的影响
+    """
+    num_hiddens = args.num_hiddens
+    blocks = [EncoderBlock(num_hiddens, num_hiddens, num_hiddens, num_hiddens, num_hiddens,
+                           num_hiddens, num_hiddens*2, args.num_heads, 0).to(args.device)
+              for _ in range(2)]
+    blocks[1].load_state_dict(blocks[0].state_dict())
+    blocks[1].attention.fused_qkv = True
+
+    def interleaved(fns):
+        times = [[] for _ in fns]
+        for fn in fns:
+            fn()
+        for _ in range(args.repeat):
+            for fn, ts in zip(fns, times):
+                start = time.perf_counter()
+                fn()
+                ts.append(time.perf_counter()-start)
+        return [sorted(ts)[len(ts)//2] for ts in times]
+
+    def train_step(block, X, valid_lens):
+        block.zero_grad()
+        block(X, valid_lens).sum().backward()
+
+    for num_steps in args.seq_lens:
+        X = t.randn(args.batch_size, num_steps, num_hiddens, device=args.device)
+        valid_lens = t.randint(1, num_steps+1, (args.batch_size,), device=args.device)
+        for block in blocks:
+            train_step(block, X, valid_lens)
+        assert all(t.equal(p.grad, q.grad) for p, q in zip(blocks[0].parameters(), blocks[1].parameters()))
+        train = interleaved([lambda block=block: train_step(block, X, valid_lens) for block in blocks])
+        with t.no_grad():
+            for block in blocks:
+                block.eval()
+            assert t.equal(blocks[0](X, valid_lens), blocks[1](X, valid_lens))
+            infer = interleaved([lambda block=block: block(X, valid_lens) for block in blocks])
+            for block in blocks:
+                block.train()
+        num_tokens = args.batch_size*num_steps
+        for name, (separate, fused) in (("infer", infer), ("train", train)):
+            print(f"num_steps {num_steps:<5} {name}: separate {num_tokens/separate:10.0f} tokens/s, "
+                  f"fused {num_tokens/fused:10.0f} tokens/s ({separate/fused:.2f}x)")
+
+
+def bench_kv_cache(args):
+    """
+    增量解码时每个词元的平均耗时随着已经生成的长度的变化，
+    不检查<eos>，一直解码到seq_lens中最长的长度
+    """
+    net = make_model(args.vocab_size, args.vocab_size, args.num_hiddens, args.num_layers,
+                     args.num_heads).to(args.device).eval()
+    enc_X = t.randint(0, args.vocab_size, (args.batch_size, args.num_steps), device=args.device)
+    enc_valid_len = t.full((args.batch_size,), args.num_steps, device=args.device)
+    dec_X = t.zeros((args.batch_size, 1), dtype=t.long, device=args.device)
+    step_times = []
+    with t.no_grad():
+        dec_state = net.decoder.init_state(net.encoder(enc_X, enc_valid_len), enc_valid_len)
+        for _ in range(max(args.seq_lens)):
+            start = time.perf_counter()
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            dec_X = Y.argmax(dim=2)
+            step_times.append(time.perf_counter()-start)
+    begin = 0
+    for end in sorted(args.seq_lens):
+        window = step_times[begin:end]
+        print(f"tokens {begin+1:>4}-{end:<4}: {sum(window)/len(window)*1e3:8.3f}ms/token")
+        begin = end
+
+
+def _decode_steps(net, enc_outputs, enc_valid_len, num_steps, project_once):
+    dec_X = t.zeros((enc_outputs.shape[0], 1), dtype=t.long, device=enc_outputs.device)
+    dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+    if not project_once:
+        # 去掉init_state中投影好的键和值，每一步都重新投影编码器的输出
+        dec_state[3] = [None]*len(dec_state[3])
+    outputs = []
+    for _ in range(num_steps):
+        Y, dec_state = net.decoder(dec_X, dec_state)
+        dec_X = Y.argmax(dim=2)
+        outputs.append(Y)
+    return t.cat(outputs, dim=1)
+
+
+def bench_cross_kv(args):
+    """
+    不同源序列长度下每个词元的解码耗时，对比编码器输出的键和值在init_state中只投影一次和每一步都投影，
+    两种方式的输出必须完全一致
+    """
+    net = make_model(args.vocab_size, args.vocab_size, args.num_hiddens, args.num_layers,
+                     args.num_heads).to(args.device).eval()
+    for src_len in args.seq_lens:
+        enc_X = t.randint(0, args.vocab_size, (args.batch_size, src_len), device=args.device)
+        enc_valid_len = t.randint(1, src_len+1, (args.batch_size,), device=args.device)
+        with t.no_grad():
+            # 编码器只跑一次，只统计解码的时间
+            enc_outputs = net.encoder(enc_X, enc_valid_len)
+            assert t.equal(_decode_steps(net, enc_outputs, enc_valid_len, args.num_steps, False),
+                           _decode_steps(net, enc_outputs, enc_valid_len, args.num_steps, True))
+            every_step, once = [
+                timeit(lambda: _decode_steps(net, enc_outputs, enc_valid_len, args.num_steps, project_once),
+                       args.repeat)/args.num_steps
+                for project_once in (False, True)]
+        print(f"src_len {src_len:<5}: project every step {every_step*1e3:8.3f}ms/token, "
+              f"project once {once*1e3:8.3f}ms/token ({every_step/once:.2f}x)")
+
+
+def _train_steps(capture, backend, vocab_size, batch_size, num_steps, num_hiddens, num_heads, repeat):
+    t.manual_seed(0)
+    net = make_model(vocab_size, vocab_size, num_hiddens, 2, num_heads, num_hiddens*2)
+    set_attention_backend(net, backend)
+    optimizer = t.optim.Adam(net.parameters())
+    loss = MaskedSoftmaxCELoss()
+    X = t.randint(0, vocab_size, (batch_size, num_steps))
+    Y = t.randint(0, vocab_size, (batch_size, num_steps))
+    valid_len = t.randint(1, num_steps+1, (batch_size,))
+
+    def step():
+        optimizer.zero_grad()
+        Y_hat, _ = net(X, Y, valid_len)
+        loss(Y_hat, Y, valid_len).sum().backward()
+        optimizer.step()
+    with capture_attention(net) if capture else contextlib.nullcontext():
+        elapsed = timeit(step, repeat)
+    # 一步训练结束之后仍然被注意力层引用着的注意力权重
+    retained = sum(m.attention_weights.numel()*m.attention_weights.element_size()
+                   for m in net.modules()
+                   if isinstance(m, DotProductAttention) and m.attention_weights is not None)
+    return elapsed, retained/2**20
+
+
+def bench_train_memory(args):
+    """
+    训练时的内存峰值和每一步的耗时，对比在capture_attention中训练(和以前一样一直保留注意力权重)和默认不保留，
+    retained是一步训练结束之后注意力层还引用着的注意力权重的大小
+    """
+    for num_steps in args.seq_lens:
+        results = []
+        for backend in ("math", "sdpa"):
+            for capture in (True, False):
+                mem, (elapsed, retained) = peak_memory_mb(
+                    _train_steps, capture, backend, args.vocab_size, args.batch_size, num_steps,
+                    args.num_hiddens, args.num_heads, args.repeat)
+                results.append(f"{backend}{'+capture' if capture else '':<8} "
+                               f"{elapsed*1e3:8.2f}ms peak {mem:8.1f}MB retained {retained:7.1f}MB")
+        print(f"num_steps {num_steps:<5}: " + ", ".join(results))
+
+
+def _checkpointed_train_steps(blocks, vocab_size, batch_size, num_steps, num_hiddens, num_layers, num_heads, repeat):
+    t.manual_seed(0)
+    net = make_model(vocab_size, vocab_size, num_hiddens, num_layers, num_heads, num_hiddens*2)
+    set_attention_backend(net, "sdpa")
+    set_activation_checkpointing(net, blocks)
+    loss = MaskedSoftmaxCELoss()
+    X = t.randint(0, vocab_size, (batch_size, num_steps))
+    Y = t.randint(0, vocab_size, (batch_size, num_steps))
+    valid_len = t.randint(1, num_steps+1, (batch_size,))
+
+    def step():
+        net.zero_grad()
+        t.manual_seed(1)
+        Y_hat, _ = net(X, Y, valid_len)
+        loss(Y_hat, Y, valid_len).sum().backward()
+    elapsed = timeit(step, repeat)
+    # 张量不能直接从子进程的队列传回来，转成numpy数组
+    return elapsed, [p.grad.numpy().copy() for p in net.parameters()]
+
+
+def bench_checkpointing(args):
+    """
+    训练时的内存峰值和每一步(前向+反向)的耗时，对比不做激活检查点和所有块都做检查点，
+    两种方式的梯度必须一致
+    """
+    for num_steps in args.seq_lens:
+        results, grads = [], []
+        for blocks in (None, True):
+            mem, (elapsed, grad) = peak_memory_mb(
+                _checkpointed_train_steps, blocks, args.vocab_size, args.batch_size, num_steps,
+                args.num_hiddens, args.num_layers, args.num_heads, args.repeat)
+            grads.append(grad)
+            results.append((elapsed, mem))
+        assert all(t.allclose(t.from_numpy(a), t.from_numpy(b), atol=1e-6) for a, b in zip(*grads))
+        (plain, plain_mem), (ckpt, ckpt_mem) = results
+        print(f"num_steps {num_steps:<5}: plain {plain*1e3:9.2f}ms peak {plain_mem:8.1f}MB, "
+              f"checkpoint {ckpt*1e3:9.2f}ms peak {ckpt_mem:8.1f}MB "
+              f"(time {ckpt/plain:.2f}x, memory {ckpt_mem/plain_mem:.2f}x)")
+
+
+def reference_mha(attention: MultiHeadAttention, queries, keys, values, valid_lens):
+    """
+    原来基于transpose_qkv/transpose_output和repeat_interleave的多头注意力，使用attention的权重
+    """
+    queries = transpose_qkv(attention.W_q(queries), attention.num_heads)
+    keys = transpose_qkv(attention.W_k(keys), attention.num_heads)
+    values = transpose_qkv(attention.W_v(values), attention.num_heads)
+    if valid_lens is not None:
+        valid_lens = t.repeat_interleave(valid_lens, attention.num_heads, dim=0)
+    output = attention.attention(queries, keys, values, valid_lens)
+    return attention.W_o(transpose_output(output, attention.num_heads))
+
+
+def count_allocations(fn) -> tuple[int, float]:
+    """
+    用profiler统计fn中分配内存的次数和总大小(MB)
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0
+             and not e.cpu_children]
+    return len(sizes), sum(sizes)/2**20
+
+
+def bench_allocations(args):
+    """
+    一次MultiHeadAttention前向传播中的内存分配次数，对比原来transpose_qkv的实现和现在4维视图的实现，
+    自注意力使用打包的QKV投影，编码器-解码器注意力的queries和keys长度不同
+    """
+    num_hiddens = args.num_hiddens
+    for backend in ("math", "sdpa"):
+        t.manual_seed(0)
+        attention = MultiHeadAttention(num_hiddens, num_hiddens, num_hiddens, num_hiddens,
+                                       args.num_heads, 0, backend=backend).eval()
+        X = t.randn(args.batch_size, args.num_steps, num_hiddens)
+        enc_outputs = t.randn(args.batch_size, 2*args.num_steps, num_hiddens)
+        valid_lens = t.randint(1, 2*args.num_steps+1, (args.batch_size,))
+        for name, keys in (("self", X), ("cross", enc_outputs)):
+            with t.no_grad():
+                assert t.allclose(attention(X, keys, keys, valid_lens),
+                                  reference_mha(attention, X, keys, keys, valid_lens), atol=1e-6)
+                old_count, old_mb = count_allocations(
+                    lambda: reference_mha(attention, X, keys, keys, valid_lens))
+                new_count, new_mb = count_allocations(
+                    lambda: attention(X, keys, keys, valid_lens))
+            print(f"{backend:<4} {name:<5}: transpose_qkv {old_count:3d} allocations {old_mb:7.2f}MB, "
+                  f"4-D views {new_count:3d} allocations {new_mb:7.2f}MB")
+
+
+def bench_decode(args):
+    """
+    贪心解码的吞吐量：逐句的predict_seq2seq和不同批量大小的predict_seq2seq_batch
+    """
+    vocab = make_vocab(args.vocab_size)
+    net = make_model(len(vocab), len(vocab), args.num_hiddens,
+                     args.num_layers, args.num_heads).to(args.device)
+    sentences = random_sentences(vocab, args.num_sentences, args.num_steps-1)
+    start = time.perf_counter()
+    for sentence in sentences[:args.num_single]:
+        predict_seq2seq(net, sentence, vocab, vocab,
+                        args.num_steps, args.device)
+    elapsed = time.perf_counter()-start
+    print(f"predict_seq2seq       batch 1   : {args.num_single/elapsed:10.1f} sentences/sec")
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, len(sentences), batch_size):
+            predict_seq2seq_batch(net, sentences[i:i+batch_size], vocab, vocab,
+                                  args.num_steps, args.device)
+        elapsed = time.perf_counter()-start
+        print(f"predict_seq2seq_batch batch {batch_size:<4}: {len(sentences)/elapsed:10.1f} sentences/sec")
+
+
+def bench_beam(args):
+    """
+    束搜索和贪心解码的耗时对比，两者都按照batch_sizes中的第一个批量大小分批
+    """
+    vocab = make_vocab(args.vocab_size)
+    net = make_model(len(vocab), len(vocab), args.num_hiddens,
+                     args.num_layers, args.num_heads).to(args.device)
+    sentences = random_sentences(vocab, args.num_sentences, args.num_steps-1)
+    batch_size = args.batch_sizes[0]
+    start = time.perf_counter()
+    for i in range(0, len(sentences), batch_size):
+        predict_seq2seq_batch(net, sentences[i:i+batch_size], vocab, vocab,
+                              args.num_steps, args.device)
+    greedy = time.perf_counter()-start
+    print(f"greedy          : {greedy:.3f}s")
+    for beam_size in args.beam_sizes:
+        start = time.perf_counter()
+        for i in range(0, len(sentences), batch_size):
+            beam_search(net, sentences[i:i+batch_size], vocab, vocab,
+                        args.num_steps, args.device, beam_size)
+        elapsed = time.perf_counter()-start
+        print(f"beam_size {beam_size:<6}: {elapsed:.3f}s ({elapsed/greedy:.2f}x greedy)")
+
+
+def bench_quantize(args):
+    """
+    fp32和动态int8量化的模型在同样的句子上逐句贪心解码，对比每句的延迟和BLEU\n
+    给出--checkpoint时加载训练好的模型，在训练数据的前num_single个句子对上计算BLEU；
+    否则使用随机初始化的模型和随机句子，这时BLEU以fp32的翻译作为参考，衡量量化前后的一致程度
+    """
+    if args.checkpoint:
+        net, src_vocab, tgt_vocab, sentences, references, num_steps = load_trained(
+            args.config, args.checkpoint, args.num_single)
+    else:
+        src_vocab = tgt_vocab = make_vocab(args.vocab_size)
+        net = make_model(len(src_vocab), len(tgt_vocab), args.num_hiddens,
+                         args.num_layers, args.num_heads, args.num_hiddens*4)
+        sentences = random_sentences(src_vocab, args.num_single, args.num_steps-1)
+        references, num_steps = None, args.num_steps
+    net.eval()
+    quantized = quantize_dynamic_int8(net)
+    results = {}
+    for name, model in (("fp32", net), ("int8", quantized)):
+        with t.no_grad():
+            start = time.perf_counter()
+            translations = [predict_seq2seq(model, sentence, src_vocab, tgt_vocab, num_steps, "cpu")[0]
+                            for sentence in sentences]
+            elapsed = (time.perf_counter()-start)/len(sentences)
+        results[name] = (translations, elapsed)
+    if references is None:
+        references = results["fp32"][0]
+    for name, (translations, elapsed) in results.items():
+        score = corpus_bleu([s.split(" ") for s in translations],
+                            [s.split(" ") for s in references], k=2)
+        same = sum(a == b for a, b in zip(translations, results["fp32"][0]))/len(sentences)
+        print(f"{name}: {elapsed*1e3:8.3f}ms/sentence, corpus bleu {score:.3f}, "
+              f"same as fp32 {same:.1%}")
+    print(f"speedup {results['fp32'][1]/results['int8'][1]:.2f}x")
+
+
+def bench_export(args):
+    """
+    导出成TorchScript再用torch.jit.load载入，对比逐句解码和批量解码的速度\n
+    导出的模块和原来的模型的结果是否一致由tests/test_export.py检查
+    """
+    vocab = make_vocab(args.vocab_size)
+    net = make_model(len(vocab), len(vocab), args.num_hiddens,
+                     args.num_layers, args.num_heads).eval()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "translator.pt")
+        export_translator(net, path, args.num_steps)
+        scripted = t.jit.load(path)
+    sentences = random_sentences(vocab, args.num_sentences, args.num_steps-1)
+    bos, eos = vocab["<bos>"], vocab["<eos>"]
+    with t.no_grad():
+        def translate_scripted(batch):
+            enc_X, enc_valid_len = build_src_batch(batch, vocab, args.num_steps, "cpu")
+            return [_to_tokens(row, eos) for row in
+                    scripted.translate(enc_X, enc_valid_len, bos, eos, args.num_steps).tolist()]
+        for batch_size in (1, args.batch_size):
+            batches = [sentences[i:i+batch_size] for i in range(0, args.num_single, batch_size)]
+            eager_time = timeit(lambda: [predict_seq2seq_batch(net, batch, vocab, vocab, args.num_steps, "cpu")
+                                         for batch in batches], 1)
+            scripted_time = timeit(lambda: [translate_scripted(batch) for batch in batches], 1)
+            print(f"batch {batch_size:<4}: eager {eager_time/args.num_single*1e3:8.3f}ms/sentence, "
+                  f"torchscript {scripted_time/args.num_single*1e3:8.3f}ms/sentence "
+                  f"({eager_time/scripted_time:.2f}x)")
+
+
+async def _load_test(net, vocab, sentences, num_steps, max_batch_size, max_delay_ms, concurrency):
+    """
+    在本机启动翻译服务，concurrency个客户端各自用一个长连接依次发送请求，
+    返回客户端看到的延迟列表、总耗时和服务端的/metrics
+    """
+    batcher = MicroBatcher(net, vocab, vocab, num_steps, "cpu", max_batch_size, max_delay_ms)
+    server = await serve(batcher, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def request(reader, writer, method, path, payload=None):
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1")+body)
+        await writer.drain()
+        headers = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        assert headers.startswith("HTTP/1.1 200"), headers
+        length = int(headers.lower().split("content-length:")[1].split("\r\n")[0])
+        return json.loads(await reader.readexactly(length))
+
+    async def client(texts):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        result = []
+        for text in texts:
+            start = time.perf_counter()
+            await request(reader, writer, "POST", "/translate", {"text": text})
+            result.append(time.perf_counter()-start)
+        writer.close()
+        await writer.wait_closed()
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client(sentences[i::concurrency]) for i in range(concurrency)])
+    elapsed = time.perf_counter()-start
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    metrics = await request(reader, writer, "GET", "/metrics")
+    writer.close()
+    await writer.wait_closed()
+    # 等服务端的连接处理协程读到连接关闭
+    await asyncio.sleep(0.01)
+    server.close()
+    server.batcher_task.cancel()
+    return [latency for result in results for latency in result], elapsed, metrics
+
+
+def bench_server(args):
+    """
+    本机压测翻译服务，对比每个请求单独解码(max_batch_size=1)和攒小批量解码的吞吐量和延迟
+    """
+    vocab = make_vocab(args.vocab_size)
+    net = make_model(len(vocab), len(vocab), args.num_hiddens,
+                     args.num_layers, args.num_heads).eval()
+    sentences = random_sentences(vocab, args.num_single, args.num_steps-1)
+    for concurrency in args.batch_sizes:
+        for max_batch_size, max_delay_ms in ((1, 0.), (args.batch_size, args.max_delay_ms)):
+            latencies, elapsed, metrics = asyncio.run(_load_test(
+                net, vocab, sentences, args.num_steps, max_batch_size, max_delay_ms, concurrency))
+            print(f"clients {concurrency:<4} max_batch {max_batch_size:<4} delay {max_delay_ms:4.1f}ms: "
+                  f"{len(sentences)/elapsed:8.1f} req/s, p50 {percentile(latencies, 50)*1e3:7.2f}ms, "
+                  f"p99 {percentile(latencies, 99)*1e3:7.2f}ms, batch sizes {metrics['batch_size_histogram']}")
+
+
+def _to_tokens(pred: list, eos: int) -> list:
+    # 截掉<eos>之后的部分
+    return pred[:pred.index(eos)] if eos in pred else pred
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "beam": bench_beam,
+    "attention": bench_attention,
+    "sdpa": bench_sdpa,
+    "additive": bench_additive,
+    "fused_qkv": bench_fused_qkv,
+    "kv_cache": bench_kv_cache,
+    "cross_kv": bench_cross_kv,
+    "train_memory": bench_train_memory,
+    "allocations": bench_allocations,
+    "checkpointing": bench_checkpointing,
+    "quantize": bench_quantize,
+    "export": bench_export,
+    "server": bench_server,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=BENCHMARKS)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--vocab_size", type=int, default=200)
+    parser.add_argument("--num_hiddens", type=int, default=32)
+    parser.add_argument("--num_layers", type=int, default=2)
+    parser.add_argument("--num_heads", type=int, default=4)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--num_sentences", type=int, default=10000)
+    parser.add_argument("--num_single", type=int, default=200,
+                        help="逐句解码太慢，只测这么多句")
+    parser.add_argument("--batch_sizes", type=int, nargs="+",
+                        default=[1, 16, 64, 256, 1024])
+    parser.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--seq_lens", type=int, nargs="+",
+                        default=[10, 50, 100, 200, 400])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--chunk_size", type=int, default=32)
+    parser.add_argument("--max_delay_ms", type=float, default=5.)
+    parser.add_argument("--config", default="./Attention/TransformerFullVersion/config.yaml")
+    parser.add_argument("--checkpoint", default=None,
+                        help="main.py保存的断点，quantize用它加载训练好的模型")
+    args = parser.parse_args()
+    args.device = t.device(args.device)
+    t.manual_seed(0)
+    random.seed(0)
+    BENCHMARKS[args.name](args)
@@ -0,0 +1,137 @@
+"""
+训练断点的保存和恢复
+
+快照先在训练线程里复制到CPU上，然后交给后台线程序列化写盘，训练不用等待写文件。
+文件先写到临时文件再重命名，中途被打断也不会留下写了一半的断点，
+只保留最近的keep个断点。
+"""
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch as t
+
+CHECKPOINT_PATTERN = re.compile(r"checkpoint-(\d+)\.pt")
+
+
+def get_rng_state():
+    """
+    收集所有随机数生成器的状态
+    """
+    state = {
+        "torch": t.get_rng_state(),
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+    if t.cuda.is_available():
+        state["cuda"] = t.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    恢复get_rng_state收集的随机数生成器状态
+    """
+    t.set_rng_state(state["torch"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    if "cuda" in state and t.cuda.is_available():
+        t.cuda.set_rng_state_all(state["cuda"])
+
+
+def to_cpu(obj):
+    """
+    把嵌套的dict/list/tuple中的张量都复制一份到CPU上，
+    复制出来的张量不再和训练中的参数共享内存，后台线程可以放心序列化
+    """
+    if isinstance(obj, t.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager:
+    """
+    管理一个目录中的断点文件checkpoint-{step}.pt\n
+    save在当前线程复制快照，在后台线程写盘，同一时刻最多只有一个快照在写\n
+    directory: 断点目录\n
+    keep: 保留最近的几个断点，至少为1
+    """
+
+    def __init__(self, directory: str, keep: int = 3) -> None:
+        # keep=0时self.checkpoints()[:-0]是空列表，一个断点都不会删除
+        if keep < 1:
+            raise ValueError(f"keep must be at least 1, got {keep}")
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        # 上次被打断时留下的临时文件
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def checkpoints(self):
+        """
+        按步数从小到大返回目录中所有完整的断点文件
+        """
+        found = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.fullmatch(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return [path for _, path in sorted(found)]
+
+    def latest(self):
+        """
+        最新的断点文件，没有断点时返回None
+        """
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, state, step: int):
+        """
+        异步保存快照，返回断点文件的路径\n
+        state: 可以包含张量的嵌套dict，比如模型和优化器的state_dict
+        """
+        snapshot = to_cpu(state)
+        # 上一个快照还没写完就先等它，避免内存中堆积多份快照，同时把写盘的异常抛出来
+        self.wait()
+        path = os.path.join(self.directory, f"checkpoint-{step:08d}.pt")
+        self._pending = self._executor.submit(self._write, snapshot, path)
+        return path
+
+    def _write(self, snapshot, path):
+        tmp_path = path+".tmp"
+        with open(tmp_path, "wb") as f:
+            t.save(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # 重命名是原子操作，目录中要么是旧的断点要么是完整的新断点
+        os.replace(tmp_path, path)
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        """
+        等待正在写的快照写完
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+def load_checkpoint(path: str):
+    """
+    读取断点，张量都在CPU上，load_state_dict时会复制到参数所在的设备
+    """
+    return t.load(path, map_location="cpu", weights_only=False)
@@ -1,14 +1,25 @@
 # %%
 import collections
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import numpy as np
 import torch as t
+from torch import Tensor
 from torch.utils import data
 
+DATA_PATH = "dataset/fra-eng/fra.txt"
+RESERVED_TOKENS = ["<pad>", "<bos>", "<eos>"]
+CACHE_ARRAYS = ("src_array", "src_valid_len", "tgt_array", "tgt_valid_len")
+
 
 def read_data_nmt():
     """
     载入英语-法语数据集
     """
-    with open("dataset/fra-eng/fra.txt", "r", encoding="utf-8") as f:
+    with open(DATA_PATH, "r", encoding="utf-8") as f:
         return f.read()
 
 
@@ -116,20 +127,48 @@ def truncate_pad(line, num_steps, padding_token):
     return line + [padding_token]*(num_steps-len(line))
 
 
-def build_array_nmt(lines, vocab: Vocab, num_steps):
+def flatten_lines(lines, vocab: Vocab):
     """
-    将机器翻译的文本序列转换成小批量
+    把所有文本序列的词元下标拼接成一个一维张量，每个序列末尾追加<eos>\n
+    offsets[i]:offsets[i+1] 就是第i个序列在flat_ids中的位置
     """
-    lines = [vocab[l] for l in lines]
-    lines = [l+[vocab["<eos>"]] for l in lines]
+    get, unk, eos = vocab.token_to_idx.get, vocab.unk, vocab["<eos>"]
+    flat_ids, offsets = [], [0]
+    for l in lines:
+        flat_ids.extend([get(token, unk) for token in l])
+        flat_ids.append(eos)
+        offsets.append(len(flat_ids))
+    return t.tensor(flat_ids, dtype=t.long), t.tensor(offsets, dtype=t.long)
 
-    array = t.tensor([truncate_pad(l, num_steps, vocab["<pad>"])
-                     for l in lines])
-    valid_len = (array != vocab["<pad>"]).type(t.int32)
-    valid_len = valid_len.sum(1)
+
+def pad_from_offsets(flat_ids: Tensor, offsets: Tensor, num_steps: int, padding_token: int):
+    """
+    truncate_pad的批量版本，一次性将拼接好的下标散射到预先分配的(num_lines, num_steps)张量中\n
+    有效长度直接由offsets计算，不再和<pad>比较，所以序列中本身出现<pad>也不会算错
+    """
+    lengths = offsets[1:] - offsets[:-1]
+    num_lines = lengths.shape[0]
+    # 每个词元在输出张量中的行号和列号
+    rows = t.repeat_interleave(t.arange(num_lines), lengths)
+    cols = t.arange(flat_ids.shape[0]) - \
+        t.repeat_interleave(offsets[:-1], lengths)
+    # 列号超出num_steps的词元被截断
+    keep = cols < num_steps
+    array = t.full((num_lines, num_steps), padding_token, dtype=t.long)
+    array[rows[keep], cols[keep]] = flat_ids[keep]
+    # 原来的(array != pad).type(t.int32).sum(1)在求和时会提升成int64，这里保持int64
+    valid_len = lengths.clamp(max=num_steps).to(t.int64)
     return array, valid_len
 
 
+def build_array_nmt(lines, vocab: Vocab, num_steps):
+    """
+    将机器翻译的文本序列转换成小批量
+    """
+    flat_ids, offsets = flatten_lines(lines, vocab)
+    return pad_from_offsets(flat_ids, offsets, num_steps, vocab["<pad>"])
+
+
 def load_array(data_arrays, batch_size, is_train=True):
     """构造一个PyTorch数据迭代器
     Defined in :numref:`sec_linear_concise`"""
@@ -137,22 +176,161 @@ def load_array(data_arrays, batch_size, is_train=True):
     return data.DataLoader(dataset, batch_size, shuffle=is_train)
 
 
-def load_data_nmt(batch_size, num_steps, num_examples=600):
+class BucketBatchSampler(data.Sampler):
+    """
+    按长度分桶的批量采样器，把长度相近的句子放到同一个批量里面\n
+    每个批量满足 批量大小*批量内最长句子长度 <= max_tokens，句子长度取源语言和目标语言中较长的那个\n
+    每个epoch会打乱等长句子的顺序和批量之间的顺序，padding_ratio记录当前epoch中填充词元所占的比例
+    """
+
+    def __init__(self, src_valid_len: Tensor, tgt_valid_len: Tensor, max_tokens: int, shuffle=True) -> None:
+        self.src_valid_len = src_valid_len.tolist()
+        self.tgt_valid_len = tgt_valid_len.tolist()
+        self.lengths = t.maximum(src_valid_len, tgt_valid_len)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        n = self.lengths.shape[0]
+        perm = t.randperm(n) if self.shuffle else t.arange(n)
+        # 稳定排序，长度相同的句子保持打乱之后的顺序
+        order = perm[t.sort(self.lengths[perm], stable=True)[1]].tolist()
+        lengths = self.lengths.tolist()
+        batches, batch = [], []
+        for idx in order:
+            # 已经按长度升序排列，所以新加入的句子就是批量内最长的
+            if batch and lengths[idx]*(len(batch)+1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in t.randperm(len(batches)).tolist()]
+        # 统计填充比例
+        num_padded, num_valid = 0, 0
+        for batch in batches:
+            src = [self.src_valid_len[i] for i in batch]
+            tgt = [self.tgt_valid_len[i] for i in batch]
+            num_padded += len(batch)*(max(src)+max(tgt))
+            num_valid += sum(src)+sum(tgt)
+        self.padding_ratio = 1-num_valid/num_padded if num_padded else 0.
+        return batches
+
+    def __iter__(self):
+        if self.shuffle:
+            self.batches = self._make_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def trim_collate(batch):
+    """
+    将样本堆叠成批量，只保留到批量内最长的有效长度
+    """
+    X, X_valid_len, Y, Y_valid_len = [t.stack(x) for x in zip(*batch)]
+    return X[:, :X_valid_len.max()], X_valid_len, Y[:, :Y_valid_len.max()], Y_valid_len
+
+
+def load_bucketed_array(data_arrays, max_tokens, is_train=True):
+    """
+    构造按长度分桶的数据迭代器，data_arrays是(src_array, src_valid_len, tgt_array, tgt_valid_len)
     """
-    返回翻译数据集的迭代器和词表
+    dataset = data.TensorDataset(*data_arrays)
+    sampler = BucketBatchSampler(
+        data_arrays[1], data_arrays[3], max_tokens, shuffle=is_train)
+    return data.DataLoader(dataset, batch_sampler=sampler, collate_fn=trim_collate)
+
+
+def build_data_nmt(num_steps, num_examples=600, min_freq=2):
+    """
+    读取、预处理、词元化数据集并构建词表，返回(src_array, src_valid_len, tgt_array, tgt_valid_len)和两个词表
     """
     raw_data = read_data_nmt()
     text = preprocess_nmt(raw_data)
     source, target = tokenize_nmt(text, num_examples)
 
-    src_vocab = Vocab(source, 2, ["<pad>", "<bos>", "<eos>"])
-    tgt_vocab = Vocab(target, 2, ["<pad>", "<bos>", "<eos>"])
+    src_vocab = Vocab(source, min_freq, RESERVED_TOKENS)
+    tgt_vocab = Vocab(target, min_freq, RESERVED_TOKENS)
 
     src_array, src_valid_len = build_array_nmt(source, src_vocab, num_steps)
     tgt_array, tgt_valid_len = build_array_nmt(target, tgt_vocab, num_steps)
 
     data_arrays = (src_array, src_valid_len, tgt_array, tgt_valid_len)
-    data_iter = load_array(data_arrays, batch_size)
+    return data_arrays, src_vocab, tgt_vocab
+
+
+def nmt_cache_key(num_steps, num_examples, min_freq, reserved_tokens=RESERVED_TOKENS):
+    """
+    缓存的键：数据文件内容和预处理参数的哈希值，任何一项改变都会得到新的缓存
+    """
+    h = hashlib.sha1()
+    with open(DATA_PATH, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    config = [num_steps, num_examples, min_freq, list(reserved_tokens)]
+    h.update(json.dumps(config).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def save_nmt_cache(path: str, data_arrays, src_vocab: Vocab, tgt_vocab: Vocab):
+    """
+    把处理好的数组保存成.npy，词表用pickle保存\n
+    先写到临时目录再重命名，中途被打断也不会留下不完整的缓存
+    """
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in zip(CACHE_ARRAYS, data_arrays):
+        np.save(os.path.join(tmp, name+".npy"), array.numpy())
+    with open(os.path.join(tmp, "vocab.pkl"), "wb") as f:
+        pickle.dump((src_vocab, tgt_vocab), f, pickle.HIGHEST_PROTOCOL)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # 其它进程已经写好了同样的缓存
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_nmt_cache(path: str):
+    """
+    以内存映射的方式打开缓存的数组，并载入词表
+    """
+    # mmap_mode="c" 是写时复制，得到的数组可写，可以直接转成Tensor
+    data_arrays = tuple(t.from_numpy(np.load(os.path.join(path, name+".npy"), mmap_mode="c"))
+                        for name in CACHE_ARRAYS)
+    with open(os.path.join(path, "vocab.pkl"), "rb") as f:
+        src_vocab, tgt_vocab = pickle.load(f)
+    return data_arrays, src_vocab, tgt_vocab
+
+
+def load_data_nmt(batch_size, num_steps, num_examples=600, max_tokens=None, min_freq=2, cache_dir=None):
+    """
+    返回翻译数据集的迭代器和词表\n
+    如果给定了max_tokens，就使用按长度分桶的迭代器，此时batch_size不起作用，
+    填充比例可以从data_iter.batch_sampler.padding_ratio获取\n
+    如果给定了cache_dir，处理好的数据会缓存到磁盘上，数据配置相同的运行直接读取缓存
+    """
+    if cache_dir:
+        path = os.path.join(cache_dir, nmt_cache_key(
+            num_steps, num_examples, min_freq))
+        if os.path.isdir(path):
+            data_arrays, src_vocab, tgt_vocab = load_nmt_cache(path)
+        else:
+            data_arrays, src_vocab, tgt_vocab = build_data_nmt(
+                num_steps, num_examples, min_freq)
+            os.makedirs(cache_dir, exist_ok=True)
+            save_nmt_cache(path, data_arrays, src_vocab, tgt_vocab)
+    else:
+        data_arrays, src_vocab, tgt_vocab = build_data_nmt(
+            num_steps, num_examples, min_freq)
+
+    if max_tokens:
+        data_iter = load_bucketed_array(data_arrays, max_tokens)
+    else:
+        data_iter = load_array(data_arrays, batch_size)
     return data_iter, src_vocab, tgt_vocab
 
 
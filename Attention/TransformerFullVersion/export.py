@@ -0,0 +1,193 @@
+"""
+把训练好的EncoderDecoder导出成TorchScript，部署的时候只需要torch.jit.load，不需要导入本仓库的代码\n
+导出的模块有三个方法：
+    cache = m.encode(src, valid_len)
+    logits, cache = m.decode_step(tokens, cache)
+    tokens = m.translate(src, valid_len, bos, eos, num_steps)
+cache是Dict[str, Tensor]，只包含张量：
+    memory_k, memory_v: 每一层编码器-解码器注意力投影好的键和值，(num_layers, batch_size, num_heads, src_len, head_dim)
+    memory_mask: 源序列的填充遮蔽，(batch_size, 1, 1, src_len)，True表示遮蔽
+    self_k, self_v: 每一层解码器自注意力预先分配的键值缓存，(num_layers, batch_size, num_heads, max_len, head_dim)
+    length: 已经解码的词元数，0维的long张量
+decode_step原地把新位置的键和值写进self_k/self_v，返回的cache和传入的cache共用这两块缓存，
+只有length是新的张量。同一个cache只能沿着一条路径往下解码，要从同一个前缀分叉(例如束搜索)，
+先对self_k/self_v调用clone()
+用法(在仓库根目录下运行):
+    python Attention/TransformerFullVersion/export.py checkpoint.pt translator.pt
+"""
+import math
+import sys
+from typing import Dict, Tuple
+import torch as t
+from torch import Tensor
+import torch.nn as nn
+import torch.nn.functional as F
+from model import EncoderDecoder, MultiHeadAttention, EncoderBlock, DecoderBlock
+from loading import load_trained
+
+
+class ScriptableAttention(nn.Module):
+    """
+    MultiHeadAttention的推理版本，共享原来的线性层，只用TorchScript支持的操作
+    """
+
+    def __init__(self, attention: MultiHeadAttention) -> None:
+        super().__init__()
+        self.num_heads = attention.num_heads
+        self.W_q, self.W_k, self.W_v, self.W_o = attention.W_q, attention.W_k, attention.W_v, attention.W_o
+
+    def split_heads(self, X: Tensor) -> Tensor:
+        # (batch_size, num_steps, num_hiddens) -> (batch_size, num_heads, num_steps, head_dim)
+        return X.view(X.shape[0], X.shape[1], self.num_heads, -1).transpose(1, 2)
+
+    def project_kv(self, X: Tensor) -> Tuple[Tensor, Tensor]:
+        return self.split_heads(self.W_k(X)), self.split_heads(self.W_v(X))
+
+    def attend(self, queries: Tensor, keys: Tensor, values: Tensor, mask: Tensor) -> Tensor:
+        """
+        queries是没有投影的输入，keys和values是project_kv的结果，mask中True表示遮蔽，可以广播
+        """
+        Q = self.split_heads(self.W_q(queries))
+        scores = t.matmul(Q, keys.transpose(-1, -2)).div_(math.sqrt(Q.shape[-1]))
+        scores = scores.masked_fill(mask, -1e6)
+        output = t.matmul(F.softmax(scores, dim=-1), values)
+        return self.W_o(output.transpose(1, 2).flatten(2))
+
+
+class ScriptableEncoderLayer(nn.Module):
+    def __init__(self, blk: EncoderBlock) -> None:
+        super().__init__()
+        self.attention = ScriptableAttention(blk.attention)
+        self.ln1, self.ln2 = blk.addnorm1.ln, blk.addnorm2.ln
+        self.dense1, self.dense2 = blk.ffn.dense1, blk.ffn.dense2
+
+    def forward(self, X: Tensor, mask: Tensor) -> Tensor:
+        keys, values = self.attention.project_kv(X)
+        Y = self.ln1(X+self.attention.attend(X, keys, values, mask))
+        return self.ln2(Y+self.dense2(F.relu(self.dense1(Y))))
+
+
+class ScriptableDecoderLayer(nn.Module):
+    def __init__(self, blk: DecoderBlock) -> None:
+        super().__init__()
+        self.self_attention = ScriptableAttention(blk.attention1)
+        self.cross_attention = ScriptableAttention(blk.attention2)
+        self.ln1, self.ln2, self.ln3 = blk.addnorm1.ln, blk.addnorm2.ln, blk.addnorm3.ln
+        self.dense1, self.dense2 = blk.ffn.dense1, blk.ffn.dense2
+
+    def forward(self, X: Tensor, self_k: Tensor, self_v: Tensor, memory_k: Tensor, memory_v: Tensor,
+                memory_mask: Tensor, length: int) -> Tensor:
+        """
+        X.shape = (batch_size, 1, num_hiddens)，self_k和self_v是这一层的缓存，原地写入新位置的键和值
+        """
+        keys, values = self.self_attention.project_kv(X)
+        self_k[:, :, length:length+1] = keys
+        self_v[:, :, length:length+1] = values
+        # 缓存中只有已经解码的位置，不需要遮蔽
+        no_mask = t.zeros((1, 1, 1, 1), dtype=t.bool, device=X.device)
+        Y = self.ln1(X+self.self_attention.attend(
+            X, self_k[:, :, :length+1], self_v[:, :, :length+1], no_mask))
+        Z = self.ln2(Y+self.cross_attention.attend(Y, memory_k, memory_v, memory_mask))
+        return self.ln3(Z+self.dense2(F.relu(self.dense1(Z))))
+
+
+class ScriptableTranslator(nn.Module):
+    """
+    可以用torch.jit.script导出的EncoderDecoder推理模块，和原来的模型共享参数\n
+    max_len: 最多能解码的词元数，自注意力的缓存按这个长度预先分配
+    """
+
+    def __init__(self, net: EncoderDecoder, max_len: int) -> None:
+        super().__init__()
+        encoder, decoder = net.encoder, net.decoder
+        self.num_hiddens = encoder.num_hiddens
+        self.max_len = max_len
+        self.src_embedding, self.tgt_embedding = encoder.embedding, decoder.embedding
+        self.encoder_layers = nn.ModuleList([ScriptableEncoderLayer(blk) for blk in encoder.blks])
+        self.decoder_layers = nn.ModuleList([ScriptableDecoderLayer(blk) for blk in decoder.blks])
+        self.dense = decoder.dense
+        # 位置编码表在导出的时候算好，源序列和目标序列都不能超过这个长度
+        self.register_buffer("positions", decoder.pos_encoding._encoding(
+            max(max_len, decoder.pos_encoding.max_len), "cpu")[0])
+
+    @t.jit.export
+    def encode(self, src: Tensor, valid_len: Tensor) -> Dict[str, Tensor]:
+        """
+        src.shape = (batch_size, src_len)，valid_len.shape = (batch_size,)，返回初始的cache
+        """
+        X = self.src_embedding(src)*math.sqrt(self.num_hiddens)+self.positions[:src.shape[1]]
+        mask = t.arange(src.shape[1], device=src.device) >= valid_len.unsqueeze(-1)
+        mask = mask[:, None, None, :]
+        for layer in self.encoder_layers:
+            X = layer(X, mask)
+        memory_k, memory_v = [], []
+        for layer in self.decoder_layers:
+            keys, values = layer.cross_attention.project_kv(X)
+            memory_k.append(keys)
+            memory_v.append(values)
+        keys = t.stack(memory_k)
+        shape = (keys.shape[0], keys.shape[1], keys.shape[2], self.max_len, keys.shape[4])
+        return {
+            "memory_k": keys, "memory_v": t.stack(memory_v), "memory_mask": mask,
+            "self_k": t.zeros(shape, dtype=X.dtype, device=X.device),
+            "self_v": t.zeros(shape, dtype=X.dtype, device=X.device),
+            "length": t.zeros((), dtype=t.long),
+        }
+
+    @t.jit.export
+    def decode_step(self, tokens: Tensor, cache: Dict[str, Tensor]) -> Tuple[Tensor, Dict[str, Tensor]]:
+        """
+        tokens.shape = (batch_size, 1)，返回这一步的logits (batch_size, vocab_size)和更新之后的cache\n
+        self_k/self_v在原地更新，不会拷贝，传入的cache和返回的cache共用它们
+        """
+        length = int(cache["length"].item())
+        if length >= self.max_len:
+            raise RuntimeError("decode_step: exceeded max_len")
+        X = self.tgt_embedding(tokens)*math.sqrt(self.num_hiddens)+self.positions[length:length+1]
+        self_k, self_v = cache["self_k"], cache["self_v"]
+        memory_k, memory_v = cache["memory_k"], cache["memory_v"]
+        for i, layer in enumerate(self.decoder_layers):
+            X = layer(X, self_k[i], self_v[i], memory_k[i], memory_v[i], cache["memory_mask"], length)
+        # 浅拷贝：只替换length，self_k/self_v等张量和传入的cache是同一个对象
+        new_cache = dict(cache)
+        new_cache["length"] = cache["length"]+1
+        return self.dense(X[:, 0]), new_cache
+
+    @t.jit.export
+    def translate(self, src: Tensor, valid_len: Tensor, bos: int, eos: int, num_steps: int) -> Tensor:
+        """
+        贪心解码，所有句子都预测出eos或者解码了num_steps步就停止，整个循环都在TorchScript里面运行\n
+        返回(batch_size, 解码的步数)的词元下标，eos之后的词元由调用者截掉
+        """
+        cache = self.encode(src, valid_len)
+        tokens = t.full((src.shape[0], 1), bos, dtype=t.long, device=src.device)
+        finished = t.zeros(src.shape[0], dtype=t.bool, device=src.device)
+        outputs = []
+        for _ in range(num_steps):
+            logits, cache = self.decode_step(tokens, cache)
+            tokens = logits.argmax(dim=-1, keepdim=True)
+            outputs.append(tokens)
+            finished = finished | (tokens[:, 0] == eos)
+            if bool(finished.all()):
+                break
+        return t.cat(outputs, dim=1)
+
+    def forward(self, src: Tensor, valid_len: Tensor) -> Dict[str, Tensor]:
+        return self.encode(src, valid_len)
+
+
+def export_translator(net: EncoderDecoder, path: str, max_len: int = 100):
+    """
+    把net导出成TorchScript文件，返回导出的ScriptModule
+    """
+    net.eval()
+    scripted = t.jit.script(ScriptableTranslator(net, max_len).eval())
+    scripted.save(path)
+    return scripted
+
+
+if __name__ == "__main__":
+    # 模型结构和词表都按照config.yaml重新构造，然后加载main.py保存的断点
+    net, _, _, _, _, num_steps = load_trained(
+        "./Attention/TransformerFullVersion/config.yaml", sys.argv[1], 0)
+    export_translator(net, sys.argv[2], num_steps)
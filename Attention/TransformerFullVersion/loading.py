@@ -0,0 +1,66 @@
+"""
+按照config.yaml构造模型、加载main.py保存的断点，export.py、server.py和benchmark.py共用
+"""
+import yaml
+from datasets import Vocab, RESERVED_TOKENS, load_data_nmt
+from model import TransformerEncoder, TransformerDecoder, EncoderDecoder, set_attention_backend
+from utils import xavier_init_weights
+from checkpoint import load_checkpoint
+
+
+def make_vocab(vocab_size: int) -> Vocab:
+    """
+    构造一个有vocab_size个普通词元的词表
+    """
+    return Vocab([[f"w{i}" for i in range(vocab_size)]], 0, RESERVED_TOKENS)
+
+
+def make_model(src_vocab_size, tgt_vocab_size, num_hiddens=32, num_layers=2,
+               num_heads=4, ffn_num_hiddens=64, dropout=0.1) -> EncoderDecoder:
+    """
+    按照config.yaml的结构构造一个随机初始化的模型
+    """
+    encoder = TransformerEncoder(
+        src_vocab_size, num_hiddens, num_hiddens, num_hiddens, num_hiddens,
+        [num_hiddens], num_hiddens, ffn_num_hiddens, num_heads,
+        num_layers, dropout,
+    )
+    decoder = TransformerDecoder(
+        tgt_vocab_size, num_hiddens, num_hiddens, num_hiddens, num_hiddens,
+        [num_hiddens], num_hiddens, ffn_num_hiddens, num_heads,
+        num_layers, dropout,
+    )
+    net = EncoderDecoder(encoder, decoder)
+    net.apply(xavier_init_weights)
+    return net
+
+
+def load_trained(config_path: str, checkpoint_path: str, num_pairs: int = 0):
+    """
+    按照config.yaml构造模型并加载main.py保存的断点，
+    返回模型、词表和训练数据中的前num_pairs个句子对
+    """
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = yaml.load(f, yaml.FullLoader)
+    data_iter, src_vocab, tgt_vocab = load_data_nmt(
+        config["batch_size"], config["num_steps"], cache_dir=config.get("data_cache_dir"))
+    encoder = TransformerEncoder(
+        len(src_vocab), config["key_size"], config["query_size"], config["value_size"], config["num_hiddens"],
+        config["norm_shape"], config["ffn_num_input"], config["ffn_num_hiddens"], config["num_heads"],
+        config["num_layers"], config["dropout"],
+    )
+    decoder = TransformerDecoder(
+        len(tgt_vocab), config["key_size"], config["query_size"], config["value_size"], config["num_hiddens"],
+        config["norm_shape"], config["ffn_num_input"], config["ffn_num_hiddens"], config["num_heads"],
+        config["num_layers"], config["dropout"],
+    )
+    net = EncoderDecoder(encoder, decoder)
+    set_attention_backend(net, config.get("attention_backend", "math"))
+    net.load_state_dict(load_checkpoint(checkpoint_path)["model"])
+    src_array, src_valid_len, tgt_array, tgt_valid_len = data_iter.dataset.tensors
+    # 有效长度包含了<eos>
+    srcs = [" ".join(src_vocab.to_tokens(row[:n-1].tolist()))
+            for row, n in zip(src_array[:num_pairs], src_valid_len[:num_pairs].tolist())]
+    tgts = [" ".join(tgt_vocab.to_tokens(row[:n-1].tolist()))
+            for row, n in zip(tgt_array[:num_pairs], tgt_valid_len[:num_pairs].tolist())]
+    return net, src_vocab, tgt_vocab, srcs, tgts, config["num_steps"]
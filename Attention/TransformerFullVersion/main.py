@@ -1,11 +1,17 @@
 from tensorboardX import SummaryWriter
 from datasets import load_data_nmt
-from model import TransformerEncoder, TransformerDecoder, EncoderDecoder
+from model import TransformerEncoder, TransformerDecoder, EncoderDecoder, set_attention_backend, set_activation_checkpointing
+from checkpoint import CheckpointManager, load_checkpoint, get_rng_state, set_rng_state
 import yaml
 import torch as t
 from utils import *
 
 
+# 这些配置决定模型结构和训练数据，和断点中保存的不同时不能恢复
+RESUME_KEYS = ["num_hiddens", "num_layers", "batch_size", "num_steps", "ffn_num_input", "ffn_num_hiddens",
+               "num_heads", "key_size", "query_size", "value_size", "norm_shape", "max_tokens"]
+
+
 if __name__ == "__main__":
     # Hyper Parameterss
     with open("./Attention/TransformerFullVersion/config.yaml", "r", encoding="utf-8") as f:
@@ -20,7 +26,13 @@ if __name__ == "__main__":
     key_size, query_size, value_size = config["key_size"], config["query_size"], config["value_size"]
     norm_shape = config["norm_shape"]
     # Prepare Train Data
-    train_iter, src_vocab, tgt_vocab = load_data_nmt(batch_size, num_steps)
+    # 设置了max_tokens就按长度分桶，每个批量只填充到批量内最长的句子
+    max_tokens = config.get("max_tokens")
+    # 处理好的数据缓存在data_cache_dir中，数据配置相同的运行直接读取缓存
+    train_iter, src_vocab, tgt_vocab = load_data_nmt(
+        batch_size, num_steps, max_tokens=max_tokens, cache_dir=config.get("data_cache_dir"))
+    if max_tokens:
+        print(f"padding ratio {train_iter.batch_sampler.padding_ratio:.3f}")
     # Construct Model
     encoder = TransformerEncoder(
         len(src_vocab), key_size, query_size, value_size, num_hiddens,
@@ -34,14 +46,51 @@ if __name__ == "__main__":
     )
 
     net = EncoderDecoder(encoder, decoder)
+    # sdpa后端在不需要注意力权重的时候使用融合的注意力算子
+    set_attention_backend(net, config.get("attention_backend", "math"))
+    # 选中的块在反向传播时重算激活，用时间换内存，可以是true或者块的下标列表
+    set_activation_checkpointing(net, config.get("activation_checkpointing"))
     net.train()
     net.apply(xavier_init_weights)
     net.to(device)
     optimizer = t.optim.Adam(net.parameters(), lr=lr)
     loss = MaskedSoftmaxCELoss()
+    # 每checkpoint_every步保存一次断点，resume为true时从最新的断点继续训练，也可以直接填断点文件的路径
+    checkpoint_dir = config.get("checkpoint_dir")
+    manager = CheckpointManager(checkpoint_dir, config.get("checkpoint_keep", 3)) if checkpoint_dir else None
+    checkpoint_every = config.get("checkpoint_every", 0)
+    resume = config.get("resume")
+    if resume is True and manager is None:
+        raise ValueError("resume: true needs checkpoint_dir, or set resume to a checkpoint path")
+    start_epoch, start_batch, step, snapshot = 0, 0, 0, None
+    if resume:
+        path = manager.latest() if resume is True else resume
+        if path:
+            snapshot = load_checkpoint(path)
+            # 模型结构和数据配置不同的断点不能接着训练
+            changed = [k for k in RESUME_KEYS if snapshot["config"].get(k) != config.get(k)]
+            if changed:
+                raise ValueError(f"checkpoint {path} was saved with a different config: {changed}")
+            net.load_state_dict(snapshot["model"])
+            optimizer.load_state_dict(snapshot["optimizer"])
+            start_epoch, start_batch, step = snapshot["epoch"], snapshot["batch"], snapshot["step"]
+            print(f"resume from {path}, epoch {start_epoch} batch {start_batch}")
     # Start Training
-    for epoch in range(num_epochs):
-        for batch in train_iter:
+    l = None
+    for epoch in range(start_epoch, num_epochs):
+        # 数据的打乱顺序在iter(train_iter)的时候由当前的随机状态决定，
+        # 所以要在调用iter之前记录或者恢复epoch开始时的随机状态
+        epoch_rng = snapshot["epoch_rng"] if snapshot is not None else get_rng_state()
+        if snapshot is not None:
+            set_rng_state(epoch_rng)
+        data_iter = iter(train_iter)
+        if snapshot is not None:
+            # 重新生成了同样的顺序，跳过已经训练过的批量，然后恢复保存断点时的随机状态
+            for _ in range(start_batch):
+                next(data_iter)
+            set_rng_state(snapshot["rng"])
+            snapshot = None
+        for i, batch in enumerate(data_iter, start_batch if epoch == start_epoch else 0):
             optimizer.zero_grad()
             # 解包数据，转cuda
             X, X_valid_len, Y, Y_valid_len = [x.to(device) for x in batch]
@@ -56,14 +105,30 @@ if __name__ == "__main__":
             grad_clipping(net, 1)
             num_tokens = Y_valid_len.sum()
             optimizer.step()
+            step += 1
+            if manager and checkpoint_every and step % checkpoint_every == 0:
+                rng = get_rng_state()
+                # epoch的最后一个批量之后保存的断点直接从下一个epoch开始
+                position = (epoch, i+1, epoch_rng) if i+1 < len(train_iter) else (epoch+1, 0, rng)
+                manager.save({
+                    "model": net.state_dict(), "optimizer": optimizer.state_dict(),
+                    "epoch": position[0], "batch": position[1], "step": step,
+                    "epoch_rng": position[2], "rng": rng, "config": config,
+                }, step)
         with t.no_grad():
             writer.add_scalar("loss", l.sum()/num_tokens,)
-    print(f'loss {l.sum()/num_tokens:.3f}')
+    if manager:
+        manager.close()
+    # 从最后一个epoch的断点恢复时不会再训练，没有loss可以打印
+    if l is not None:
+        print(f'loss {l.sum()/num_tokens:.3f}')
 
     engs = ['go .', "i lost .", 'he\'s calm .', 'i\'m home .']
     fras = ['va !', 'j\'ai perdu .', 'il est calme .', 'je suis chez moi .']
-    for eng, fra in zip(engs, fras):
-        translation, dec_attention_weight_seq = predict_seq2seq(
-            net, eng, src_vocab, tgt_vocab, num_steps, device, True)
+    # 所有句子在一个批量里面一起翻译
+    translations, _ = predict_seq2seq_batch(
+        net, engs, src_vocab, tgt_vocab, num_steps, device)
+    for eng, fra, translation in zip(engs, fras, translations):
         print(f'{eng} => {translation}, ',
               f'bleu {bleu(translation, fra, k=2):.3f}')
+    print(f"corpus bleu {corpus_bleu([s.split(' ') for s in translations], [s.split(' ') for s in fras], k=2):.3f}")
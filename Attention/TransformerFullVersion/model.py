@@ -3,6 +3,8 @@ from torch import Tensor
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import contextlib
+from torch.utils.checkpoint import checkpoint
 
 
 class PositionalEncoding(nn.Module):
@@ -13,28 +15,46 @@ class PositionalEncoding(nn.Module):
     def __init__(self, num_hiddens: int, dropout: float, max_len=1000) -> None:
         super().__init__()
         self.dropout = nn.Dropout(dropout)
-        # 创建一个足够长的p， p.shape = 1, num_steps, num_hiddens
-        self.p = t.zeros((1, max_len, num_hiddens))
+        self.num_hiddens = num_hiddens
+        # 第一次用到的时候至少算出max_len个位置
+        self.max_len = max_len
+        # p.shape = 1, num_steps, num_hiddens
+        # 注册成buffer，会跟着模型一起.to(device)，p可以随时重新算出来，所以不保存到state_dict里面
+        self.register_buffer("p", t.zeros((1, 0, num_hiddens)), persistent=False)
+
+    def _encoding(self, max_len: int, device) -> Tensor:
+        p = t.zeros((1, max_len, self.num_hiddens), device=device)
         # 先计算出来下标
         # 先定义出一个长度为max_len的数组，这就是公式里面的i
-        I = t.arange(0, max_len, 1, dtype=t.float32).reshape(-1, 1)
+        I = t.arange(0, max_len, 1, dtype=t.float32, device=device).reshape(-1, 1)
         # 计算分式下面的值
         # EXP = 2j/d
-        EXP = t.arange(0, num_hiddens, 2, dtype=t.float32)/num_hiddens
+        EXP = t.arange(0, self.num_hiddens, 2, dtype=t.float32, device=device)/self.num_hiddens
         # 计算最终的值
         V = I / t.pow(10000, EXP)
 
         # 给位置赋sin 和 cos值
         # 注意这里是序列切片，序列切片的操作是,[开始：结束：步长]，任何开始结束或者步长都可以被丢弃
         # 奇数位赋cos，偶数位赋sin
-        self.p[:, :, 0::2] = t.sin(V)
-        self.p[:, :, 1::2] = t.cos(V)
+        p[:, :, 0::2] = t.sin(V)
+        p[:, :, 1::2] = t.cos(V)
+        return p
 
-    def forward(self, X: Tensor) -> Tensor:
+    def extend(self, length: int) -> None:
+        """
+        保证p至少有length个位置，不够的时候长度至少翻倍，这样重新计算的开销是均摊的
+        """
+        if length > self.p.shape[1]:
+            self.p = self._encoding(
+                max(length, 2*self.p.shape[1], self.max_len), self.p.device).to(self.p.dtype)
+
+    def forward(self, X: Tensor, offset=0) -> Tensor:
         """
-        给序列附加位置编码
+        给序列附加位置编码，X中的第一个词元位于offset处，
+        增量解码的时候只需要给新的位置加上位置编码
         """
-        X = X+self.p[:, :X.shape[1], :].to(X.device)
+        self.extend(offset+X.shape[1])
+        X = X+self.p[:, offset:offset+X.shape[1], :]
         X = self.dropout.forward(X)
         return X
 
@@ -52,6 +72,35 @@ def sequence_mask(X: Tensor, valid_len: Tensor, value=0) -> Tensor:
     return X
 
 
+def valid_lens_mask(valid_lens: Tensor, num_kvs: int) -> Tensor:
+    """
+    由有效长度构造可以广播到注意力分数上的遮蔽，True代表需要遮蔽的位置\n
+    valid_lens.shape = (batch,) 时返回 (batch, 1, num_kvs)\n
+    valid_lens.shape = (batch, num_queries) 时返回 (batch, num_queries, num_kvs)
+    """
+    positions = t.arange(num_kvs, device=valid_lens.device)
+    if valid_lens.dim() == 1:
+        return positions >= valid_lens[:, None, None]
+    return positions >= valid_lens[:, :, None]
+
+
+def attention_mask(valid_lens: Tensor, num_kvs: int) -> Tensor:
+    """
+    由有效长度构造所有注意力头共享的遮蔽，True代表需要遮蔽的位置\n
+    valid_lens.shape = (batch,) 时返回 (batch, 1, 1, num_kvs)\n
+    valid_lens.shape = (batch, num_queries) 时返回 (batch, 1, num_queries, num_kvs)\n
+    第1维是注意力头，编码器和解码器每次前向传播只构造一次，所有的层和头都用它
+    """
+    return valid_lens_mask(valid_lens, num_kvs).unsqueeze(1)
+
+
+def causal_mask(num_steps: int, device=None) -> Tensor:
+    """
+    解码器训练时的遮蔽，形状为(1, 1, num_steps, num_steps)，第i个查询只能看到前i+1个键
+    """
+    return t.ones((num_steps, num_steps), dtype=t.bool, device=device).triu_(1)[None, None]
+
+
 def masked_softmax(X: Tensor, valid_lens: Tensor) -> Tensor:
     """
     如果一个句子长度不满足我们给定的长度，我们就进行填充，为了仅仅将有意义的词元作为值来获取注意力汇聚\n
@@ -61,48 +110,146 @@ def masked_softmax(X: Tensor, valid_lens: Tensor) -> Tensor:
     # 如果没有长度限制，直接返回softmax结果，是对最后一维进行Softmax操作
     if valid_lens is None:
         return F.softmax(X, dim=-1)
-    else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            # 如果维度是1的话，那么就直接复制
-            valid_lens = t.repeat_interleave(valid_lens, shape[1])
-        else:
-            # 否则压缩到一个维度上面去
-            valid_lens = valid_lens.reshape(-1)
-        # 最后一轴上被遮蔽的元素使用非常大的负值来替换掉，使softmax输出为0
-        X = sequence_mask(X.reshape(-1, shape[-1]), valid_lens, value=-1e6)
-        # 使用负数填充之后，再进行最后一个维度的Softmax操作
-        return F.softmax(X.reshape(shape), dim=-1)
+    # 遮蔽通过广播作用到每个查询上，不用再复制valid_lens，也不会修改输入的X
+    mask = valid_lens_mask(valid_lens, X.shape[-1])
+    # 最后一轴上被遮蔽的元素使用非常大的负值来替换掉，使softmax输出为0
+    # 这里不用-inf，这样有效长度为0的行和原来一样得到均匀分布而不是nan
+    return F.softmax(X.masked_fill(mask, -1e6), dim=-1)
 
 
 class DotProductAttention(nn.Module):
     """
-    缩放点积注意力，它要求查询和键都有一样的形状，因为要进行矩阵相乘，直接将查询和键做内积
+    缩放点积注意力，它要求查询和键都有一样的形状，因为要进行矩阵相乘，直接将查询和键做内积\n
+    backend="math" 时按照公式一步步计算\n
+    backend="sdpa" 时如果不需要注意力权重(need_weights=False)，直接调用融合的
+    F.scaled_dot_product_attention，不会生成完整的(batch, num_queries, num_kvs)权重矩阵\n
+    只有need_weights=True的时候才会把注意力权重保存到attention_weights，一般通过capture_attention打开，
+    多头注意力的权重也合并成3维的(batch*num_heads, num_queries, num_kvs)
     """
 
-    def __init__(self, dropout: float, **kwargs) -> None:
+    def __init__(self, dropout: float, backend="math", **kwargs) -> None:
         super().__init__(**kwargs)
         self.dropout = nn.Dropout(dropout)
+        self.backend = backend
+        self.need_weights = False
 
     def forward(self, queries: Tensor, keys: Tensor, values: Tensor, valid_lens=None) -> Tensor:
         """
-        根据键和查询来返回相应的值，注意力分数是查询和键的相似度，注意力权重是分数的softmax结果
+        根据键和查询来返回相应的值，注意力分数是查询和键的相似度，注意力权重是分数的softmax结果\n
+        queries、keys、values可以是(batch, 个数, d)，也可以是多头注意力的(batch, num_heads, 个数, d)\n
+        valid_lens可以是有效长度，也可以是attention_mask、causal_mask构造的4维bool遮蔽，
+        3维的输入配4维的遮蔽时认为第0维是合并在一起的batch*num_heads
         """
+        if valid_lens is not None and valid_lens.dtype != t.bool:
+            valid_lens = (valid_lens_mask if queries.dim() == 3 else attention_mask)(
+                valid_lens, keys.shape[-2])
+        if valid_lens is not None and valid_lens.dim() > queries.dim():
+            # 把batch*num_heads拆开，得到的都是视图，这样4维的遮蔽可以直接广播
+            queries, keys, values = [X.unflatten(0, (valid_lens.shape[0], -1))
+                                     for X in (queries, keys, values)]
+            return self.forward(queries, keys, values, valid_lens).flatten(0, 1)
+        if self.backend == "sdpa" and not self.need_weights:
+            # attn_mask中True代表参与注意力计算，和valid_lens_mask正好相反
+            # 注意有效长度为0的行在这里输出的是0，而不是所有值的平均
+            # 融合的kernel可以直接读取多头的4维视图，不需要先拷贝成连续的张量
+            self.attention_weights = None
+            return F.scaled_dot_product_attention(
+                queries, keys, values, None if valid_lens is None else ~valid_lens,
+                dropout_p=self.dropout.p if self.training else 0.)
         # 获得特征维度
         d = queries.shape[-1]
         # 查询和键的转置进行矩阵相乘，然后除以特征维度进行归一化
-        scores = t.bmm(queries, keys.transpose(1, 2))/math.sqrt(d)
+        # scores是这里新建的临时张量，原地缩放和遮蔽可以省掉两次拷贝
+        scores = t.matmul(queries, keys.transpose(-2, -1)).div_(math.sqrt(d))
+        if valid_lens is not None:
+            scores.masked_fill_(valid_lens, -1e6)
         # 进行softmax操作得到注意力权重，注意力权重的和是1
-        self.attention_weights = masked_softmax(scores, valid_lens)
+        attention_weights = F.softmax(scores, dim=-1)
+        # 不需要的时候不保留注意力权重，否则它会一直占着内存直到下一次前向传播
+        # 多头的权重合并成(batch*num_heads, num_queries, num_kvs)，和逐头计算时的形状一样，只是视图
+        self.attention_weights = attention_weights.flatten(0, -3) if self.need_weights else None
         # 与输入的值进行矩阵相乘，得到最后的attention结果
-        attention_value = t.bmm(self.dropout.forward(
-            self.attention_weights), values)
+        attention_value = t.matmul(self.dropout.forward(
+            attention_weights), values)
         return attention_value
 
 
+def set_attention_backend(net: nn.Module, backend: str) -> nn.Module:
+    """
+    把net中所有的DotProductAttention切换到backend，可以是"math"或者"sdpa"
+    """
+    for m in net.modules():
+        if isinstance(m, DotProductAttention):
+            m.backend = backend
+    return net
+
+
+def set_activation_checkpointing(net: nn.Module, blocks=True) -> nn.Module:
+    """
+    训练的时候不保存选中的编码器块和解码器块内部的激活，反向传播时重新计算，用时间换内存\n
+    blocks: True选中所有块，False或者None都不选，也可以是块的下标列表，比如[0, 1]，
+    编码器和解码器都按这个下标选
+    """
+    for m in net.modules():
+        if isinstance(m, (TransformerEncoder, TransformerDecoder)):
+            for i, blk in enumerate(m.blks):
+                blk.checkpoint = blocks is True or bool(blocks) and i in blocks
+    return net
+
+
+def quantize_dynamic_int8(net: nn.Module) -> nn.Module:
+    """
+    返回net的一个动态int8量化的副本，只用于CPU上的推理，原来的net不变\n
+    注意力、前馈网络和输出层的nn.Linear权重量化成int8，激活在运行时动态量化，
+    嵌入层、LayerNorm和注意力的矩阵乘法仍然是fp32
+    """
+    net = t.ao.quantization.quantize_dynamic(net, {nn.Linear}, t.qint8)
+    for m in net.modules():
+        # 量化之后的线性层没有weight参数可以拼接，自注意力分别做三次投影
+        if isinstance(m, MultiHeadAttention):
+            m.fused_qkv = False
+    return net.eval()
+
+
+@contextlib.contextmanager
+def capture_attention(net: nn.Module):
+    """
+    在with语句中记录net中所有DotProductAttention的注意力权重，退出之后恢复原来的设置\n
+    with capture_attention(net):
+        net.decoder(dec_X, dec_state)
+        net.decoder.attention_weights
+    """
+    attentions = [m for m in net.modules() if isinstance(m, DotProductAttention)]
+    need_weights = [m.need_weights for m in attentions]
+    for m in attentions:
+        m.need_weights = True
+    try:
+        yield net
+    finally:
+        for m, need in zip(attentions, need_weights):
+            m.need_weights = need
+
+
+def split_heads(X: Tensor, num_heads: int) -> Tensor:
+    """
+    把(batch_size, 个数, num_hiddens)拆成多头的(batch_size, num_heads, 个数, num_hiddens/num_heads)，
+    只改变形状和步长，返回的是视图，不会拷贝
+    """
+    return X.unflatten(-1, (num_heads, -1)).transpose(1, 2)
+
+
+def merge_heads(X: Tensor) -> Tensor:
+    """
+    split_heads的逆操作，(batch_size, num_heads, 个数, head_dim) -> (batch_size, 个数, num_hiddens)\n
+    X的内存布局本来就是(batch_size, 个数, num_heads, head_dim)时(比如split_heads的结果)不会拷贝
+    """
+    return X.transpose(1, 2).flatten(2)
+
+
 def transpose_qkv(X: Tensor, num_heads: int) -> Tensor:
     """
-    为了多头注意力的并行而转换维度
+    为了多头注意力的并行而转换维度，会拷贝成(batch_size*num_heads, 个数, head_dim)的连续张量\n
+    MultiHeadAttention已经改用split_heads，这里保留给notebook使用
     """
     # 输入X的形状:(batch_size，查询或者“键－值”对的个数，num_hiddens)
     # 输出X的形状:(batch_size，查询或者“键－值”对的个数，num_heads，num_hiddens/num_heads)
@@ -125,34 +272,144 @@ def transpose_output(X: Tensor, num_heads: int) -> Tensor:
     return X.reshape(X.shape[0], X.shape[1], -1)
 
 
+class KVCache:
+    """
+    增量解码时自注意力的键值缓存\n
+    预先分配(batch_size, num_heads, max_len, head_dim)的缓冲区保存投影之后的键和值，
+    每一步原地写入新的位置，注意力直接使用前length个位置的视图，长度不够的时候翻倍
+    """
+
+    def __init__(self, batch_size: int, num_heads: int, max_len: int, head_dim: int,
+                 device=None, dtype=None) -> None:
+        self.keys = t.empty((batch_size, num_heads, max_len, head_dim),
+                            device=device, dtype=dtype)
+        self.values = t.empty_like(self.keys)
+        self.length = 0
+
+    def _grow(self, length: int) -> None:
+        max_len = max(length, 2*self.keys.shape[2])
+        keys, values = self.keys, self.values
+        self.keys = keys.new_empty(keys.shape[:2]+(max_len, keys.shape[3]))
+        self.values = t.empty_like(self.keys)
+        self.keys[:, :, :self.length] = keys[:, :, :self.length]
+        self.values[:, :, :self.length] = values[:, :, :self.length]
+
+    def append(self, keys: Tensor, values: Tensor) -> tuple[Tensor, Tensor]:
+        """
+        写入新位置的键和值，keys.shape = values.shape = (batch_size, num_heads, num_steps, head_dim)\n
+        返回到目前为止所有位置的键和值的视图，形状为(batch_size, num_heads, length, head_dim)
+        """
+        end = self.length+keys.shape[2]
+        if end > self.keys.shape[2]:
+            self._grow(end)
+        self.keys[:, :, self.length:end] = keys
+        self.values[:, :, self.length:end] = values
+        self.length = end
+        return self.keys[:, :, :end], self.values[:, :, :end]
+
+    def reorder(self, index: Tensor) -> "KVCache":
+        """
+        在批量维度上按照index挑选或者复制缓存，返回新的KVCache，只拷贝已经写入的位置
+        """
+        batch_size, num_heads, max_len, head_dim = self.keys.shape
+        cache = KVCache(len(index), num_heads, max_len, head_dim,
+                        self.keys.device, self.keys.dtype)
+        cache.keys[:, :, :self.length] = self.keys[:, :, :self.length].index_select(0, index)
+        cache.values[:, :, :self.length] = self.values[:, :, :self.length].index_select(0, index)
+        cache.length = self.length
+        return cache
+
+
 class MultiHeadAttention(nn.Module):
     """
-    多头注意力，里面有好多个DotProductAttention，而且实现了并行计算
+    多头注意力，里面有好多个DotProductAttention，而且实现了并行计算\n
+    fused_qkv=True时自注意力使用打包的QKV投影，单核CPU上测不出加速，所以默认关闭
     """
 
-    def __init__(self, key_size, query_size, value_size, num_hiddens, num_heads, dropout, bias=False, **kwargs) -> None:
+    def __init__(self, key_size, query_size, value_size, num_hiddens, num_heads, dropout, bias=False,
+                 backend="math", fused_qkv=False, **kwargs) -> None:
         super().__init__(**kwargs)
         self.num_heads = num_heads
-        self.attention = DotProductAttention(dropout)
+        self.fused_qkv = fused_qkv
+        self.attention = DotProductAttention(dropout, backend)
         self.W_q = nn.Linear(query_size, num_hiddens, bias)
         self.W_k = nn.Linear(key_size, num_hiddens, bias)
         self.W_v = nn.Linear(value_size, num_hiddens, bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias)
+        # 拼接好的QKV权重，权重没有变化的时候重复使用
+        self._packed, self._packed_key = None, None
 
-    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, valid_lens: Tensor) -> Tensor:
+    def packed_weight(self) -> tuple[Tensor, Tensor]:
         """
-        将多头注意力并到batch维度实现并行化计算
+        返回拼接好的(weight, bias)\n
+        需要梯度的时候每次都重新拼接，反向传播才能传到W_q、W_k、W_v；
+        推理时缓存拼接的结果，优化器更新、load_state_dict和.to()都会改变
+        权重的版本号或者地址，这时才重新拼接
         """
-        queries = transpose_qkv(self.W_q.forward(queries), self.num_heads)
-        keys = transpose_qkv(self.W_k.forward(keys), self.num_heads)
-        values = transpose_qkv(self.W_v.forward(values), self.num_heads)
-        # 将valid_lens复制num_head份然后进行并行处理
-        if valid_lens is not None:
-            valid_lens = t.repeat_interleave(
-                valid_lens, repeats=self.num_heads, dim=0)
+        linears = (self.W_q, self.W_k, self.W_v)
+        params = [m.weight for m in linears]+([m.bias for m in linears] if self.W_q.bias is not None else [])
+        if t.is_grad_enabled() and any(p.requires_grad for p in params):
+            self._packed, self._packed_key = None, None
+            return t.cat(params[:3]), t.cat(params[3:]) if len(params) > 3 else None
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if key != self._packed_key:
+            with t.no_grad():
+                self._packed = (t.cat(params[:3]), t.cat(params[3:]) if len(params) > 3 else None)
+            self._packed_key = key
+        return self._packed
+
+    def packed_qkv(self, X: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        自注意力(queries、keys、values是同一个张量)的快速路径\n
+        用拼接的W_q、W_k、W_v的权重只做一次GEMM，再拆成多头的视图，
+        权重还是分开存的，所以原来的state_dict可以直接加载
+        """
+        weight, bias = self.packed_weight()
+        # qkv.shape = (batch_size, num_steps, 3*num_hiddens)
+        qkv = F.linear(X, weight, bias)
+        # (3, batch_size, num_heads, num_steps, num_hiddens/num_heads)，只是视图，没有拷贝
+        qkv = qkv.unflatten(-1, (3, self.num_heads, -1)).permute(2, 0, 3, 1, 4)
+        return qkv.unbind(0)
+
+    def new_cache(self, batch_size: int, max_len: int, device=None, dtype=None) -> KVCache:
+        """
+        为增量解码创建一个空的KVCache
+        """
+        return KVCache(batch_size, self.num_heads, max_len, self.W_k.out_features//self.num_heads,
+                       device, dtype)
+
+    def project_kv(self, keys: Tensor, values: Tensor) -> tuple[Tensor, Tensor]:
+        """
+        提前把不会变化的keys和values投影成(batch_size, num_heads, 键值对的个数, head_dim)，
+        解码时的编码器-解码器注意力每一步都用同一份，作为projected_kv传给forward
+        """
+        return (split_heads(self.W_k.forward(keys), self.num_heads),
+                split_heads(self.W_v.forward(values), self.num_heads))
+
+    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, valid_lens: Tensor,
+                cache: KVCache = None, projected_kv: tuple[Tensor, Tensor] = None) -> Tensor:
+        """
+        多头注意力在(batch_size, num_heads, 个数, head_dim)的视图上计算，投影的结果不需要拷贝就可以送进注意力\n
+        给出cache的时候keys和values只包含新的位置，投影之后写入cache，注意力作用在cache中所有的位置上\n
+        给出projected_kv的时候直接使用project_kv的结果，不再投影keys和values
+        """
+        if projected_kv is not None:
+            queries = split_heads(self.W_q.forward(queries), self.num_heads)
+            keys, values = projected_kv
+        elif self.fused_qkv and queries is keys and keys is values:
+            queries, keys, values = self.packed_qkv(queries)
+        else:
+            queries = split_heads(self.W_q.forward(queries), self.num_heads)
+            keys = split_heads(self.W_k.forward(keys), self.num_heads)
+            values = split_heads(self.W_v.forward(values), self.num_heads)
+        if cache is not None:
+            keys, values = cache.append(keys, values)
+        # 有效长度转换成在注意力头上广播的遮蔽，不需要复制num_heads份，bool遮蔽直接使用
+        if valid_lens is not None and valid_lens.dtype != t.bool:
+            valid_lens = attention_mask(valid_lens, keys.shape[2])
         output = self.attention.forward(queries, keys, values, valid_lens)
         # output_concat 的形状(batch_size, num_queries,num_hiddens)
-        output = transpose_output(output, self.num_heads)
+        output = merge_heads(output)
         output = self.W_o.forward(output)
         return output
 
@@ -216,6 +473,8 @@ class EncoderBlock(nn.Module):
         self.ffn = PositionWiseFFN(
             ffn_num_input, ffn_num_hiddens, num_hiddens)
         self.addnorm2 = AddNorm(norm_shape, dropout)
+        # 由set_activation_checkpointing设置
+        self.checkpoint = False
 
     def forward(self, X: Tensor, valid_lens: Tensor) -> Tensor:
         Y = self.attention.forward(X, X, X, valid_lens)
@@ -257,12 +516,18 @@ class TransformerEncoder(nn.Module):
         # 与根号num_hiddens相乘，避免位置编码过大导致只学习位置编码
         X = self.pos_encoding.forward(
             self.embedding.forward(X)*math.sqrt(self.num_hiddens))
+        # 遮蔽只构造一次，所有的编码器块和注意力头共享
+        mask = None if valid_lens is None else attention_mask(valid_lens, X.shape[1])
         # 将Attention权重先定义，等会进行赋值，方便可视化操作
         self.attention_weights = [None]*len(self.blks)
 
         # 逐级进行前向传播，拿出Attention
         for i, blk in enumerate(self.blks):
-            X = blk.forward(X, valid_lens)
+            if blk.checkpoint and self.training and t.is_grad_enabled():
+                # 反向传播的时候重新计算这个块，dropout的随机状态会被恢复，重算的结果和第一次一样
+                X = checkpoint(blk, X, mask, use_reentrant=False)
+            else:
+                X = blk.forward(X, mask)
             self.attention_weights[i] = blk.attention.attention.attention_weights
 
         return X
@@ -290,31 +555,42 @@ class DecoderBlock(nn.Module):
         self.ffn = PositionWiseFFN(
             ffn_num_input, ffn_num_hiddens, num_hiddens)
         self.addnorm3 = AddNorm(norm_shape, dropout)
+        # 由set_activation_checkpointing设置
+        self.checkpoint = False
 
-    def forward(self, X: Tensor, state: tuple[Tensor, Tensor, Tensor]) -> Tensor:
+    def forward(self, X: Tensor, state: tuple[Tensor, Tensor, Tensor], masks=None) -> Tensor:
+        """
+        masks是TransformerDecoder构造好的(解码器自注意力遮蔽, 编码器-解码器注意力遮蔽)，
+        为None的时候在这里由有效长度计算
+        """
         enc_outputs, enc_valid_lens = state[0], state[1]
-        if state[2][self.i] is None:
-            key_values = X
-        else:
-            key_values = t.cat((state[2][self.i], X), dim=1)
-        # concatenation比单纯的相加更能保留数据
-        state[2][self.i] = key_values
-
         # 在训练过程中，将后面的内容遮蔽起来，但是在预测过程中就不用了，因为我们也看不到后面的东西
-        if self.training:
+        if masks is not None:
+            dec_valid_lens, enc_valid_lens = masks
+        elif self.training:
             batch_size, num_steps, _ = X.shape
             dec_valid_lens = t.arange(
                 1, num_steps+1, device=X.device).repeat(batch_size, 1)
         else:
             dec_valid_lens = None
+        if self.training:
+            state[2][self.i] = None
+            cache = None
+        else:
+            # 预测的时候把已经解码的位置投影之后的键和值缓存下来，每一步只投影新的词元，
+            # 缓存按照源序列的长度预先分配，一般就是num_steps
+            if state[2][self.i] is None:
+                state[2][self.i] = self.attention1.new_cache(
+                    X.shape[0], max(X.shape[1], enc_outputs.shape[1]), X.device, X.dtype)
+            cache = state[2][self.i]
         # 进行前向传播操作
         # 第一个attention模块用的是target input作为kqv
-        X2 = self.attention1.forward(
-            X, key_values, key_values, dec_valid_lens)
+        X2 = self.attention1.forward(X, X, X, dec_valid_lens, cache)
         Y = self.addnorm1.forward(X, X2)
         # 第二个attention使用Y作为q，编码器的输出作为kv
+        # 编码器输出的键和值已经在init_state中投影好了
         Y2 = self.attention2.forward(
-            Y, enc_outputs, enc_outputs, enc_valid_lens)
+            Y, enc_outputs, enc_outputs, enc_valid_lens, projected_kv=state[3][self.i])
         Z = self.addnorm2.forward(Y, Y2)
         # 经过前馈网络之后返回结果
         return self.addnorm3.forward(Z, self.ffn.forward(Z)), state
@@ -344,19 +620,45 @@ class TransformerDecoder(nn.Module):
         self.dense = nn.Linear(num_hiddens, vocab_size)
 
     def init_state(self, enc_outputs: Tensor, enc_validlens: Tensor, *args):
-        return [enc_outputs, enc_validlens, [None]*self.num_layers]
+        # 编码器-解码器注意力的键和值在整个解码过程中都不变，每一层只投影一次
+        cross_key_values = [blk.attention2.project_kv(enc_outputs, enc_outputs)
+                            for blk in self.blks]
+        return [enc_outputs, enc_validlens, [None]*self.num_layers, cross_key_values]
+
+    def reorder_state(self, state, index: Tensor):
+        """
+        在批量维度上按照index挑选或者复制状态，束搜索用它来重新排列候选序列
+        """
+        enc_outputs, enc_valid_lens, key_values, cross_key_values = state
+        if enc_valid_lens is not None:
+            enc_valid_lens = enc_valid_lens.index_select(0, index)
+        key_values = [None if kv is None else kv.reorder(index)
+                      for kv in key_values]
+        cross_key_values = [(k.index_select(0, index), v.index_select(0, index))
+                            for k, v in cross_key_values]
+        return [enc_outputs.index_select(0, index), enc_valid_lens, key_values, cross_key_values]
 
     def forward(self, X: Tensor, state: tuple[Tensor, Tensor, Tensor]) -> Tensor:
-        # 如法炮制
+        # 如法炮制，预测的时候state里已经缓存了前面的词元，新的词元从这个位置开始编码
+        offset = 0 if state[2][0] is None else state[2][0].length
         X = self.pos_encoding.forward(
-            self.embedding.forward(X)*math.sqrt(self.num_hiddens))
+            self.embedding.forward(X)*math.sqrt(self.num_hiddens), offset)
         # 要提取权重进行可视化，这里较为啰嗦
         # 有两个多头注意力，所以就要in range(2)
         self._attention_weights = [[None]*len(self.blks) for _ in range(2)]
+        # 两种遮蔽都只构造一次，所有的解码器块和注意力头共享
+        dec_mask = causal_mask(X.shape[1], X.device) if self.training else None
+        enc_mask = None if state[1] is None else attention_mask(state[1], state[0].shape[1])
 
         # 传入到DecoderBlock中
         for i, blk in enumerate(self.blks):
-            X, state = blk.forward(X, state)
+            if blk.checkpoint and self.training and t.is_grad_enabled():
+                # 训练的时候块对state的修改只是把自注意力缓存置为None，重算一遍也不会改变state，
+                # 所以只对输出做检查点，state中编码器的输出和投影好的键值照常接收梯度
+                X = checkpoint(lambda X, blk=blk: blk.forward(X, state, (dec_mask, enc_mask))[0],
+                               X, use_reentrant=False)
+            else:
+                X, state = blk.forward(X, state, (dec_mask, enc_mask))
             # 解码器自注意力权重
             self._attention_weights[0][i] = blk.attention1.attention.attention_weights
             # "编码器-解码器"自注意力权重
@@ -0,0 +1,209 @@
+"""
+基于asyncio的HTTP/JSON翻译服务，把同时到达的请求攒成小批量一起解码\n
+    POST /translate  {"text": "go ."} -> {"translation": "va !", "batch_size": 3, "latency_ms": 12.5}
+    GET  /metrics    -> 延迟的p50/p99和批量大小的直方图
+第一个请求到达之后最多等待max_delay_ms毫秒，或者攒够max_batch_size个请求，就交给工作线程批量解码，
+解码的时候事件循环继续接收新的请求\n
+用法(在仓库根目录下运行):
+    python Attention/TransformerFullVersion/server.py --checkpoint checkpoint.pt
+不给--checkpoint时使用随机初始化的模型和随机词表，只用来测试服务本身
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch as t
+from utils import predict_seq2seq_batch
+from loading import load_trained, make_model, make_vocab
+
+
+def percentile(values, q: float) -> float:
+    """
+    最近邻法的百分位数，values为空时返回0
+    """
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values)-1, int(q/100*len(values)))]
+
+
+class MicroBatcher:
+    """
+    把并发的翻译请求攒成小批量，在一个工作线程中调用predict_seq2seq_batch\n
+    max_batch_size: 一个批量最多的句子数\n
+    max_delay_ms: 批量中第一个请求最多等待的毫秒数
+    """
+
+    def __init__(self, net, src_vocab, tgt_vocab, num_steps: int, device,
+                 max_batch_size=32, max_delay_ms=5., history=10000) -> None:
+        self.net, self.src_vocab, self.tgt_vocab = net, src_vocab, tgt_vocab
+        self.num_steps, self.device = num_steps, device
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms/1000
+        self.queue = asyncio.Queue()
+        # 模型只在这一个线程中运行
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.Counter()
+
+    async def translate(self, text: str) -> tuple[str, int, float]:
+        """
+        提交一个句子，返回翻译、所在批量的大小和从提交到完成的秒数
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2]+self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline-time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 队列里已经在等的请求不需要再等，直接放进这个批量
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                translations = await loop.run_in_executor(
+                    self.executor, self._decode, [text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            for (_, future, start), translation in zip(batch, translations):
+                self.latencies.append(end-start)
+                if not future.cancelled():
+                    future.set_result((translation, len(batch), end-start))
+
+    def _decode(self, sentences):
+        with t.no_grad():
+            return predict_seq2seq_batch(self.net, sentences, self.src_vocab, self.tgt_vocab,
+                                         self.num_steps, self.device)[0]
+
+    def metrics(self) -> dict:
+        latencies = list(self.latencies)
+        return {
+            "requests": sum(size*count for size, count in self.batch_sizes.items()),
+            "latency_ms": {"p50": percentile(latencies, 50)*1e3, "p99": percentile(latencies, 99)*1e3},
+            "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+        }
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """
+    读取一个HTTP请求，返回(方法, 路径, 请求体)，连接关闭时返回None\n
+    请求行或者Content-Length格式不对时抛出ValueError
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ValueError(f"malformed request line {request_line!r}") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        content_length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise ValueError(f"invalid Content-Length {headers['content-length']!r}") from None
+    if content_length < 0:
+        raise ValueError(f"invalid Content-Length {content_length}")
+    body = await reader.readexactly(content_length)
+    return method, path, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: str, payload: dict):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1")+body)
+
+
+async def serve(batcher: MicroBatcher, host="127.0.0.1", port=8000):
+    """
+    启动HTTP服务和攒批量的协程，返回asyncio.Server，连接保持打开可以发送多个请求
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError as e:
+                    # 请求格式不对时无法确定下一个请求从哪里开始，回复400之后关闭连接
+                    write_response(writer, "400 Bad Request", {"error": str(e)})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, body = request
+                if method == "POST" and path == "/translate":
+                    try:
+                        text = json.loads(body)["text"]
+                    except (ValueError, KeyError, TypeError):
+                        text = None
+                    # 非字符串或者空字符串会让整个批量的解码失败，在进入批量之前拒绝
+                    if not isinstance(text, str) or not text.strip():
+                        write_response(writer, "400 Bad Request", {"error": "expected {\"text\": <non-empty string>}"})
+                    else:
+                        try:
+                            translation, batch_size, latency = await batcher.translate(text)
+                        except Exception as e:
+                            write_response(writer, "500 Internal Server Error", {"error": repr(e)})
+                        else:
+                            write_response(writer, "200 OK", {"translation": translation, "batch_size": batch_size,
+                                                              "latency_ms": latency*1e3})
+                elif method == "GET" and path == "/metrics":
+                    write_response(writer, "200 OK", batcher.metrics())
+                else:
+                    write_response(writer, "404 Not Found", {"error": f"{method} {path}"})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    # 保存任务的引用，防止被垃圾回收
+    server.batcher_task = asyncio.create_task(batcher.run())
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--config", default="./Attention/TransformerFullVersion/config.yaml")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_delay_ms", type=float, default=5.)
+    args = parser.parse_args()
+    if args.checkpoint:
+        net, src_vocab, tgt_vocab, _, _, num_steps = load_trained(args.config, args.checkpoint, 0)
+    else:
+        src_vocab = tgt_vocab = make_vocab(200)
+        net, num_steps = make_model(len(src_vocab), len(tgt_vocab)), 10
+
+    async def main():
+        server = await serve(MicroBatcher(net.eval(), src_vocab, tgt_vocab, num_steps, "cpu",
+                                          args.max_batch_size, args.max_delay_ms), args.host, args.port)
+        print(f"serving on http://{args.host}:{args.port}")
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
@@ -1,9 +1,12 @@
 import torch as t
 import torch.nn as nn
+import torch.nn.functional as F
 from torch import Tensor
 from datasets import truncate_pad
+from model import capture_attention
 import math
 import collections
+import contextlib
 
 
 def grad_clipping(net, theta):
@@ -74,33 +77,244 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps,
     dec_X = t.unsqueeze(t.tensor(
         [tgt_vocab['<bos>']], dtype=t.long, device=device), dim=0)
     output_seq, attention_weight_seq = [], []
-    for _ in range(num_steps):
-        Y, dec_state = net.decoder(dec_X, dec_state)
-        # 我们使用具有预测最高可能性的词元，作为解码器在下一时间步的输入
-        dec_X = Y.argmax(dim=2)
-        pred = dec_X.squeeze(dim=0).type(t.int32).item()
-        # 保存注意力权重（稍后讨论）
-        if save_attention_weights:
-            attention_weight_seq.append(net.decoder.attention_weights)
-        # 一旦序列结束词元被预测，输出序列的生成就完成了
-        if pred == tgt_vocab['<eos>']:
-            break
-        output_seq.append(pred)
+    # 只有需要的时候才让注意力层记录注意力权重
+    with capture_attention(net) if save_attention_weights else contextlib.nullcontext():
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            # 我们使用具有预测最高可能性的词元，作为解码器在下一时间步的输入
+            dec_X = Y.argmax(dim=2)
+            pred = dec_X.squeeze(dim=0).type(t.int32).item()
+            # 保存注意力权重（稍后讨论）
+            if save_attention_weights:
+                attention_weight_seq.append(net.decoder.attention_weights)
+            # 一旦序列结束词元被预测，输出序列的生成就完成了
+            if pred == tgt_vocab['<eos>']:
+                break
+            output_seq.append(pred)
     return ' '.join(tgt_vocab.to_tokens(output_seq)), attention_weight_seq
 
 
-def bleu(pred_seq, label_seq, k):  # @save
-    """计算BLEU"""
-    pred_tokens, label_tokens = pred_seq.split(' '), label_seq.split(' ')
-    len_pred, len_label = len(pred_tokens), len(label_tokens)
+def build_src_batch(src_sentences, src_vocab, num_steps, device):
+    """
+    把一组源语言句子填充成一个批量，返回enc_X和有效长度
+    """
+    src_tokens = [src_vocab[s.lower().split(' ')] + [src_vocab['<eos>']]
+                  for s in src_sentences]
+    enc_valid_len = t.tensor([len(l) for l in src_tokens], device=device)
+    enc_X = t.tensor([truncate_pad(l, num_steps, src_vocab['<pad>']) for l in src_tokens],
+                     dtype=t.long, device=device)
+    return enc_X, enc_valid_len
+
+
+def _to_translation(pred: list, tgt_vocab) -> str:
+    # 截掉<eos>之后的部分
+    eos = tgt_vocab['<eos>']
+    if eos in pred:
+        pred = pred[:pred.index(eos)]
+    return ' '.join(tgt_vocab.to_tokens(pred))
+
+
+def predict_seq2seq_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps,
+                          device, save_attention_weights=False):
+    """
+    批量的序列到序列预测，把所有句子填充成一个批量一起编码，然后同步地逐步解码\n
+    每个句子预测出<eos>之后就标记为结束，所有句子都结束了才停止，每一步只同步一次
+    """
+    net.eval()
+    eos = tgt_vocab['<eos>']
+    with t.no_grad(), capture_attention(net) if save_attention_weights else contextlib.nullcontext():
+        enc_X, enc_valid_len = build_src_batch(
+            src_sentences, src_vocab, num_steps, device)
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        dec_X = t.full((enc_X.shape[0], 1), tgt_vocab['<bos>'],
+                       dtype=t.long, device=device)
+        finished = t.zeros(enc_X.shape[0], dtype=t.bool, device=device)
+        output_seq, attention_weight_seq = [], []
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            dec_X = Y.argmax(dim=2)
+            output_seq.append(dec_X)
+            if save_attention_weights:
+                attention_weight_seq.append(net.decoder.attention_weights)
+            finished |= dec_X.squeeze(1) == eos
+            if finished.all():
+                break
+    # 最后一次性拷贝回CPU
+    translations = [_to_translation(pred, tgt_vocab)
+                    for pred in t.cat(output_seq, dim=1).tolist()]
+    return translations, attention_weight_seq
+
+
+def beam_search(net, src_sentences, src_vocab, tgt_vocab, num_steps, device,
+                beam_size=4, alpha=0.75, early_stopping=False):
+    """
+    批量的束搜索，每个句子的beam_size个候选被打包进批量维度，一共batch_size*beam_size行\n
+    每一步从beam_size*vocab_size个候选中选出最好的beam_size个，然后通过net.decoder.reorder_state
+    在批量维度上挑选出对应的解码器状态\n
+    候选序列按照 log P / L^alpha 排序，alpha=0时不做长度归一化\n
+    一个句子的所有候选都输出了<eos>就把它从批量中移除，early_stopping=True时最好的候选结束就移除\n
+    返回翻译结果和对应的归一化分数
+    """
+    net.eval()
+    eos = tgt_vocab['<eos>']
+    with t.no_grad():
+        enc_X, enc_valid_len = build_src_batch(
+            src_sentences, src_vocab, num_steps, device)
+        batch_size = enc_X.shape[0]
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        # 每个句子的状态复制beam_size份
+        dec_state = net.decoder.reorder_state(dec_state, t.arange(
+            batch_size, device=device).repeat_interleave(beam_size))
+        # 一开始只有一个候选，其余的分数设为负无穷，避免选出重复的候选
+        scores = t.full((batch_size, beam_size), -float("inf"), device=device)
+        scores[:, 0] = 0
+        lengths = t.zeros((batch_size, beam_size),
+                          dtype=t.long, device=device)
+        finished = t.zeros((batch_size, beam_size),
+                           dtype=t.bool, device=device)
+        tokens = t.zeros((batch_size*beam_size, 0),
+                         dtype=t.long, device=device)
+        dec_X = t.full((batch_size*beam_size, 1), tgt_vocab['<bos>'],
+                       dtype=t.long, device=device)
+        # active[i] 是当前批量中第i个句子在输入中的下标
+        active = t.arange(batch_size, device=device)
+        results = [None]*batch_size
+
+        def collect(rows: Tensor):
+            # 排序之后第0个候选就是最好的
+            best = tokens.reshape(-1, beam_size, tokens.shape[1])[rows, 0]
+            best_scores = scores[rows, 0] / \
+                lengths[rows, 0].clamp(min=1).float()**alpha
+            for i, pred, score in zip(active[rows].tolist(), best.tolist(), best_scores.tolist()):
+                results[i] = (_to_translation(pred, tgt_vocab), score)
+
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            log_probs = F.log_softmax(Y[:, -1], dim=-1)
+            vocab_size = log_probs.shape[-1]
+            log_probs = log_probs.reshape(-1, beam_size, vocab_size)
+            # 已经结束的候选只能继续输出<eos>，分数和长度都不变
+            eos_only = t.full((vocab_size,), -float("inf"), device=device)
+            eos_only[eos] = 0
+            log_probs = t.where(finished[:, :, None], eos_only, log_probs)
+            candidates = (scores[:, :, None]+log_probs).reshape(-1,
+                                                                beam_size*vocab_size)
+            new_lengths = (lengths+(~finished).long())[:, :, None].expand(
+                -1, -1, vocab_size).reshape(-1, beam_size*vocab_size)
+            # 按长度归一化之后的分数选出最好的beam_size个候选
+            _, top = (candidates/new_lengths.float()**alpha).topk(beam_size, dim=1)
+            beam_idx, next_tokens = top // vocab_size, top % vocab_size
+            scores = candidates.gather(1, top)
+            lengths = new_lengths.gather(1, top)
+            finished = finished.gather(1, beam_idx) | (next_tokens == eos)
+            # 按照选出来的候选重新排列历史和解码器状态
+            index = (t.arange(beam_idx.shape[0], device=device)[:, None]*beam_size
+                     + beam_idx).reshape(-1)
+            tokens = t.cat([tokens[index], next_tokens.reshape(-1, 1)], dim=1)
+            dec_state = net.decoder.reorder_state(dec_state, index)
+            dec_X = next_tokens.reshape(-1, 1)
+            # 已经结束的句子移出批量
+            done = finished[:, 0] if early_stopping else finished.all(dim=1)
+            if done.any():
+                collect(done.nonzero().squeeze(1))
+                keep = (~done).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                index = (keep[:, None]*beam_size +
+                         t.arange(beam_size, device=device)).reshape(-1)
+                scores, lengths, finished = scores[keep], lengths[keep], finished[keep]
+                tokens, dec_X, active = tokens[index], dec_X[index], active[keep]
+                dec_state = net.decoder.reorder_state(dec_state, index)
+        else:
+            collect(t.arange(active.shape[0], device=device))
+    translations = [result[0] for result in results]
+    return translations, [result[1] for result in results]
+
+
+def _as_tokens(seq) -> list:
+    # Tensor先转换成python列表，哈希整数比哈希0维张量快得多
+    return seq.tolist() if hasattr(seq, "tolist") else list(seq)
+
+
+def _count_matches(pred_tokens: list, label_tokens: list, n: int) -> int:
+    """
+    n元语法的截断匹配数，n元语法直接用元组表示，不再拼接字符串
+    """
+    label_subs = {}
+    for gram in zip(*[label_tokens[i:] for i in range(n)]):
+        label_subs[gram] = label_subs.get(gram, 0)+1
+    num_matches = 0
+    for gram in zip(*[pred_tokens[i:] for i in range(n)]):
+        count = label_subs.get(gram, 0)
+        if count > 0:
+            num_matches += 1
+            label_subs[gram] = count-1
+    return num_matches
+
+
+def _bleu_from_counts(num_matches, num_ngrams, len_pred, len_label, k: int) -> float:
+    """
+    由匹配数、n元语法数和长度计算BLEU，浮点运算的顺序和bleu保持一致
+    """
+    if len_pred == 0:
+        return 0.
     score = math.exp(min(0, 1 - len_label / len_pred))
     for n in range(1, k + 1):
-        num_matches, label_subs = 0, collections.defaultdict(int)
-        for i in range(len_label - n + 1):
-            label_subs[' '.join(label_tokens[i: i + n])] += 1
-        for i in range(len_pred - n + 1):
-            if label_subs[' '.join(pred_tokens[i: i + n])] > 0:
-                num_matches += 1
-                label_subs[' '.join(pred_tokens[i: i + n])] -= 1
-        score *= math.pow(num_matches / (len_pred - n + 1), math.pow(0.5, n))
+        # 预测序列比n短，没有任何n元语法可以匹配
+        if num_ngrams[n-1] <= 0:
+            return 0.
+        score *= math.pow(num_matches[n-1] / num_ngrams[n-1], math.pow(0.5, n))
     return score
+
+
+def ngram_matches(pred_seqs, label_seqs, k: int) -> tuple[list, list, list, list]:
+    """
+    统计一批句子的n元语法截断匹配数\n
+    返回每个句子的 num_matches, num_ngrams (长度为k的列表) 以及预测和标签的长度
+    """
+    all_matches, all_ngrams, pred_lens, label_lens = [], [], [], []
+    for pred_tokens, label_tokens in zip(pred_seqs, label_seqs):
+        pred_tokens, label_tokens = _as_tokens(pred_tokens), _as_tokens(label_tokens)
+        len_pred = len(pred_tokens)
+        all_matches.append([_count_matches(pred_tokens, label_tokens, n)
+                            for n in range(1, k + 1)])
+        all_ngrams.append([len_pred - n + 1 for n in range(1, k + 1)])
+        pred_lens.append(len_pred)
+        label_lens.append(len(label_tokens))
+    return all_matches, all_ngrams, pred_lens, label_lens
+
+
+def sentence_bleu(pred_tokens, label_tokens, k: int) -> float:
+    """
+    计算一个句子的BLEU，输入是词元序列，词元下标或者字符串都可以，结果和bleu完全一样
+    """
+    return batch_bleu([pred_tokens], [label_tokens], k)[0]
+
+
+def batch_bleu(pred_seqs, label_seqs, k: int) -> list[float]:
+    """
+    一次计算一批句子的BLEU，每个句子的结果和sentence_bleu完全一样
+    """
+    num_matches, num_ngrams, pred_lens, label_lens = ngram_matches(
+        pred_seqs, label_seqs, k)
+    return [_bleu_from_counts(*counts, k) for counts in zip(
+        num_matches, num_ngrams, pred_lens, label_lens)]
+
+
+def corpus_bleu(pred_seqs, label_seqs, k: int) -> float:
+    """
+    语料库级别的BLEU，先累加所有句子的匹配数、n元语法数和长度，再计算精度和长度惩罚
+    """
+    num_matches, num_ngrams, pred_lens, label_lens = ngram_matches(
+        pred_seqs, label_seqs, k)
+    # 语料库中每个n元语法的总数不会是负数
+    num_ngrams = [sum(max(c, 0) for c in col) for col in zip(*num_ngrams)]
+    return _bleu_from_counts([sum(col) for col in zip(*num_matches)], num_ngrams,
+                             sum(pred_lens), sum(label_lens), k)
+
+
+def bleu(pred_seq, label_seq, k):  # @save
+    """计算BLEU"""
+    return sentence_bleu(pred_seq.split(' '), label_seq.split(' '), k)
@@ -0,0 +1,285 @@
+"""
+性能测试脚本，用法(在仓库根目录下运行):
+    python Attention/TransformerWmathorVersion/benchmark.py cross_kv
+    python Attention/TransformerWmathorVersion/benchmark.py quantize
+    python Attention/TransformerWmathorVersion/benchmark.py masks
+    python Attention/TransformerWmathorVersion/benchmark.py incremental
+    python Attention/TransformerWmathorVersion/benchmark.py sweep --csv sweep.csv
+"""
+import argparse
+import collections
+import csv
+import itertools
+import math
+import multiprocessing as mp
+import resource
+import time
+
+import torch as t
+from torch.profiler import profile, ProfilerActivity
+
+from model import Transformer, quantize_dynamic_int8, greedy_decode
+
+
+def timeit(fn, repeat: int) -> float:
+    """
+    先预热一次，然后返回fn的平均耗时(秒)
+    """
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter()-start)/repeat
+
+
+def greedy_steps(model: Transformer, enc_inputs, enc_outputs, num_steps, start_symbol, project_once):
+    """
+    和train.py中的greedy_decoder一样逐词解码，但是不检查结束符，固定解码num_steps步
+    """
+    enc_kvs = model.decoder.init_state(enc_outputs) if project_once else None
+    dec_input = t.full((enc_inputs.shape[0], 1), start_symbol,
+                       dtype=enc_inputs.dtype, device=enc_inputs.device)
+    for _ in range(num_steps):
+        dec_outputs, _, _ = model.decoder(dec_input, enc_inputs, enc_outputs, enc_kvs)
+        next_word = model.projection(dec_outputs[:, -1]).argmax(dim=-1, keepdim=True)
+        dec_input = t.cat([dec_input, next_word], -1)
+    return dec_input
+
+
+def reference_greedy(model: Transformer, enc_input, start_symbol, end_symbol, max_len):
+    """
+    原来train.py中的逐句贪心解码：每一步都把整个前缀重新送进解码器，解码出end_symbol或者max_len个词元就停止
+    """
+    enc_outputs, _ = model.encoder(enc_input)
+    enc_kvs = model.decoder.init_state(enc_outputs)
+    dec_input = t.full((1, 1), start_symbol, dtype=enc_input.dtype, device=enc_input.device)
+    for _ in range(max_len):
+        dec_outputs, _, _ = model.decoder(dec_input, enc_input, enc_outputs, enc_kvs)
+        next_word = model.projection(dec_outputs[:, -1]).argmax(dim=-1, keepdim=True)
+        dec_input = t.cat([dec_input, next_word], -1)
+        if next_word.item() == end_symbol:
+            break
+    return dec_input
+
+
+def bench_incremental(args):
+    """
+    逐词贪心解码每个词元的耗时，对比每一步重新计算整个前缀和使用KVCache的增量解码，
+    两种方式解码出来的词元必须完全一致，包括逐句解码遇到结束符停止和批量解码的结果
+    """
+    model = Transformer(args.vocab_size, args.vocab_size).to(args.device).eval()
+    enc_inputs = t.randint(1, args.vocab_size, (args.batch_size, 10), device=args.device)
+    with t.no_grad():
+        # 随机模型很少解码出指定的结束符，用第一个句子第三步解码出来的词元作为结束符
+        end_symbol = greedy_decode(model, enc_inputs[:1], 1, None, 3)[0, -1].item()
+        batched = greedy_decode(model, enc_inputs, 1, end_symbol, args.num_steps)
+        for i in range(args.batch_size):
+            expected = reference_greedy(model, enc_inputs[i:i+1], 1, end_symbol, args.num_steps)[0]
+            assert t.equal(batched[i, :len(expected)], expected)
+            assert (batched[i, len(expected):] == 0).all()
+        for num_steps in args.seq_lens:
+            enc_outputs, _ = model.encoder(enc_inputs)
+            assert t.equal(greedy_steps(model, enc_inputs, enc_outputs, num_steps, 1, True),
+                           greedy_decode(model, enc_inputs, 1, None, num_steps))
+            full, incremental = [
+                timeit(fn, args.repeat)/num_steps for fn in (
+                    lambda: greedy_steps(model, enc_inputs, model.encoder(enc_inputs)[0], num_steps, 1, True),
+                    lambda: greedy_decode(model, enc_inputs, 1, None, num_steps))]
+            print(f"num_steps {num_steps:<5}: full prefix {full*1e3:8.3f}ms/token, "
+                  f"kv cache {incremental*1e3:8.3f}ms/token ({full/incremental:.2f}x)")
+
+
+def bench_cross_kv(args):
+    """
+    不同源序列长度下逐词解码的耗时，对比编码器-解码器注意力的K和V只投影一次和每一步都重新投影，
+    两种方式解码出来的结果必须完全一致
+    """
+    model = Transformer(args.vocab_size, args.vocab_size).to(args.device).eval()
+    for src_len in args.seq_lens:
+        enc_inputs = t.randint(1, args.vocab_size, (args.batch_size, src_len), device=args.device)
+        with t.no_grad():
+            # 编码器只跑一次，只统计解码的时间
+            enc_outputs, _ = model.encoder(enc_inputs)
+            assert t.equal(greedy_steps(model, enc_inputs, enc_outputs, args.num_steps, 1, False),
+                           greedy_steps(model, enc_inputs, enc_outputs, args.num_steps, 1, True))
+            every_step, once = [
+                timeit(lambda: greedy_steps(model, enc_inputs, enc_outputs, args.num_steps, 1, project_once),
+                       args.repeat)/args.num_steps
+                for project_once in (False, True)]
+        print(f"src_len {src_len:<5}: project every step {every_step*1e3:8.3f}ms/token, "
+              f"project once {once*1e3:8.3f}ms/token ({every_step/once:.2f}x)")
+
+
+def corpus_bleu(pred_seqs, label_seqs, k: int = 2) -> float:
+    """
+    语料库级别的BLEU，输入是词元下标的列表，和TransformerFullVersion/utils.py中的corpus_bleu算法相同
+    """
+    matches, ngrams = [0]*k, [0]*k
+    len_pred = len_label = 0
+    for pred, label in zip(pred_seqs, label_seqs):
+        len_pred, len_label = len_pred+len(pred), len_label+len(label)
+        for n in range(1, k+1):
+            label_subs = collections.Counter(zip(*[label[i:] for i in range(n)]))
+            pred_subs = collections.Counter(zip(*[pred[i:] for i in range(n)]))
+            matches[n-1] += sum((pred_subs & label_subs).values())
+            ngrams[n-1] += max(len(pred)-n+1, 0)
+    if len_pred == 0:
+        return 0.
+    score = math.exp(min(0, 1-len_label/len_pred))
+    for n in range(1, k+1):
+        if ngrams[n-1] == 0:
+            return 0.
+        score *= math.pow(matches[n-1]/ngrams[n-1], math.pow(0.5, n))
+    return score
+
+
+def bench_quantize(args):
+    """
+    fp32和动态int8量化的模型逐句贪心解码同样的随机句子，对比每句的延迟，
+    BLEU以fp32的解码结果作为参考，衡量量化前后的一致程度
+    """
+    model = Transformer(args.vocab_size, args.vocab_size).eval()
+    quantized = quantize_dynamic_int8(model)
+    sentences = [t.randint(1, args.vocab_size, (1, src_len))
+                 for src_len in t.randint(2, max(args.seq_lens)+1, (args.num_sentences,)).tolist()]
+    results = {}
+    for name, m in (("fp32", model), ("int8", quantized)):
+        outputs = []
+        with t.no_grad():
+            start = time.perf_counter()
+            for enc_inputs in sentences:
+                enc_outputs, _ = m.encoder(enc_inputs)
+                outputs.append(greedy_steps(m, enc_inputs, enc_outputs, args.num_steps, 1, True)[0, 1:].tolist())
+            elapsed = (time.perf_counter()-start)/len(sentences)
+        results[name] = (outputs, elapsed)
+    for name, (outputs, elapsed) in results.items():
+        same = sum(a == b for a, b in zip(outputs, results["fp32"][0]))/len(sentences)
+        print(f"{name}: {elapsed*1e3:8.3f}ms/sentence, bleu vs fp32 {corpus_bleu(outputs, results['fp32'][0]):.3f}, "
+              f"same as fp32 {same:.1%}")
+    print(f"speedup {results['fp32'][1]/results['int8'][1]:.2f}x")
+
+
+def count_allocations(fn) -> tuple[int, float]:
+    """
+    用profiler统计fn中分配内存的次数和总大小(MB)
+    """
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0
+             and not e.cpu_children]
+    return len(sizes), sum(sizes)/2**20
+
+
+def bench_masks(args):
+    """
+    不同目标序列长度下解码器一次前向传播(训练时的整句输入)的内存分配和耗时
+    """
+    model = Transformer(args.vocab_size, args.vocab_size).to(args.device).eval()
+    for tgt_len in args.seq_lens:
+        enc_inputs = t.randint(1, args.vocab_size, (args.batch_size, 10), device=args.device)
+        dec_inputs = t.randint(1, args.vocab_size, (args.batch_size, tgt_len), device=args.device)
+        # 最后几个位置是填充
+        dec_inputs[:, -tgt_len//4:] = 0
+        with t.no_grad():
+            enc_outputs, _ = model.encoder(enc_inputs)
+            count, size = count_allocations(lambda: model.decoder(dec_inputs, enc_inputs, enc_outputs))
+            elapsed = timeit(lambda: model.decoder(dec_inputs, enc_inputs, enc_outputs), args.repeat)
+        print(f"tgt_len {tgt_len:<5}: {count:5d} allocations {size:9.1f}MB {elapsed*1e3:9.2f}ms")
+
+
+def _measure_in_child(queue, fn, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = fn(*args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(((after-before)/1024, result))
+
+
+def peak_memory_mb(fn, *args):
+    """
+    在一个新的子进程中运行fn(*args)，返回运行期间常驻内存峰值的增量(MB)和fn的返回值\n
+    CPU上没有类似torch.cuda.max_memory_allocated的接口，所以用子进程的ru_maxrss来近似
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure_in_child, args=(queue, fn, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _sweep_point(config, vocab_size, batch_size, seq_len, repeat):
+    """
+    一组模型配置的参数量、训练和推理的吞吐量(词元/秒)，训练和train.py一样用SGD，推理是增量贪心解码seq_len个词元
+    """
+    t.manual_seed(0)
+    model = Transformer(vocab_size, vocab_size, **config)
+    criterion = t.nn.CrossEntropyLoss(ignore_index=0)
+    optimizer = t.optim.SGD(model.parameters(), lr=1e-3, momentum=0.99)
+    enc_inputs = t.randint(1, vocab_size, (batch_size, seq_len))
+    dec_inputs = t.randint(1, vocab_size, (batch_size, seq_len))
+    dec_outputs = t.randint(1, vocab_size, (batch_size, seq_len))
+
+    def train_step():
+        outputs, _, _, _ = model(enc_inputs, dec_inputs)
+        loss = criterion(outputs, dec_outputs.view(-1))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.train()
+    train_time = timeit(train_step, repeat)
+    model.eval()
+    infer_time = timeit(lambda: greedy_decode(model, enc_inputs, 1, None, seq_len), repeat)
+    num_params = sum(p.numel() for p in model.parameters())
+    return num_params, batch_size*seq_len/train_time, batch_size*seq_len/infer_time
+
+
+def bench_sweep(args):
+    """
+    在宽度(d_model)、深度(n_layers)、头数(n_heads)和序列长度的网格上测量参数量、训练和推理的吞吐量以及内存峰值，
+    结果写到--csv中，d_ff=4*d_model，d_k=d_v=d_model//n_heads，每个点在单独的子进程中运行
+    """
+    fields = ["d_model", "n_layers", "n_heads", "seq_len", "params",
+              "train_tokens_per_sec", "infer_tokens_per_sec", "peak_memory_mb"]
+    with open(args.csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        for width, depth, heads, seq_len in itertools.product(args.widths, args.depths, args.heads, args.seq_lens):
+            config = dict(d_model=width, d_ff=4*width, n_layers=depth, n_heads=heads, d_k=None, d_v=None)
+            memory, (params, train_speed, infer_speed) = peak_memory_mb(
+                _sweep_point, config, args.vocab_size, args.batch_size, seq_len, args.repeat)
+            row = dict(d_model=width, n_layers=depth, n_heads=heads, seq_len=seq_len, params=params,
+                       train_tokens_per_sec=round(train_speed, 1), infer_tokens_per_sec=round(infer_speed, 1),
+                       peak_memory_mb=round(memory, 1))
+            writer.writerow(row)
+            f.flush()
+            print(", ".join(f"{k} {v}" for k, v in row.items()))
+
+
+BENCHMARKS = {
+    "cross_kv": bench_cross_kv,
+    "quantize": bench_quantize,
+    "masks": bench_masks,
+    "incremental": bench_incremental,
+    "sweep": bench_sweep,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=BENCHMARKS)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--vocab_size", type=int, default=200)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num_sentences", type=int, default=50)
+    parser.add_argument("--widths", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 6])
+    parser.add_argument("--heads", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--csv", default="sweep.csv")
+    args = parser.parse_args()
+    args.device = t.device(args.device)
+    t.manual_seed(0)
+    BENCHMARKS[args.name](args)
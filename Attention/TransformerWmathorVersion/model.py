@@ -18,7 +18,7 @@ import numpy as np
 10. Transformer
 """
 
-# Transformer Parameters
+# Transformer Parameters，是各个模块构造函数参数的默认值
 d_model = 512  # Embedding Size
 d_ff = 2048  # FeedForward dimension
 d_k = d_v = 64  # dimension of K(=Q), V
@@ -42,13 +42,13 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer("pe", pe)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, offset=0) -> Tensor:
         """
         X.shape is (seq_len,batch_size,d_model)
-        利用广播机制对于每个batch加上位置编码
+        利用广播机制对于每个batch加上位置编码，x的第一个位置是offset，增量解码的时候用到
         """
         # 直接加上位置编码就可以辣
-        x = x+self.pe[:x.size(0), :]
+        x = x+self.pe[offset:offset+x.size(0), :]
         return self.dropout.forward(x)
 
 
@@ -58,52 +58,87 @@ def get_attn_pad_mask(seq_q: Tensor, seq_k: Tensor,):
     seq_k.shape = (batch_size,seq_len)\n
     seq_len可以src或者是tgt的\n
     在seq_q或者是seq_k中seq_len可能是不相等的\n
+    返回的遮罩shape = (batch_size,1,len_k)，对每个query都一样，使用的时候靠广播，不再扩展成(batch_size,len_q,len_k)
     """
-    batch_size_q, len_q = seq_q.shape
-    batch_size_k, len_k = seq_k.shape
     # eq(zero) is PAD token
     # pad_atten_mask.shap is [batch_size,1,len_k]
     # 元素为True代表有掩膜
     # 这一步是这个函数的核心操作
-    pad_atten_mask = seq_k.data.eq(0).unsqueeze(1)
-    # 增广一下
-    return pad_atten_mask.expand(batch_size_k, len_q, len_k)
+    return seq_k.data.eq(0).unsqueeze(1)
+
+
+# 每个设备上缓存一个上三角矩阵，不同长度的遮罩都是它左上角的切片
+_subsequence_masks = {}
 
 
 def get_attn_subsequence_mask(seq: Tensor):
     """
     seq.shape = (batch_size,seq_len)\n
-    在Decoder中需要用到，使用它来屏蔽未来时刻的单词信息
+    在Decoder中需要用到，使用它来屏蔽未来时刻的单词信息\n
+    返回的遮罩shape = (1,seq_len,seq_len)，dtype是bool，对每个样本都一样，使用的时候靠广播\n
+    遮罩直接在seq所在的设备上构造并缓存起来，长度不够的时候至少翻倍重新构造
     """
-    atten_shape = [seq.size(0), seq.size(1), seq.size(1)]
-    # 上三角矩阵
-    subsequence_mask = np.triu(np.ones(atten_shape), k=1)
-    # 转Tensor
-    subsequence_mask = t.from_numpy(subsequence_mask).byte()
-    # subsequence_mask.shape = (batch_size,seq_len,seq_len)
-    return subsequence_mask
+    seq_len = seq.size(1)
+    mask = _subsequence_masks.get(seq.device)
+    if mask is None or mask.shape[0] < seq_len:
+        size = max(seq_len, 2*mask.shape[0]) if mask is not None else seq_len
+        # 上三角矩阵
+        mask = t.ones((size, size), dtype=t.bool, device=seq.device).triu_(1)
+        _subsequence_masks[seq.device] = mask
+    return mask[:seq_len, :seq_len].unsqueeze(0)
 
 
 class ScaledDotProductAttention(nn.Module):
-    def __init__(self,):
+    def __init__(self, d_k=d_k):
         super().__init__()
+        self.scale = np.sqrt(d_k)
 
     def forward(self, Q: Tensor, K: Tensor, V: Tensor, attn_mask: Tensor):
         """
         Q.shape = (batch_size,num_heads,len_q,d_k)
         K.shape = (batch_size,num_heads,len_k,d_k)
         V.shape = (batch_size,num_heads,len_v(=len_k),d_v)
-        attn_mask.shape = (batch_size,num_heads,seq_len,seq_len)
+        attn_mask.shape = (batch_size,num_heads,seq_len,seq_len)，各个维度都可以是1，靠广播
         """
         # 进行内积并使用负无穷填充遮蔽区域
         # scores.shape = [batch_size,num_heads,len_q,len_k]
-        scores = t.matmul(Q, K.transpose(-1, -2))/np.sqrt(d_k)
+        scores = t.matmul(Q, K.transpose(-1, -2))/self.scale
         scores.masked_fill_(attn_mask, -1e9)
         attn = F.softmax(scores, dim=-1)
         context = t.matmul(attn, V)
         return context, attn
 
 
+class KVCache:
+    """
+    增量解码时一层解码器自注意力的K和V，按max_len预先分配，不够的时候翻倍\n
+    keys.shape = (batch_size,n_heads,max_len,d_k)，values.shape = (batch_size,n_heads,max_len,d_v)
+    """
+
+    def __init__(self, batch_size: int, max_len: int, device=None, dtype=None,
+                 n_heads=n_heads, d_k=d_k, d_v=d_v) -> None:
+        self.keys = t.zeros((batch_size, n_heads, max_len, d_k), device=device, dtype=dtype)
+        self.values = t.zeros((batch_size, n_heads, max_len, d_v), device=device, dtype=dtype)
+        # 已经缓存的位置数
+        self.length = 0
+
+    def append(self, K: Tensor, V: Tensor):
+        """
+        把新位置的K和V写进缓存，返回包括新位置在内的所有K和V(视图)
+        """
+        end = self.length+K.size(2)
+        if end > self.keys.size(2):
+            size = max(end, 2*self.keys.size(2))
+            self.keys = t.cat([self.keys, self.keys.new_zeros(
+                (*self.keys.shape[:2], size-self.keys.size(2), self.keys.size(3)))], 2)
+            self.values = t.cat([self.values, self.values.new_zeros(
+                (*self.values.shape[:2], size-self.values.size(2), self.values.size(3)))], 2)
+        self.keys[:, :, self.length:end] = K
+        self.values[:, :, self.length:end] = V
+        self.length = end
+        return self.keys[:, :, :end], self.values[:, :, :end]
+
+
 class MultiHeadAttention(nn.Module):
     """
     在编码器中、解码器遮蔽自注意力中，编码器-解码器注意力中，我们会用到这些东西\n
@@ -112,39 +147,69 @@ class MultiHeadAttention(nn.Module):
     在编码器-解码器注意力中，就不一样了，QKV分别是dec_outputs,enc_outputs,enc_outputs
     """
 
-    def __init__(self,):
+    def __init__(self, d_model=d_model, n_heads=n_heads, d_k=d_k, d_v=d_v):
         super().__init__()
+        self.d_model, self.n_heads, self.d_k, self.d_v = d_model, n_heads, d_k, d_v
         self.W_Q = nn.Linear(d_model, d_k*n_heads, bias=False)
         self.W_K = nn.Linear(d_model, d_k*n_heads, bias=False)
         self.W_V = nn.Linear(d_model, d_v*n_heads, bias=False)
         # 使用线性层将它们的维度降下来
         self.fc = nn.Linear(n_heads*d_v, d_model, bias=False)
+        # 没有参数，构造一次之后每次前向传播都复用
+        self.attention = ScaledDotProductAttention(d_k)
+        # True时按照修复之前的方式合并多头，只用来运行修复之前训练的权重，见set_legacy_head_merge
+        self.legacy_head_merge = False
 
-    def forward(self, input_Q: Tensor, input_K: Tensor, input_V: Tensor, attn_mask: Tensor):
+    def new_cache(self, batch_size: int, max_len: int, device=None, dtype=None) -> KVCache:
+        """
+        为增量解码创建一个和这个注意力形状匹配的KVCache
+        """
+        return KVCache(batch_size, max_len, device, dtype, self.n_heads, self.d_k, self.d_v)
+
+    def project_kv(self, input_K: Tensor, input_V: Tensor):
+        """
+        把K和V投影并切分成多头，K.shape = (batch_size,n_heads,len_k,d_k)，V.shape = (batch_size,n_heads,len_v,d_v)\n
+        编码器-解码器注意力的K和V在解码时不变，可以提前算好传给forward
+        """
+        batch_size = input_K.size(0)
+        K = self.W_K.forward(input_K).view(
+            batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+        V = self.W_V.forward(input_V).view(
+            batch_size, -1, self.n_heads, self.d_v).transpose(1, 2)
+        return K, V
+
+    def forward(self, input_Q: Tensor, input_K: Tensor, input_V: Tensor, attn_mask: Tensor, kv=None,
+                cache: KVCache = None):
         """
         Q.shape = (batch_size,len_q,d_k)
         K.shape = (batch_size,len_k,d_k)
         V.shape = (batch_size,len_v(=len_k),d_v)
-        attn_mask.shape = (batch_size,seq_len,seq_len)
+        attn_mask.shape = (batch_size,seq_len,seq_len)，可以是能广播成这个形状的遮罩
+        kv是project_kv的结果，给出的时候就不再投影input_K和input_V\n
+        cache是增量解码的自注意力缓存，input_K和input_V只有新的位置，投影之后和缓存中之前的位置拼在一起
         """
         residual, batch_size = input_Q, input_Q.size(0)
         # 投影->切片->转置
         Q = self.W_Q.forward(input_Q).view(
-            batch_size, -1, n_heads, d_k).transpose(1, 2)
-        K = self.W_K.forward(input_K).view(
-            batch_size, -1, n_heads, d_k).transpose(1, 2)
-        V = self.W_V.forward(input_V).view(
-            batch_size, -1, n_heads, d_v).transpose(1, 2)
-        # 获取注意力遮罩,对于每个注意力头我们都有一样的遮罩，所以需要复制
-        attn_mask = attn_mask.unsqueeze(1).repeat(1, n_heads, 1, 1)
+            batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+        K, V = self.project_kv(input_K, input_V) if kv is None else kv
+        if cache is not None:
+            K, V = cache.append(K, V)
+        # 获取注意力遮罩,对于每个注意力头我们都有一样的遮罩，插入一个头的维度靠广播，不复制
+        attn_mask = attn_mask.unsqueeze(1)
         # 获取Attention结果
         # context.shape = (batch_size,n_heads,len_q,d_v)
         # attn.shape = (batch_size,n_heads,len_q,len_k)
-        context, attn = ScaledDotProductAttention().forward(Q, K, V, attn_mask)
-        # 还原维度
-        context = context.reshape(batch_size, -1, n_heads*d_v)
+        context, attn = self.attention.forward(Q, K, V, attn_mask)
+        # 还原维度，先把头的维度换回去再合并，否则不同位置的结果会混在一起
+        if self.legacy_head_merge:
+            if cache is not None:
+                raise ValueError("legacy_head_merge mixes positions across heads and cannot use a KVCache")
+            context = context.reshape(batch_size, -1, self.n_heads*self.d_v)
+        else:
+            context = context.transpose(1, 2).reshape(batch_size, -1, self.n_heads*self.d_v)
         output = self.fc.forward(context)
-        return F.layer_norm(output+residual, (d_model,)), attn
+        return F.layer_norm(output+residual, (self.d_model,)), attn
 
 
 class FeedForwardNet(nn.Module):
@@ -152,8 +217,9 @@ class FeedForwardNet(nn.Module):
     简单的线性层加上残差连接和LayerNorm
     """
 
-    def __init__(self,):
+    def __init__(self, d_model=d_model, d_ff=d_ff):
         super().__init__()
+        self.d_model = d_model
         self.fc = nn.Sequential(
             nn.Linear(d_model, d_ff, bias=False),
             nn.ReLU(),
@@ -166,7 +232,7 @@ class FeedForwardNet(nn.Module):
         """
         residual = inputs
         output = self.fc.forward(inputs)
-        return F.layer_norm(output+residual, (d_model,))
+        return F.layer_norm(output+residual, (self.d_model,))
 
 
 class EncodreLayer(nn.Module):
@@ -174,10 +240,10 @@ class EncodreLayer(nn.Module):
     一个编码器层，它包含一个多头自注意力模块和一个前馈神经网络，注意里面有LayerNorm和残差连接
     """
 
-    def __init__(self,):
+    def __init__(self, d_model=d_model, d_ff=d_ff, n_heads=n_heads, d_k=d_k, d_v=d_v):
         super().__init__()
-        self.enc_self_attn = MultiHeadAttention()
-        self.ffn = FeedForwardNet()
+        self.enc_self_attn = MultiHeadAttention(d_model, n_heads, d_k, d_v)
+        self.ffn = FeedForwardNet(d_model, d_ff)
 
     def forward(self, enc_inputs: Tensor, enc_self_attn_mask: Tensor):
         """
@@ -198,11 +264,12 @@ class Encoder(nn.Module):
     编码器，它包含一嵌入层（负责将输入语句转换成嵌入向量），一个位置编码，还有n个编码器层
     """
 
-    def __init__(self, src_vocab_size):
+    def __init__(self, src_vocab_size, d_model=d_model, d_ff=d_ff, n_layers=n_layers, n_heads=n_heads,
+                 d_k=d_k, d_v=d_v):
         super().__init__()
         self.src_emb = nn.Embedding(src_vocab_size, d_model)
         self.pos_emb = PositionalEncoding(d_model)
-        self.layers = nn.ModuleList([EncodreLayer() for _ in range(n_layers)])
+        self.layers = nn.ModuleList([EncodreLayer(d_model, d_ff, n_heads, d_k, d_v) for _ in range(n_layers)])
 
     def forward(self, enc_inputs: Tensor):
         """
@@ -233,25 +300,28 @@ class DecoderLayer(nn.Module):
     解码器的层，注意到它的MHA输入包含了编码器的输出
     """
 
-    def __init__(self,):
+    def __init__(self, d_model=d_model, d_ff=d_ff, n_heads=n_heads, d_k=d_k, d_v=d_v):
         super(DecoderLayer, self).__init__()
-        self.dec_self_attn = MultiHeadAttention()
-        self.dec_enc_attn = MultiHeadAttention()
-        self.ffn = FeedForwardNet()
+        self.dec_self_attn = MultiHeadAttention(d_model, n_heads, d_k, d_v)
+        self.dec_enc_attn = MultiHeadAttention(d_model, n_heads, d_k, d_v)
+        self.ffn = FeedForwardNet(d_model, d_ff)
 
-    def forward(self, dec_inputs: Tensor, enc_outputs: Tensor, dec_self_attn_mask: Tensor, dec_enc_attn_mask: Tensor):
+    def forward(self, dec_inputs: Tensor, enc_outputs: Tensor, dec_self_attn_mask: Tensor, dec_enc_attn_mask: Tensor,
+                enc_kv=None, cache: KVCache = None):
         """
         dec_inputs.shape = (batch_size,tgt_len,d_model)
         enc_outputs.shape = (batch_size,src_len,d_model)
         dec_self_attn_mask.shape = (batch_size,tgt_len,tgt_len)
         dec_enc_attn_mask.shape = (batch_size, tgt_len,src_len)
+        enc_kv是dec_enc_attn提前投影好的编码器输出(K,V)
+        cache是这一层自注意力的KVCache，增量解码的时候dec_inputs只有新的位置
         """
         # 自注意力
         dec_outputs, dec_self_attn = self.dec_self_attn.forward(
-            dec_inputs, dec_inputs, dec_inputs, dec_self_attn_mask)
+            dec_inputs, dec_inputs, dec_inputs, dec_self_attn_mask, cache=cache)
         # 编码器解码器注意力
         dec_outputs, dec_enc_attn = self.dec_enc_attn.forward(
-            dec_outputs, enc_outputs, enc_outputs, dec_enc_attn_mask)
+            dec_outputs, enc_outputs, enc_outputs, dec_enc_attn_mask, enc_kv)
         # 通过FFN
         dec_outputs = self.ffn.forward(dec_outputs)
         return dec_outputs, dec_self_attn, dec_enc_attn
@@ -264,43 +334,77 @@ class Decoder(nn.Module):
     ，而且为了防止GT泄露进行上三角矩阵的遮罩
     """
 
-    def __init__(self, tgt_vocab_size):
+    def __init__(self, tgt_vocab_size, d_model=d_model, d_ff=d_ff, n_layers=n_layers, n_heads=n_heads,
+                 d_k=d_k, d_v=d_v):
         super(Decoder, self).__init__()
         self.tgt_emb = nn.Embedding(tgt_vocab_size, d_model)
         self.pos_emb = PositionalEncoding(d_model)
-        self. layers = nn.ModuleList([DecoderLayer() for _ in range(n_layers)])
+        self. layers = nn.ModuleList([DecoderLayer(d_model, d_ff, n_heads, d_k, d_v) for _ in range(n_layers)])
 
-    def forward(self, dec_inputs: Tensor, enc_inputs: Tensor, enc_outpus: Tensor):
+    def init_state(self, enc_outputs: Tensor):
+        """
+        逐词解码的时候编码器的输出不变，每一层的编码器-解码器注意力的K和V只需要投影一次，
+        把返回的列表作为enc_kvs传给forward
+        """
+        return [layer.dec_enc_attn.project_kv(enc_outputs, enc_outputs) for layer in self.layers]
+
+    def new_caches(self, batch_size: int, max_len: int, device=None, dtype=None):
+        """
+        为增量解码给每一层创建一个自注意力的KVCache，把返回的列表作为caches传给forward
+        """
+        return [layer.dec_self_attn.new_cache(batch_size, max_len, device, dtype) for layer in self.layers]
+
+    def forward(self, dec_inputs: Tensor, enc_inputs: Tensor, enc_outpus: Tensor, enc_kvs=None, caches=None):
         """
         dec_inputs.shape = (batch_size,tgt_len)
         enc_inputs.shape = (batch_size,src_len)
         enc_outputs.shape = (batch_size,src_len,d_model)
+        enc_kvs是init_state的结果\n
+        caches是new_caches的结果，给出的时候只计算缓存中还没有的位置，
+        dec_inputs仍然是完整的前缀(用来计算填充的遮罩)，返回的结果只有新的位置
         """
-        dec_outputs = self.tgt_emb.forward(dec_inputs)
+        start = 0 if caches is None else caches[0].length
+        dec_outputs = self.tgt_emb.forward(dec_inputs[:, start:])
         dec_outputs = self.pos_emb.forward(
-            dec_outputs.transpose(0, 1)).transpose(1, 0)
+            dec_outputs.transpose(0, 1), start).transpose(1, 0)
         # 求selfAttn的mask，这里要加上子序列的mask防止GT暴露
         dec_self_attn_pad_mask = get_attn_pad_mask(dec_inputs, dec_inputs)
-        dec_self_attn_subsequence_mask = get_attn_subsequence_mask(dec_inputs)
-        dec_self_attn_mask = t.gt(
-            (dec_self_attn_pad_mask+dec_self_attn_subsequence_mask), 0)
+        # 只取新的位置对应的行
+        dec_self_attn_subsequence_mask = get_attn_subsequence_mask(dec_inputs)[:, start:]
+        # (batch_size,1,tgt_len)和(1,tgt_len,tgt_len)广播成(batch_size,tgt_len,tgt_len)
+        dec_self_attn_mask = dec_self_attn_pad_mask | dec_self_attn_subsequence_mask
         # 对于dec和enc求一个mask
         dec_enc_attn_mask = get_attn_pad_mask(dec_inputs, enc_inputs)
 
         dec_self_attns, dec_enc_attns = [], []
-        for layer in self.layers:
+        if enc_kvs is None:
+            enc_kvs = [None]*len(self.layers)
+        if caches is None:
+            caches = [None]*len(self.layers)
+        for layer, enc_kv, cache in zip(self.layers, enc_kvs, caches):
             dec_outputs, dec_self_attn, dec_enc_attn = layer.forward(
-                dec_outputs, enc_outpus, dec_self_attn_mask, dec_enc_attn_mask)
+                dec_outputs, enc_outpus, dec_self_attn_mask, dec_enc_attn_mask, enc_kv, cache)
             dec_self_attns.append(dec_self_attn)
             dec_enc_attns.append(dec_enc_attn)
         return dec_outputs, dec_self_attns, dec_enc_attns
 
 
 class Transformer(nn.Module):
-    def __init__(self, src_vocab_size, tgt_vocab_size):
+    """
+    模型的大小都由构造函数的参数决定，默认值是文件开头的全局参数，
+    d_k和d_v为None时取d_model//n_heads，例如:\n
+    Transformer(src_vocab_size, tgt_vocab_size, d_model=256, d_ff=1024, n_layers=4, n_heads=4)\n
+    也可以把一个配置字典展开传进来: Transformer(src_vocab_size, tgt_vocab_size, **config)
+    """
+
+    def __init__(self, src_vocab_size, tgt_vocab_size, d_model=d_model, d_ff=d_ff, n_layers=n_layers,
+                 n_heads=n_heads, d_k=d_k, d_v=d_v):
         super().__init__()
-        self.encoder = Encoder(src_vocab_size)
-        self.decoder = Decoder(tgt_vocab_size)
+        d_k = d_model//n_heads if d_k is None else d_k
+        d_v = d_model//n_heads if d_v is None else d_v
+        self.config = dict(d_model=d_model, d_ff=d_ff, n_layers=n_layers, n_heads=n_heads, d_k=d_k, d_v=d_v)
+        self.encoder = Encoder(src_vocab_size, **self.config)
+        self.decoder = Decoder(tgt_vocab_size, **self.config)
         self.projection = nn.Linear(d_model, tgt_vocab_size, bias=False)
 
     def forward(self, enc_inputs: Tensor, dec_inputs: Tensor):
@@ -316,3 +420,55 @@ class Transformer(nn.Module):
         dec_logits = self.projection.forward(dec_outputs)
 
         return dec_logits.view(-1, dec_logits.size(-1)), enc_self_attns, dec_self_attns, dec_enc_attns
+
+
+def greedy_decode(model: Transformer, enc_inputs: Tensor, start_symbol: int, end_symbol=None, max_len=50):
+    """
+    批量的增量贪心解码，编码器-解码器注意力的K和V只投影一次，自注意力的K和V缓存在KVCache中，
+    每一步只计算新的词元\n
+    enc_inputs.shape = (batch_size,src_len)，可以在任意设备上\n
+    每个句子解码出end_symbol之后就结束，之后的位置填充0(P)，所有句子都结束或者解码了max_len个词元就停止，
+    end_symbol为None时固定解码max_len个词元\n
+    返回(batch_size,解码的步数+1)的词元，第一列是start_symbol
+    """
+    with t.no_grad():
+        enc_outputs, _ = model.encoder(enc_inputs)
+        enc_kvs = model.decoder.init_state(enc_outputs)
+        caches = model.decoder.new_caches(enc_inputs.size(0), max_len, enc_inputs.device, enc_outputs.dtype)
+        dec_inputs = t.full((enc_inputs.size(0), 1), start_symbol,
+                            dtype=enc_inputs.dtype, device=enc_inputs.device)
+        finished = t.zeros(enc_inputs.size(0), dtype=t.bool, device=enc_inputs.device)
+        for _ in range(max_len):
+            dec_outputs, _, _ = model.decoder(dec_inputs, enc_inputs, enc_outputs, enc_kvs, caches)
+            next_word = model.projection(dec_outputs[:, -1]).argmax(dim=-1)
+            # 已经结束的句子填充0，和原来逐句解码时不再往后解码的效果一样
+            next_word = next_word.masked_fill(finished, 0)
+            dec_inputs = t.cat([dec_inputs, next_word.unsqueeze(1)], -1)
+            if end_symbol is not None:
+                finished |= next_word == end_symbol
+                if finished.all():
+                    break
+    return dec_inputs
+
+
+def quantize_dynamic_int8(model: Transformer) -> Transformer:
+    """
+    返回model的一个动态int8量化的副本，只用于CPU上的推理，原来的model不变\n
+    多头注意力的W_Q、W_K、W_V、fc，FeedForwardNet和projection这些nn.Linear的权重量化成int8，
+    激活在运行时动态量化，嵌入层和注意力的矩阵乘法仍然是fp32
+    """
+    return t.ao.quantization.quantize_dynamic(model, {nn.Linear}, t.qint8).eval()
+
+
+def set_legacy_head_merge(model: nn.Module, enabled=True) -> nn.Module:
+    """
+    以前的MultiHeadAttention没有把头的维度换回去就直接reshape合并多头，
+    (batch_size,n_heads,len_q,d_v)被当成了(batch_size,len_q,n_heads*d_v)，不同位置的结果混在一起，
+    解码器的输出会依赖后面的词元\n
+    修复之后同样的权重输出不一样，修复之前训练的权重需要打开这个开关才能得到原来的输出，
+    这时不能使用KVCache，greedy_decode会报错，需要重新训练才能用增量解码
+    """
+    for m in model.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.legacy_head_merge = enabled
+    return model
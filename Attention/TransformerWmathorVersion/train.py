@@ -1,5 +1,5 @@
-from model import Transformer
-from datasets import loader, tgt_vocab, idx2word
+from model import Transformer, greedy_decode
+from datasets import loader, tgt_vocab, idx2word, tgt_len
 
 import torch as t
 import torch.optim as optim
@@ -28,40 +28,14 @@ for epoch in range(30):
         optimizer.step()
 
 
-def greedy_decoder(model, enc_input, start_symbol):
-    """
-    For simplicity, a Greedy Decoder is Beam search when K=1. This is necessary for inference as we don't know the
-    target sequence input. Therefore we try to generate the target input word by word, then feed it into the transformer.
-    Starting Reference: http://nlp.seas.harvard.edu/2018/04/03/attention.html#greedy-decoding
-    :param model: Transformer Model
-    :param enc_input: The encoder input
-    :param start_symbol: The start symbol. In this example it is 'S' which corresponds to index 4
-    :return: The target input
-    """
-    enc_outputs, enc_self_attns = model.encoder(enc_input)
-    dec_input = t.zeros(1, 0).type_as(enc_input.data)
-    terminal = False
-    next_symbol = start_symbol
-    while not terminal:
-        dec_input = t.cat([dec_input.detach(), t.tensor(
-            [[next_symbol]], dtype=enc_input.dtype).cuda()], -1)
-        dec_outputs, _, _ = model.decoder(dec_input, enc_input, enc_outputs)
-        projected = model.projection(dec_outputs)
-        prob = projected.squeeze(0).max(dim=-1, keepdim=False)[1]
-        next_word = prob.data[-1]
-        next_symbol = next_word
-        if next_symbol == tgt_vocab["."]:
-            terminal = True
-        print(next_word)
-    return dec_input
-
-
 # Test
+model.eval()
 enc_inputs, _, _ = next(iter(loader))
-# enc_inputs = enc_inputs.cuda()
+# 所有句子一起增量解码，解码出"."就结束，最多解码tgt_len个词元
+greedy_dec_inputs = greedy_decode(
+    model, enc_inputs, start_symbol=tgt_vocab["S"], end_symbol=tgt_vocab["."], max_len=tgt_len)
 for i in range(len(enc_inputs)):
-    greedy_dec_input = greedy_decoder(
-        model, enc_inputs[i].view(1, -1), start_symbol=tgt_vocab["S"])
-    predict, _, _, _ = model(enc_inputs[i].view(1, -1), greedy_dec_input)
-    predict = predict.data.max(1, keepdim=True)[1]
-    print(enc_inputs[i], '->', [idx2word[n.item()] for n in predict.squeeze()])
+    predict = greedy_dec_inputs[i, 1:].tolist()
+    if tgt_vocab["."] in predict:
+        predict = predict[:predict.index(tgt_vocab["."])+1]
+    print(enc_inputs[i], '->', [idx2word[n] for n in predict])
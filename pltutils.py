@@ -9,6 +9,7 @@ import torch
 import torchvision as tv
 import torchvision.transforms as transforms
 import torch.utils.data as data
+import torch.utils.checkpoint
 import random
 import os
 import requests
@@ -771,20 +772,106 @@ def tokenize_nmt(text: str, num_examples=None):
     return source, target
 
 
+def flatten_lines(lines, vocab):
+    """
+    把所有文本序列的词元下标拼接成一维，每个序列末尾追加<eos>，同时返回每个序列的起止位置offsets
+    """
+    get, unk, eos = vocab.token_to_idx.get, vocab.unk, vocab["<eos>"]
+    flat_ids, offsets = [], [0]
+    for l in lines:
+        flat_ids.extend([get(token, unk) for token in l])
+        flat_ids.append(eos)
+        offsets.append(len(flat_ids))
+    return torch.tensor(flat_ids, dtype=torch.long), torch.tensor(offsets, dtype=torch.long)
+
+
+def pad_from_offsets(flat_ids: torch.Tensor, offsets: torch.Tensor, num_steps, padding_token):
+    """
+    批量截断或者填充：一次性散射到预先分配的(num_lines, num_steps)张量中，有效长度由offsets计算
+    """
+    lengths = offsets[1:] - offsets[:-1]
+    num_lines = lengths.shape[0]
+    rows = torch.repeat_interleave(torch.arange(num_lines), lengths)
+    cols = torch.arange(flat_ids.shape[0]) - \
+        torch.repeat_interleave(offsets[:-1], lengths)
+    keep = cols < num_steps
+    array = torch.full((num_lines, num_steps), padding_token, dtype=torch.long)
+    array[rows[keep], cols[keep]] = flat_ids[keep]
+    # 原来的(array != pad).type(torch.int32).sum(1)在求和时会提升成int64，这里保持int64
+    return array, lengths.clamp(max=num_steps).to(torch.int64)
+
+
 def build_array_nmt(lines, vocab, num_steps):
     """
     将文本序列转换成小批量
     """
-    lines = [vocab[l] for l in lines]
-    lines = [l+[vocab["<eos>"]] for l in lines]
-    array = torch.tensor(
-        [truncate_pad(l, num_steps, vocab["<pad>"]) for l in lines])
-    valid_len = (array != vocab["<pad>"]).type(torch.int32).sum(1)
-    return array, valid_len
+    flat_ids, offsets = flatten_lines(lines, vocab)
+    return pad_from_offsets(flat_ids, offsets, num_steps, vocab["<pad>"])
+
+
+class BucketBatchSampler(data.Sampler):
+    """
+    按长度分桶的批量采样器，每个批量满足 批量大小*批量内最长句子长度 <= max_tokens\n
+    每个epoch打乱等长句子和批量的顺序，padding_ratio是当前epoch中填充词元的比例
+    """
+
+    def __init__(self, src_valid_len: torch.Tensor, tgt_valid_len: torch.Tensor, max_tokens, shuffle=True):
+        self.src_valid_len = src_valid_len.tolist()
+        self.tgt_valid_len = tgt_valid_len.tolist()
+        self.lengths = torch.maximum(src_valid_len, tgt_valid_len)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        n = self.lengths.shape[0]
+        perm = torch.randperm(n) if self.shuffle else torch.arange(n)
+        order = perm[torch.sort(self.lengths[perm], stable=True)[1]].tolist()
+        lengths = self.lengths.tolist()
+        batches, batch = [], []
+        for idx in order:
+            if batch and lengths[idx]*(len(batch)+1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        num_padded, num_valid = 0, 0
+        for batch in batches:
+            src = [self.src_valid_len[i] for i in batch]
+            tgt = [self.tgt_valid_len[i] for i in batch]
+            num_padded += len(batch)*(max(src)+max(tgt))
+            num_valid += sum(src)+sum(tgt)
+        self.padding_ratio = 1-num_valid/num_padded if num_padded else 0.
+        return batches
+
+    def __iter__(self):
+        if self.shuffle:
+            self.batches = self._make_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def trim_collate(batch):
+    """堆叠成批量，只填充到批量内最长的有效长度"""
+    X, X_valid_len, Y, Y_valid_len = [torch.stack(x) for x in zip(*batch)]
+    return X[:, :X_valid_len.max()], X_valid_len, Y[:, :Y_valid_len.max()], Y_valid_len
 
 
-def load_data_nmt(batch_size, num_steps, num_examples=600):
-    """返回翻译数据集的迭代器和词表"""
+def load_bucketed_array(data_arrays, max_tokens, is_train=True):
+    """构造按长度分桶的数据迭代器"""
+    dataset = data.TensorDataset(*data_arrays)
+    sampler = BucketBatchSampler(
+        data_arrays[1], data_arrays[3], max_tokens, shuffle=is_train)
+    return data.DataLoader(dataset, batch_sampler=sampler, collate_fn=trim_collate)
+
+
+def load_data_nmt(batch_size, num_steps, num_examples=600, max_tokens=None):
+    """返回翻译数据集的迭代器和词表，给定max_tokens时按长度分桶(此时batch_size不起作用)"""
     text = preprocess_nmt(read_data_nmt())
     source, target = tokenize_nmt(text, num_examples)
     src_vocab = Vocab(source, min_freq=2,
@@ -794,7 +881,10 @@ def load_data_nmt(batch_size, num_steps, num_examples=600):
     src_array, src_valid_len = build_array_nmt(source, src_vocab, num_steps)
     tgt_array, tgt_valid_len = build_array_nmt(target, tgt_vocab, num_steps)
     data_arrays = (src_array, src_valid_len, tgt_array, tgt_valid_len)
-    data_iter = load_array(data_arrays, batch_size)
+    if max_tokens:
+        data_iter = load_bucketed_array(data_arrays, max_tokens)
+    else:
+        data_iter = load_array(data_arrays, batch_size)
     return data_iter, src_vocab, tgt_vocab
 
 
@@ -828,19 +918,25 @@ def sequence_mask(X: torch.Tensor, valid_len: torch.Tensor, value=0):
     return X
 
 
+def valid_lens_mask(valid_lens: torch.Tensor, num_kvs):
+    """
+    由有效长度构造可以广播的遮蔽，True代表需要遮蔽的位置\n
+    valid_lens.shape = (batch,) 或者 (batch, num_queries)，返回 (batch, 1 或 num_queries, num_kvs)
+    """
+    positions = torch.arange(num_kvs, device=valid_lens.device)
+    if valid_lens.dim() == 1:
+        return positions >= valid_lens[:, None, None]
+    return positions >= valid_lens[:, :, None]
+
+
 def masked_softmax(X: torch.Tensor, valid_lens: torch.Tensor):
 
     if valid_lens is None:
         return F.softmax(X, dim=-1)
-    else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            valid_lens = torch.repeat_interleave(valid_lens, shape[1])
-        else:
-            valid_lens = valid_lens.reshape(-1)
-        # 最后一个轴上被这比的元素使用一个非常大的肤质来替换，是softmax输出为0
-        X = sequence_mask(X.reshape(-1, shape[-1]), valid_lens, value=-1e6)
-        return F.softmax(X.reshape(shape), dim=-1)
+    # 遮蔽通过广播作用到每个查询上，不修改输入的X
+    # 最后一个轴上被遮蔽的元素使用一个非常大的负值来替换，使softmax输出为0，有效长度为0的行得到均匀分布
+    mask = valid_lens_mask(valid_lens, X.shape[-1])
+    return F.softmax(X.masked_fill(mask, -1e6), dim=-1)
 
 
 class Encoder(nn.Module):
@@ -851,6 +947,15 @@ class Encoder(nn.Module):
         raise NotImplementedError
 
 
+def reorder_state(state, index: torch.Tensor, dim=0):
+    """在dim维上按照index挑选状态，状态可以是嵌套的list/tuple，None保持不变"""
+    if isinstance(state, torch.Tensor):
+        return state.index_select(dim, index)
+    if isinstance(state, (list, tuple)):
+        return type(state)(reorder_state(s, index, dim) for s in state)
+    return state
+
+
 class Decoder(nn.Module):
     def __init__(self, **kwargs):
         super(Decoder, self).__init__(**kwargs)
@@ -861,6 +966,13 @@ class Decoder(nn.Module):
     def forward(self, X: torch.Tensor, state):
         raise NotImplementedError
 
+    def reorder_state(self, state, index: torch.Tensor):
+        """
+        束搜索用来在批量维度上重新排列状态，默认状态中所有张量的第0维都是批量\n
+        RNN的隐状态形状是(num_layers, batch_size, num_hiddens)，这种解码器需要重写这个函数，比如Seq2SeqDecoder
+        """
+        return reorder_state(state, index)
+
 
 class EncoderDecoder(nn.Module):
     def __init__(self, encoder: Encoder, decoder: Decoder, **kwargs):
@@ -879,15 +991,23 @@ class EncoderDecoder(nn.Module):
 
 # 加性注意力
 class AdditiveAttention(nn.Module):
-    def __init__(self, key_size, query_size, num_hiddens, dropout, **kwargs):
+    """
+    加性注意力，chunk_size不为None时按照键的分块计算分数，
+    (batch_size, num_queries, num_kvs, num_hiddens)的中间结果最多只有chunk_size个键那么大\n
+    每个分数只依赖一个键，所以分块之后前向的输出和键、W_k的梯度都和不分块完全一致；
+    查询、W_q和w_v的梯度要在所有的键上求和，分块之后变成先在块内求和再把各块累加，
+    加法的顺序不同，只在浮点舍入误差的范围内一致
+    """
+
+    def __init__(self, key_size, query_size, num_hiddens, dropout, chunk_size=None, **kwargs):
         super().__init__(**kwargs)
         self.W_k = nn.Linear(key_size, num_hiddens, bias=False)
         self.W_q = nn.Linear(query_size, num_hiddens, bias=False)
         self.w_v = nn.Linear(num_hiddens, 1, bias=False)
         self.dropout = nn.Dropout(dropout)
+        self.chunk_size = chunk_size
 
-    def forward(self, queries, keys, values, valid_lens):
-        queries, keys = self.W_q.forward(queries), self.W_k.forward(keys)
+    def _scores(self, queries, keys):
         # 维度扩展之后，
         # queries.shape = batch_size, num_queries, 1, num_hidden
         # key.shape = batch_size, 1, num_kvs , num_hiddens
@@ -896,21 +1016,75 @@ class AdditiveAttention(nn.Module):
         features = torch.tanh(features)
         # self.w_v只有一个输出，因此从形状中移除最后的那个维度
         # socres.shape = batch_size, num_queries, num_kvs
-        scores = self.w_v.forward(features).squeeze(-1)
+        return self.w_v.forward(features).squeeze(-1)
+
+    def project_keys(self, keys):
+        """
+        预先计算W_k(keys)，逐步解码时键在整个源序列批量上都不变，
+        把结果作为projected_keys传给forward就不需要每一步都重新投影
+        """
+        return self.W_k.forward(keys)
+
+    def forward(self, queries, keys, values, valid_lens, projected_keys=None):
+        queries = self.W_q.forward(queries)
+        keys = self.project_keys(keys) if projected_keys is None else projected_keys
+        if self.chunk_size is None or keys.shape[1] <= self.chunk_size:
+            scores = self._scores(queries, keys)
+        else:
+            # 逐块计算分数再拼接起来，需要梯度时用checkpoint在反向传播中重算每一块，
+            # 这样也不会为了反向传播保存完整的features
+            chunks = []
+            for i in range(0, keys.shape[1], self.chunk_size):
+                key_chunk = keys[:, i:i+self.chunk_size]
+                if torch.is_grad_enabled() and (queries.requires_grad or key_chunk.requires_grad):
+                    chunks.append(torch.utils.checkpoint.checkpoint(
+                        self._scores, queries, key_chunk, use_reentrant=False))
+                else:
+                    chunks.append(self._scores(queries, key_chunk))
+            scores = torch.cat(chunks, dim=-1)
         self.attention_weights = masked_softmax(scores, valid_lens)
         return torch.bmm(self.dropout(self.attention_weights), values)
 
 
 class DotProductAttention(nn.Module):
-    def __init__(self, dropout, **kwargs):
+    """
+    缩放点积注意力，backend="sdpa"并且不需要注意力权重时使用融合的F.scaled_dot_product_attention
+    """
+
+    def __init__(self, dropout, backend="math", **kwargs):
         super().__init__(**kwargs)
         self.dropout = nn.Dropout(dropout)
+        self.backend = backend
+        self.need_weights = False
 
     def forward(self, queries, keys, values, valid_lens=None):
+        # 输入可以是(batch, 个数, d)或者多头的(batch, num_heads, 个数, d)
+        # valid_lens是有效长度或者已经构造好的bool遮蔽(True代表遮蔽)
+        if valid_lens is not None and valid_lens.dtype != torch.bool:
+            valid_lens = valid_lens_mask(valid_lens, keys.shape[-2])
+        if self.backend == "sdpa" and not self.need_weights:
+            # attn_mask中True代表参与注意力计算
+            self.attention_weights = None
+            return F.scaled_dot_product_attention(
+                queries, keys, values, None if valid_lens is None else ~valid_lens,
+                dropout_p=self.dropout.p if self.training else 0.)
         d = queries.shape[-1]
-        scores = torch.bmm(queries, keys.transpose(1, 2))/math.sqrt(d)
-        self.attention_weights = masked_softmax(scores, valid_lens)
-        return torch.bmm(self.dropout(self.attention_weights), values)
+        # scores是临时张量，原地缩放和遮蔽，和masked_softmax的结果一样
+        scores = torch.matmul(queries, keys.transpose(-2, -1)).div_(math.sqrt(d))
+        if valid_lens is not None:
+            scores.masked_fill_(valid_lens, -1e6)
+        attention_weights = F.softmax(scores, dim=-1)
+        # 多头的权重保存成(batch*num_heads, num_queries, num_kvs)，和原来的形状一样
+        self.attention_weights = attention_weights.flatten(0, -3)
+        return torch.matmul(self.dropout(attention_weights), values)
+
+
+def set_attention_backend(net: nn.Module, backend):
+    """把net中所有的DotProductAttention切换到backend("math"或者"sdpa")"""
+    for m in net.modules():
+        if isinstance(m, DotProductAttention):
+            m.backend = backend
+    return net
 
 
 class Seq2SeqEncoder(Encoder):
@@ -933,6 +1107,31 @@ class Seq2SeqEncoder(Encoder):
         return output, state
 
 
+class Seq2SeqDecoder(Decoder):
+    def __init__(self, vocab_size, embed_size, num_hiddens, num_layers, dropout=0, **kwargs):
+        super().__init__(**kwargs)
+        self.embedding = nn.Embedding(vocab_size, embed_size)
+        self.rnn = nn.GRU(embed_size+num_hiddens, num_hiddens, num_layers, dropout=dropout)
+        self.dense = nn.Linear(num_hiddens, vocab_size)
+
+    def init_state(self, enc_outputs, *args):
+        return enc_outputs[1]
+
+    def forward(self, X: torch.Tensor, state: torch.Tensor):
+        X = self.embedding.forward(X).permute(1, 0, 2)
+        # 复制上下文信息，对于每个时间步我们都有一样的上下文
+        context = state[-1].repeat(X.shape[0], 1, 1)
+        X_and_context = torch.cat((X, context), 2)
+        output, state = self.rnn.forward(X_and_context, state)
+        output = self.dense.forward(output).permute(1, 0, 2)
+        # state.shape = [num_layers,batch_size,num_hiddens]
+        return output, state
+
+    def reorder_state(self, state, index: torch.Tensor):
+        # 隐状态的批量在第1维
+        return reorder_state(state, index, dim=1)
+
+
 def train_seq2seq(net: nn.Module, data_iter, lr, num_epochs, tgt_vocab, device: t.device):
 
     def xavier_init_weights(m: nn.Module):
@@ -1034,26 +1233,247 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps,
     return ' '.join(tgt_vocab.to_tokens(output_seq)), attention_weight_seq
 
 
-def bleu(pred_seq, label_seq, k):  # @save
-    """计算BLEU"""
-    pred_tokens, label_tokens = pred_seq.split(' '), label_seq.split(' ')
-    len_pred, len_label = len(pred_tokens), len(label_tokens)
+def build_src_batch(src_sentences, src_vocab, num_steps, device):
+    """
+    把一组源语言句子填充成一个批量，返回enc_X和有效长度
+    """
+    src_tokens = [src_vocab[s.lower().split(' ')] + [src_vocab['<eos>']]
+                  for s in src_sentences]
+    enc_valid_len = t.tensor([len(l) for l in src_tokens], device=device)
+    enc_X = t.tensor([truncate_pad(l, num_steps, src_vocab['<pad>']) for l in src_tokens],
+                     dtype=t.long, device=device)
+    return enc_X, enc_valid_len
+
+
+def _to_translation(pred: list, tgt_vocab) -> str:
+    # 截掉<eos>之后的部分
+    eos = tgt_vocab['<eos>']
+    if eos in pred:
+        pred = pred[:pred.index(eos)]
+    return ' '.join(tgt_vocab.to_tokens(pred))
+
+
+def predict_seq2seq_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps,
+                          device, save_attention_weights=False):
+    """
+    批量的序列到序列预测，把所有句子填充成一个批量一起编码，然后同步地逐步解码\n
+    每个句子预测出<eos>之后就标记为结束，所有句子都结束了才停止，每一步只同步一次
+    """
+    net.eval()
+    eos = tgt_vocab['<eos>']
+    with t.no_grad():
+        enc_X, enc_valid_len = build_src_batch(
+            src_sentences, src_vocab, num_steps, device)
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        dec_X = t.full((enc_X.shape[0], 1), tgt_vocab['<bos>'],
+                       dtype=t.long, device=device)
+        finished = t.zeros(enc_X.shape[0], dtype=t.bool, device=device)
+        output_seq, attention_weight_seq = [], []
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            dec_X = Y.argmax(dim=2)
+            output_seq.append(dec_X)
+            if save_attention_weights:
+                attention_weight_seq.append(net.decoder.attention_weights)
+            finished |= dec_X.squeeze(1) == eos
+            if finished.all():
+                break
+    # 最后一次性拷贝回CPU
+    translations = [_to_translation(pred, tgt_vocab)
+                    for pred in t.cat(output_seq, dim=1).tolist()]
+    return translations, attention_weight_seq
+
+
+def beam_search(net, src_sentences, src_vocab, tgt_vocab, num_steps, device,
+                beam_size=4, alpha=0.75, early_stopping=False):
+    """
+    批量的束搜索，每个句子的beam_size个候选被打包进批量维度，一共batch_size*beam_size行\n
+    每一步从beam_size*vocab_size个候选中选出最好的beam_size个，然后通过net.decoder.reorder_state
+    在批量维度上挑选出对应的解码器状态\n
+    候选序列按照 log P / L^alpha 排序，alpha=0时不做长度归一化\n
+    一个句子的所有候选都输出了<eos>就把它从批量中移除，early_stopping=True时最好的候选结束就移除\n
+    返回翻译结果和对应的归一化分数
+    """
+    net.eval()
+    eos = tgt_vocab['<eos>']
+    with t.no_grad():
+        enc_X, enc_valid_len = build_src_batch(
+            src_sentences, src_vocab, num_steps, device)
+        batch_size = enc_X.shape[0]
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        # 每个句子的状态复制beam_size份
+        dec_state = net.decoder.reorder_state(dec_state, t.arange(
+            batch_size, device=device).repeat_interleave(beam_size))
+        # 一开始只有一个候选，其余的分数设为负无穷，避免选出重复的候选
+        scores = t.full((batch_size, beam_size), -float("inf"), device=device)
+        scores[:, 0] = 0
+        lengths = t.zeros((batch_size, beam_size),
+                          dtype=t.long, device=device)
+        finished = t.zeros((batch_size, beam_size),
+                           dtype=t.bool, device=device)
+        tokens = t.zeros((batch_size*beam_size, 0),
+                         dtype=t.long, device=device)
+        dec_X = t.full((batch_size*beam_size, 1), tgt_vocab['<bos>'],
+                       dtype=t.long, device=device)
+        # active[i] 是当前批量中第i个句子在输入中的下标
+        active = t.arange(batch_size, device=device)
+        results = [None]*batch_size
+
+        def collect(rows: t.Tensor):
+            # 排序之后第0个候选就是最好的
+            best = tokens.reshape(-1, beam_size, tokens.shape[1])[rows, 0]
+            best_scores = scores[rows, 0] / \
+                lengths[rows, 0].clamp(min=1).float()**alpha
+            for i, pred, score in zip(active[rows].tolist(), best.tolist(), best_scores.tolist()):
+                results[i] = (_to_translation(pred, tgt_vocab), score)
+
+        for _ in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            log_probs = F.log_softmax(Y[:, -1], dim=-1)
+            vocab_size = log_probs.shape[-1]
+            log_probs = log_probs.reshape(-1, beam_size, vocab_size)
+            # 已经结束的候选只能继续输出<eos>，分数和长度都不变
+            eos_only = t.full((vocab_size,), -float("inf"), device=device)
+            eos_only[eos] = 0
+            log_probs = t.where(finished[:, :, None], eos_only, log_probs)
+            candidates = (scores[:, :, None]+log_probs).reshape(-1,
+                                                                beam_size*vocab_size)
+            new_lengths = (lengths+(~finished).long())[:, :, None].expand(
+                -1, -1, vocab_size).reshape(-1, beam_size*vocab_size)
+            # 按长度归一化之后的分数选出最好的beam_size个候选
+            _, top = (candidates/new_lengths.float()**alpha).topk(beam_size, dim=1)
+            beam_idx, next_tokens = top // vocab_size, top % vocab_size
+            scores = candidates.gather(1, top)
+            lengths = new_lengths.gather(1, top)
+            finished = finished.gather(1, beam_idx) | (next_tokens == eos)
+            # 按照选出来的候选重新排列历史和解码器状态
+            index = (t.arange(beam_idx.shape[0], device=device)[:, None]*beam_size
+                     + beam_idx).reshape(-1)
+            tokens = t.cat([tokens[index], next_tokens.reshape(-1, 1)], dim=1)
+            dec_state = net.decoder.reorder_state(dec_state, index)
+            dec_X = next_tokens.reshape(-1, 1)
+            # 已经结束的句子移出批量
+            done = finished[:, 0] if early_stopping else finished.all(dim=1)
+            if done.any():
+                collect(done.nonzero().squeeze(1))
+                keep = (~done).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                index = (keep[:, None]*beam_size +
+                         t.arange(beam_size, device=device)).reshape(-1)
+                scores, lengths, finished = scores[keep], lengths[keep], finished[keep]
+                tokens, dec_X, active = tokens[index], dec_X[index], active[keep]
+                dec_state = net.decoder.reorder_state(dec_state, index)
+        else:
+            collect(t.arange(active.shape[0], device=device))
+    translations = [result[0] for result in results]
+    return translations, [result[1] for result in results]
+
+
+def _as_tokens(seq) -> list:
+    # Tensor先转换成python列表，哈希整数比哈希0维张量快得多
+    return seq.tolist() if hasattr(seq, "tolist") else list(seq)
+
+
+def _count_matches(pred_tokens: list, label_tokens: list, n: int) -> int:
+    """
+    n元语法的截断匹配数，n元语法直接用元组表示，不再拼接字符串
+    """
+    label_subs = {}
+    for gram in zip(*[label_tokens[i:] for i in range(n)]):
+        label_subs[gram] = label_subs.get(gram, 0)+1
+    num_matches = 0
+    for gram in zip(*[pred_tokens[i:] for i in range(n)]):
+        count = label_subs.get(gram, 0)
+        if count > 0:
+            num_matches += 1
+            label_subs[gram] = count-1
+    return num_matches
+
+
+def _bleu_from_counts(num_matches, num_ngrams, len_pred, len_label, k: int) -> float:
+    """
+    由匹配数、n元语法数和长度计算BLEU，浮点运算的顺序和bleu保持一致
+    """
+    if len_pred == 0:
+        return 0.
     score = math.exp(min(0, 1 - len_label / len_pred))
     for n in range(1, k + 1):
-        num_matches, label_subs = 0, collections.defaultdict(int)
-        for i in range(len_label - n + 1):
-            label_subs[' '.join(label_tokens[i: i + n])] += 1
-        for i in range(len_pred - n + 1):
-            if label_subs[' '.join(pred_tokens[i: i + n])] > 0:
-                num_matches += 1
-                label_subs[' '.join(pred_tokens[i: i + n])] -= 1
-        score *= math.pow(num_matches / (len_pred - n + 1), math.pow(0.5, n))
+        # 预测序列比n短，没有任何n元语法可以匹配
+        if num_ngrams[n-1] <= 0:
+            return 0.
+        score *= math.pow(num_matches[n-1] / num_ngrams[n-1], math.pow(0.5, n))
     return score
 
 
+def ngram_matches(pred_seqs, label_seqs, k: int) -> tuple[list, list, list, list]:
+    """
+    统计一批句子的n元语法截断匹配数\n
+    返回每个句子的 num_matches, num_ngrams (长度为k的列表) 以及预测和标签的长度
+    """
+    all_matches, all_ngrams, pred_lens, label_lens = [], [], [], []
+    for pred_tokens, label_tokens in zip(pred_seqs, label_seqs):
+        pred_tokens, label_tokens = _as_tokens(pred_tokens), _as_tokens(label_tokens)
+        len_pred = len(pred_tokens)
+        all_matches.append([_count_matches(pred_tokens, label_tokens, n)
+                            for n in range(1, k + 1)])
+        all_ngrams.append([len_pred - n + 1 for n in range(1, k + 1)])
+        pred_lens.append(len_pred)
+        label_lens.append(len(label_tokens))
+    return all_matches, all_ngrams, pred_lens, label_lens
+
+
+def sentence_bleu(pred_tokens, label_tokens, k: int) -> float:
+    """
+    计算一个句子的BLEU，输入是词元序列，词元下标或者字符串都可以，结果和bleu完全一样
+    """
+    return batch_bleu([pred_tokens], [label_tokens], k)[0]
+
+
+def batch_bleu(pred_seqs, label_seqs, k: int) -> list[float]:
+    """
+    一次计算一批句子的BLEU，每个句子的结果和sentence_bleu完全一样
+    """
+    num_matches, num_ngrams, pred_lens, label_lens = ngram_matches(
+        pred_seqs, label_seqs, k)
+    return [_bleu_from_counts(*counts, k) for counts in zip(
+        num_matches, num_ngrams, pred_lens, label_lens)]
+
+
+def corpus_bleu(pred_seqs, label_seqs, k: int) -> float:
+    """
+    语料库级别的BLEU，先累加所有句子的匹配数、n元语法数和长度，再计算精度和长度惩罚
+    """
+    num_matches, num_ngrams, pred_lens, label_lens = ngram_matches(
+        pred_seqs, label_seqs, k)
+    # 语料库中每个n元语法的总数不会是负数
+    num_ngrams = [sum(max(c, 0) for c in col) for col in zip(*num_ngrams)]
+    return _bleu_from_counts([sum(col) for col in zip(*num_matches)], num_ngrams,
+                             sum(pred_lens), sum(label_lens), k)
+
+
+def bleu(pred_seq, label_seq, k):  # @save
+    """计算BLEU"""
+    return sentence_bleu(pred_seq.split(' '), label_seq.split(' '), k)
+
+
+def split_heads(X: torch.Tensor, num_heads: int):
+    """
+    (batch_size, 个数, num_hiddens) -> (batch_size, num_heads, 个数, num_hiddens/num_heads)，返回视图不拷贝
+    """
+    return X.unflatten(-1, (num_heads, -1)).transpose(1, 2)
+
+
+def merge_heads(X: torch.Tensor):
+    """split_heads的逆操作"""
+    return X.transpose(1, 2).flatten(2)
+
+
 def transpose_qkv(X: torch.Tensor, num_heads: int):
     """
-    为了多注意力的并行计算而转换形状
+    为了多注意力的并行计算而转换形状，MultiHeadAttention已经改用split_heads
     """
     # 输入X的形状:(batch_size，查询或者“键－值”对的个数，num_hiddens)
     # 输出X的形状:(batch_size，查询或者“键－值”对的个数，num_heads，num_hiddens/num_heads)
@@ -1073,30 +1493,61 @@ def transpose_output(X: torch.Tensor, num_heads):
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, key_size, query_size, value_size, num_hiddens, num_heads, dropout, bias=False, **kwargs):
+    def __init__(self, key_size, query_size, value_size, num_hiddens, num_heads, dropout, bias=False,
+                 backend="math", fused_qkv=False, **kwargs):
         super().__init__(**kwargs)
         self.num_heads = num_heads
-        self.attention = DotProductAttention(dropout)
+        self.fused_qkv = fused_qkv
+        self.attention = DotProductAttention(dropout, backend)
         self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
         self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
         self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias=bias)
+        self._packed, self._packed_key = None, None
+
+    def packed_weight(self):
+        """
+        拼接好的QKV权重(weight, bias)，需要梯度时每次重新拼接，推理时在权重的版本号和地址不变时重复使用
+        """
+        linears = (self.W_q, self.W_k, self.W_v)
+        params = [m.weight for m in linears]+([m.bias for m in linears] if self.W_q.bias is not None else [])
+        if t.is_grad_enabled() and any(p.requires_grad for p in params):
+            self._packed, self._packed_key = None, None
+            return t.cat(params[:3]), t.cat(params[3:]) if len(params) > 3 else None
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if key != self._packed_key:
+            with t.no_grad():
+                self._packed = (t.cat(params[:3]), t.cat(params[3:]) if len(params) > 3 else None)
+            self._packed_key = key
+        return self._packed
+
+    def packed_qkv(self, X):
+        """
+        自注意力的快速路径，fused_qkv=True时使用，拼起来的QKV权重只做一次GEMM，然后拆成多头的视图
+        """
+        weight, bias = self.packed_weight()
+        qkv = F.linear(X, weight, bias)
+        # (3, batch_size, num_heads, num_steps, num_hiddens/num_heads)
+        return qkv.unflatten(-1, (3, self.num_heads, -1)).permute(2, 0, 3, 1, 4).unbind(0)
 
     def forward(self, queries, keys, values, valid_lens):
-        # 将这些玩意拆成batch实现并行化
+        # 在(batch_size, num_heads, 个数, head_dim)的视图上并行计算所有的头
         # queries, keys, values.shape = (batch_size, num_of_q/k/v s,num_hiddens)
-        # valied_lens.shape = (batch_size,num_queries)
-        queries = transpose_qkv(self.W_q.forward(queries), self.num_heads)
-        keys = transpose_qkv(self.W_k.forward(keys), self.num_heads)
-        values = transpose_qkv(self.W_v.forward(values), self.num_heads)
+        # valied_lens.shape = (batch_size,) 或者 (batch_size,num_queries)
+        if self.fused_qkv and queries is keys and keys is values:
+            queries, keys, values = self.packed_qkv(queries)
+        else:
+            queries = split_heads(self.W_q.forward(queries), self.num_heads)
+            keys = split_heads(self.W_k.forward(keys), self.num_heads)
+            values = split_heads(self.W_v.forward(values), self.num_heads)
 
+        # 遮蔽在注意力头的维度上广播，不需要复制num_heads份
         if valid_lens is not None:
-            valid_lens = t.repeat_interleave(
-                valid_lens, repeats=self.num_heads, dim=0)
+            valid_lens = valid_lens_mask(valid_lens, keys.shape[2]).unsqueeze(1)
         output = self.attention(queries, keys, values, valid_lens)
 
         # output_concat的形状:(batch_size，查询的个数，num_hiddens)
-        output_concat = transpose_output(output, self.num_heads)
+        output_concat = merge_heads(output)
         return self.W_o(output_concat)
 
 
@@ -0,0 +1,32 @@
+"""
+测试用的导入工具\n
+TransformerFullVersion和TransformerWmathorVersion都是平铺的脚本目录，且都有model.py/datasets.py，
+导入其中一个版本之前要把另一个版本留在sys.modules中的同名模块清掉
+"""
+import importlib
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+VERSIONS = {
+    "full": os.path.join(ROOT, "Attention", "TransformerFullVersion"),
+    "wmathor": os.path.join(ROOT, "Attention", "TransformerWmathorVersion"),
+}
+FLAT_MODULES = ["model", "datasets", "utils", "export", "server", "loading", "checkpoint", "benchmark", "train"]
+
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+
+def import_version(version, *names):
+    """
+    从指定版本目录导入模块，返回模块列表(只导入一个时直接返回该模块)
+    """
+    for name in FLAT_MODULES:
+        sys.modules.pop(name, None)
+    for path in VERSIONS.values():
+        while path in sys.path:
+            sys.path.remove(path)
+    sys.path.insert(0, VERSIONS[version])
+    modules = [importlib.import_module(name) for name in names]
+    return modules[0] if len(modules) == 1 else modules
@@ -0,0 +1,47 @@
+"""
+多头注意力保存的attention_weights的形状是(batch_size*num_heads, 查询数, 键值对数)，
+第b*num_heads+h行是第b个样本第h个头的注意力权重
+"""
+import contextlib
+import math
+import torch as t
+import torch.nn.functional as F
+from helpers import import_version
+import pltutils
+
+BATCH, NUM_HEADS, NUM_QUERIES, NUM_KVS, NUM_HIDDENS = 3, 4, 5, 7, 16
+
+
+def reference_weights(attention, queries, keys, valid_lens):
+    # 逐个头计算的注意力权重，按照(b, h)的顺序排列
+    q = attention.W_q(queries).reshape(BATCH, NUM_QUERIES, NUM_HEADS, -1)
+    k = attention.W_k(keys).reshape(BATCH, NUM_KVS, NUM_HEADS, -1)
+    weights = []
+    for b in range(BATCH):
+        for h in range(NUM_HEADS):
+            scores = q[b, :, h] @ k[b, :, h].T/math.sqrt(q.shape[-1])
+            scores[:, valid_lens[b]:] = -1e6
+            weights.append(F.softmax(scores, dim=-1))
+    return t.stack(weights)
+
+
+def check_attention_weights(MultiHeadAttention, capture=lambda net: contextlib.nullcontext()):
+    t.manual_seed(0)
+    attention = MultiHeadAttention(NUM_HIDDENS, NUM_HIDDENS, NUM_HIDDENS, NUM_HIDDENS, NUM_HEADS, 0.).eval()
+    queries = t.randn(BATCH, NUM_QUERIES, NUM_HIDDENS)
+    keys = t.randn(BATCH, NUM_KVS, NUM_HIDDENS)
+    valid_lens = t.tensor([3, 7, 5])
+    with t.no_grad(), capture(attention):
+        attention(queries, keys, keys, valid_lens)
+        weights = attention.attention.attention_weights
+        assert weights.shape == (BATCH*NUM_HEADS, NUM_QUERIES, NUM_KVS)
+        assert t.allclose(weights, reference_weights(attention, queries, keys, valid_lens), atol=1e-6)
+
+
+def test_pltutils_attention_weights_shape():
+    check_attention_weights(pltutils.MultiHeadAttention)
+
+
+def test_full_version_attention_weights_shape():
+    model = import_version("full", "model")
+    check_attention_weights(model.MultiHeadAttention, model.capture_attention)
@@ -0,0 +1,55 @@
+"""
+用GRU的Seq2SeqEncoder/Seq2SeqDecoder端到端地运行束搜索
+"""
+import os
+import sys
+import torch as t
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from pltutils import Vocab, Seq2SeqEncoder, Seq2SeqDecoder, EncoderDecoder, beam_search, predict_seq2seq_batch
+
+RESERVED = ["<pad>", "<bos>", "<eos>"]
+
+
+def make_gru_net(src_vocab, tgt_vocab):
+    t.manual_seed(0)
+    encoder = Seq2SeqEncoder(len(src_vocab), 8, 16, 2)
+    decoder = Seq2SeqDecoder(len(tgt_vocab), 8, 16, 2)
+    return EncoderDecoder(encoder, decoder)
+
+
+def make_vocabs():
+    src_vocab = Vocab([["go", ".", "i", "lost", "he's", "calm"]], reserved_tokens=RESERVED)
+    tgt_vocab = Vocab([["va", "!", "j'ai", "perdu", ".", "il", "est", "calme"]], reserved_tokens=RESERVED)
+    return src_vocab, tgt_vocab
+
+
+# 句子数多于GRU的层数，在错误的维度上挑选状态会越界或者混淆不同的句子
+SENTENCES = ["go .", "i lost .", "he's calm .", "go", "i lost"]
+
+
+def test_beam_search_gru():
+    src_vocab, tgt_vocab = make_vocabs()
+    net = make_gru_net(src_vocab, tgt_vocab)
+    translations, scores = beam_search(net, SENTENCES, src_vocab, tgt_vocab, 6, "cpu", beam_size=3)
+    assert len(translations) == len(SENTENCES)
+    assert all(isinstance(s, str) for s in translations)
+    assert all(score <= 0 for score in scores)
+
+
+def test_beam_size_one_matches_greedy_gru():
+    src_vocab, tgt_vocab = make_vocabs()
+    net = make_gru_net(src_vocab, tgt_vocab)
+    greedy, _ = predict_seq2seq_batch(net, SENTENCES, src_vocab, tgt_vocab, 6, "cpu")
+    beam, _ = beam_search(net, SENTENCES, src_vocab, tgt_vocab, 6, "cpu", beam_size=1, alpha=0)
+    assert beam == greedy
+
+
+def test_beam_search_matches_per_sentence_gru():
+    # 批量中的每个句子的结果和单独搜索的结果相同
+    src_vocab, tgt_vocab = make_vocabs()
+    net = make_gru_net(src_vocab, tgt_vocab)
+    batched, batched_scores = beam_search(net, SENTENCES, src_vocab, tgt_vocab, 6, "cpu", beam_size=3)
+    for sentence, translation, score in zip(SENTENCES, batched, batched_scores):
+        single, single_scores = beam_search(net, [sentence], src_vocab, tgt_vocab, 6, "cpu", beam_size=3)
+        assert single == [translation]
+        assert abs(single_scores[0]-score) < 1e-5
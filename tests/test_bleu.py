@@ -0,0 +1,25 @@
+"""
+TransformerWmathorVersion/benchmark.py中的corpus_bleu是本地的一份拷贝，结果要和pltutils、
+TransformerFullVersion/utils.py中的实现相同
+"""
+import random
+from helpers import import_version
+import pltutils
+
+
+def random_corpora(num_corpora=50, seed=0):
+    rng = random.Random(seed)
+    for _ in range(num_corpora):
+        pairs = [([rng.randrange(6) for _ in range(rng.randint(0, 8))],
+                  [rng.randrange(6) for _ in range(rng.randint(1, 8))]) for _ in range(rng.randint(1, 6))]
+        yield [p for p, _ in pairs], [l for _, l in pairs]
+
+
+def test_corpus_bleu_copies_agree():
+    wmathor_benchmark = import_version("wmathor", "benchmark")
+    full_utils = import_version("full", "utils")
+    for pred_seqs, label_seqs in random_corpora():
+        for k in (1, 2, 4):
+            expected = pltutils.corpus_bleu(pred_seqs, label_seqs, k)
+            assert abs(wmathor_benchmark.corpus_bleu(pred_seqs, label_seqs, k)-expected) < 1e-12
+            assert abs(full_utils.corpus_bleu(pred_seqs, label_seqs, k)-expected) < 1e-12
@@ -0,0 +1,38 @@
+"""
+build_array_nmt改成按offsets批量填充之后，输出(包括dtype)要和原来逐行truncate_pad的实现完全一致
+"""
+import torch as t
+from helpers import import_version
+import pltutils
+
+LINES = [["go", "."], ["i", "lost", "."], ["he's", "calm", ".", "go", "go", "go"], [], ["unknown", "word"]]
+
+
+def baseline_build_array_nmt(lines, vocab, num_steps, truncate_pad):
+    # 原来的实现：逐行截断或填充，有效长度由和<pad>比较得到
+    lines = [vocab[l] for l in lines]
+    lines = [l + [vocab["<eos>"]] for l in lines]
+    array = t.tensor([truncate_pad(l, num_steps, vocab["<pad>"]) for l in lines])
+    valid_len = (array != vocab["<pad>"]).type(t.int32).sum(1)
+    return array, valid_len
+
+
+def check_same(vocab, build_array_nmt, truncate_pad):
+    for num_steps in (1, 3, 4, 10):
+        array, valid_len = build_array_nmt(LINES, vocab, num_steps)
+        expected_array, expected_len = baseline_build_array_nmt(LINES, vocab, num_steps, truncate_pad)
+        assert array.dtype == expected_array.dtype
+        assert valid_len.dtype == expected_len.dtype
+        assert t.equal(array, expected_array)
+        assert t.equal(valid_len, expected_len)
+
+
+def test_pltutils_build_array_nmt_matches_baseline():
+    vocab = pltutils.Vocab([["go", ".", "i", "lost", "he's", "calm"]], reserved_tokens=["<pad>", "<bos>", "<eos>"])
+    check_same(vocab, pltutils.build_array_nmt, pltutils.truncate_pad)
+
+
+def test_full_version_build_array_nmt_matches_baseline():
+    datasets = import_version("full", "datasets")
+    vocab = datasets.Vocab([["go", ".", "i", "lost", "he's", "calm"]], reserved_tokens=datasets.RESERVED_TOKENS)
+    check_same(vocab, datasets.build_array_nmt, datasets.truncate_pad)
@@ -0,0 +1,24 @@
+"""
+CheckpointManager只保留最近的keep个断点
+"""
+import os
+import pytest
+import torch as t
+from helpers import import_version
+
+
+def test_keep_must_be_positive(tmp_path):
+    checkpoint = import_version("full", "checkpoint")
+    for keep in (0, -1):
+        with pytest.raises(ValueError):
+            checkpoint.CheckpointManager(str(tmp_path), keep)
+
+
+def test_keeps_latest_checkpoints(tmp_path):
+    checkpoint = import_version("full", "checkpoint")
+    manager = checkpoint.CheckpointManager(str(tmp_path), keep=1)
+    for step in range(3):
+        manager.save({"step": step, "weight": t.full((2,), float(step))}, step)
+    manager.close()
+    assert [os.path.basename(p) for p in manager.checkpoints()] == ["checkpoint-00000002.pt"]
+    assert checkpoint.load_checkpoint(manager.latest())["step"] == 2
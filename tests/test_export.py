@@ -0,0 +1,57 @@
+"""
+导出的TorchScript模块和原来的模型逐步的logits以及贪心解码的结果一致
+"""
+import os
+import torch as t
+from helpers import import_version
+from test_predict_seq2seq_batch import random_sentences
+
+NUM_STEPS = 8
+
+
+def make_exported(tmp_path):
+    export, loading, utils = import_version("full", "export", "loading", "utils")
+    t.manual_seed(0)
+    vocab = loading.make_vocab(30)
+    net = loading.make_model(len(vocab), len(vocab)).eval()
+    path = os.path.join(tmp_path, "translator.pt")
+    export.export_translator(net, path, NUM_STEPS)
+    return net, vocab, t.jit.load(path), utils
+
+
+def test_decode_step_matches_eager(tmp_path):
+    net, vocab, scripted, utils = make_exported(tmp_path)
+    enc_X, enc_valid_len = utils.build_src_batch(random_sentences(30, 6, NUM_STEPS-1), vocab, NUM_STEPS, "cpu")
+    with t.no_grad():
+        dec_state = net.decoder.init_state(net.encoder(enc_X, enc_valid_len), enc_valid_len)
+        cache = scripted.encode(enc_X, enc_valid_len)
+        dec_X = t.full((enc_X.shape[0], 1), vocab["<bos>"], dtype=t.long)
+        for _ in range(NUM_STEPS):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            logits, cache = scripted.decode_step(dec_X, cache)
+            assert t.allclose(logits, Y[:, 0], atol=1e-5)
+            dec_X = Y.argmax(dim=2)
+
+
+def test_translate_matches_predict_seq2seq_batch(tmp_path):
+    net, vocab, scripted, utils = make_exported(tmp_path)
+    sentences = random_sentences(30, 10, NUM_STEPS-1, seed=3)
+    eager, _ = utils.predict_seq2seq_batch(net, sentences, vocab, vocab, NUM_STEPS, "cpu")
+    enc_X, enc_valid_len = utils.build_src_batch(sentences, vocab, NUM_STEPS, "cpu")
+    with t.no_grad():
+        rows = scripted.translate(enc_X, enc_valid_len, vocab["<bos>"], vocab["<eos>"], NUM_STEPS).tolist()
+    eos = vocab["<eos>"]
+    exported = [" ".join(vocab.to_tokens(row[:row.index(eos)] if eos in row else row)) for row in rows]
+    assert exported == eager
+
+
+def test_decode_step_shares_self_cache(tmp_path):
+    # decode_step原地更新self_k/self_v，返回的cache和传入的cache共用它们
+    _, vocab, scripted, utils = make_exported(tmp_path)
+    enc_X, enc_valid_len = utils.build_src_batch(["w1 w2"], vocab, NUM_STEPS, "cpu")
+    with t.no_grad():
+        cache = scripted.encode(enc_X, enc_valid_len)
+        _, new_cache = scripted.decode_step(t.tensor([[vocab["<bos>"]]]), cache)
+    assert new_cache["self_k"] is cache["self_k"] and new_cache["self_v"] is cache["self_v"]
+    assert cache["self_k"][:, :, :, 0].abs().sum() > 0
+    assert int(cache["length"]) == 0 and int(new_cache["length"]) == 1
@@ -0,0 +1,62 @@
+"""
+批量贪心解码predict_seq2seq_batch的结果和逐句的predict_seq2seq相同
+"""
+import random
+import torch as t
+from helpers import import_version
+import pltutils
+from test_beam_search import make_gru_net, make_vocabs
+
+
+def random_sentences(vocab_size, num_sentences, max_len, seed=0):
+    rng = random.Random(seed)
+    return [" ".join(f"w{rng.randrange(vocab_size)}" for _ in range(rng.randint(1, max_len)))
+            for _ in range(num_sentences)]
+
+
+def check_matches_per_sentence(predict_seq2seq, predict_seq2seq_batch, net, sentences, src_vocab, tgt_vocab, num_steps):
+    batched, _ = predict_seq2seq_batch(net, sentences, src_vocab, tgt_vocab, num_steps, "cpu")
+    assert len(batched) == len(sentences)
+    for sentence, translation in zip(sentences, batched):
+        assert predict_seq2seq(net, sentence, src_vocab, tgt_vocab, num_steps, "cpu")[0] == translation
+
+
+def make_transformer():
+    loading = import_version("full", "loading")
+    t.manual_seed(0)
+    vocab = loading.make_vocab(30)
+    return loading.make_model(len(vocab), len(vocab)), vocab
+
+
+def test_pltutils_batch_matches_per_sentence_transformer():
+    # Transformer编码时屏蔽了<pad>，长短不同的句子放在一个批量中结果也不变
+    net, vocab = make_transformer()
+    sentences = random_sentences(30, 12, 8)
+    check_matches_per_sentence(pltutils.predict_seq2seq, pltutils.predict_seq2seq_batch,
+                               net, sentences, vocab, vocab, 10)
+
+
+def test_full_version_batch_matches_per_sentence_transformer():
+    net, vocab = make_transformer()
+    utils = import_version("full", "utils")
+    sentences = random_sentences(30, 12, 8, seed=1)
+    check_matches_per_sentence(utils.predict_seq2seq, utils.predict_seq2seq_batch,
+                               net, sentences, vocab, vocab, 10)
+
+
+def test_pltutils_batch_matches_per_sentence_gru():
+    # GRU编码器不看有效长度，所以只用等长的句子比较
+    src_vocab, tgt_vocab = make_vocabs()
+    net = make_gru_net(src_vocab, tgt_vocab)
+    sentences = ["go .", "i lost", "he's calm", "calm ."]
+    check_matches_per_sentence(pltutils.predict_seq2seq, pltutils.predict_seq2seq_batch,
+                               net, sentences, src_vocab, tgt_vocab, 6)
+
+
+def test_predict_seq2seq_batch_attention_weights():
+    net, vocab = make_transformer()
+    sentences = random_sentences(30, 3, 5, seed=2)
+    translations, attention_weight_seq = pltutils.predict_seq2seq_batch(
+        net, sentences, vocab, vocab, 10, "cpu", save_attention_weights=True)
+    assert len(translations) == 3
+    assert 1 <= len(attention_weight_seq) <= 10
@@ -0,0 +1,86 @@
+"""
+翻译服务的请求校验：格式不对的请求回复400，不会影响同一个批量中的其他请求
+"""
+import asyncio
+import json
+import torch as t
+from helpers import import_version
+
+server, loading = import_version("full", "server", "loading")
+
+
+def make_batcher(max_delay_ms=200.):
+    t.manual_seed(0)
+    src_vocab = tgt_vocab = loading.make_vocab(20)
+    net = loading.make_model(len(src_vocab), len(tgt_vocab)).eval()
+    return server.MicroBatcher(net, src_vocab, tgt_vocab, 6, "cpu", max_delay_ms=max_delay_ms)
+
+
+async def send(port, raw: bytes):
+    """
+    发送原始的请求字节，返回(状态码, 响应体, 服务端是否关闭了连接)
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(raw)
+    await writer.drain()
+    status_line = await reader.readline()
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = json.loads(await reader.readexactly(int(headers["content-length"])))
+    writer.write_eof()
+    closed = await reader.read() == b""
+    writer.close()
+    return int(status_line.split()[1]), body, closed
+
+
+def post_translate(payload) -> bytes:
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+    return b"POST /translate HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+
+
+async def run_with_server(batcher, coroutine):
+    srv = await server.serve(batcher, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+    try:
+        return await coroutine(port)
+    finally:
+        srv.batcher_task.cancel()
+        srv.close()
+        await srv.wait_closed()
+        batcher.executor.shutdown()
+
+
+def test_bad_text_does_not_fail_the_batch():
+    batcher = make_batcher()
+    good = ["w1 w2 w3", "w4", "w5 w6"]
+    bad = [{"text": 123}, {"text": ""}, {"text": "   "}, {"text": None}, {"text": ["w1"]}, {"other": "w1"}, b"not json"]
+
+    async def requests(port):
+        # 合法和不合法的请求同时到达，max_delay_ms足够大，合法的请求会进入同一个批量
+        return await asyncio.gather(*[send(port, post_translate({"text": s})) for s in good],
+                                    *[send(port, post_translate(p)) for p in bad])
+    responses = asyncio.run(run_with_server(batcher, requests))
+    expected = batcher._decode(good)
+    for (status, body, _), translation in zip(responses[:len(good)], expected):
+        assert status == 200
+        assert body["translation"] == translation
+        assert body["batch_size"] == len(good)
+    assert [status for status, _, _ in responses[len(good):]] == [400]*len(bad)
+
+
+def test_malformed_request_returns_400_and_closes():
+    batcher = make_batcher(max_delay_ms=1.)
+    raws = [
+        b"GARBAGE\r\n\r\n",
+        b"POST /translate HTTP/1.1\r\nContent-Length: abc\r\n\r\n",
+        b"POST /translate HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+    ]
+
+    async def requests(port):
+        return [await send(port, raw) for raw in raws]
+    for status, body, closed in asyncio.run(run_with_server(batcher, requests)):
+        assert status == 400
+        assert "error" in body
+        assert closed
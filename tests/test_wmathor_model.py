@@ -0,0 +1,62 @@
+"""
+TransformerWmathorVersion的多头合并：解码器前缀的输出不依赖后面的词元，旧的合并方式只能整句重算
+"""
+import pytest
+import torch as t
+from helpers import import_version
+
+model = import_version("wmathor", "model")
+SRC_VOCAB, TGT_VOCAB, START, END = 11, 13, 1, 2
+
+
+def make_model():
+    t.manual_seed(0)
+    net = model.Transformer(SRC_VOCAB, TGT_VOCAB, d_model=32, d_ff=64, n_layers=2, n_heads=4).eval()
+    enc_inputs = t.tensor([[3, 4, 5, 6, 0], [7, 8, 9, 0, 0]])
+    dec_inputs = t.tensor([[START, 3, 4, 5, 6, 7], [START, 8, 9, 10, 11, 12]])
+    return net, enc_inputs, dec_inputs
+
+
+def decode_prefix(net, enc_inputs, dec_inputs, prefix_len):
+    with t.no_grad():
+        enc_outputs, _ = net.encoder(enc_inputs)
+        dec_outputs, _, _ = net.decoder(dec_inputs, enc_inputs, enc_outputs)
+    return dec_outputs[:, :prefix_len]
+
+
+def test_prefix_outputs_do_not_depend_on_later_tokens():
+    net, enc_inputs, dec_inputs = make_model()
+    for prefix_len in range(1, dec_inputs.shape[1]):
+        prefix = decode_prefix(net, enc_inputs, dec_inputs[:, :prefix_len], prefix_len)
+        full = decode_prefix(net, enc_inputs, dec_inputs, prefix_len)
+        assert t.allclose(prefix, full, atol=1e-5)
+
+
+def test_legacy_head_merge_mixes_positions():
+    # 旧的合并方式把不同位置的结果混在一起，前缀的输出会随着后面的词元变化
+    net, enc_inputs, dec_inputs = make_model()
+    model.set_legacy_head_merge(net)
+    prefix = decode_prefix(net, enc_inputs, dec_inputs[:, :3], 3)
+    full = decode_prefix(net, enc_inputs, dec_inputs, 3)
+    assert not t.allclose(prefix, full, atol=1e-5)
+
+
+def test_greedy_decode_matches_full_recompute():
+    net, enc_inputs, _ = make_model()
+    cached = model.greedy_decode(net, enc_inputs, START, max_len=6)
+    dec_inputs = t.full((enc_inputs.shape[0], 1), START, dtype=t.long)
+    with t.no_grad():
+        for _ in range(6):
+            logits = net(enc_inputs, dec_inputs)[0].view(enc_inputs.shape[0], dec_inputs.shape[1], -1)
+            dec_inputs = t.cat([dec_inputs, logits[:, -1].argmax(dim=-1, keepdim=True)], -1)
+    assert t.equal(cached, dec_inputs)
+
+
+def test_greedy_decode_rejects_legacy_model():
+    net, enc_inputs, _ = make_model()
+    model.set_legacy_head_merge(net)
+    with pytest.raises(ValueError):
+        model.greedy_decode(net, enc_inputs, START, END)
+    # 关掉开关之后可以正常解码
+    model.set_legacy_head_merge(net, False)
+    assert model.greedy_decode(net, enc_inputs, START, END).shape[0] == enc_inputs.shape[0]